@@ -0,0 +1,201 @@
+"""
+Контроль допуска задач в очередь генерации
+
+Решение принимается при постановке задачи (QueueManager.add_task), до того
+как она займет место в очереди:
+- глобальный сброс нагрузки: прогноз времени разбора очереди (стоимость
+  ожидающих задач × секунды на единицу стоимости / число обработчиков)
+  не должен превышать max_drain_seconds уровня пользователя — при
+  перегрузке первыми отказывают уровням с меньшим порогом;
+- ограничения пользователя: ожидающие задачи (max_queued), ожидающие и
+  генерируемые (max_inflight), их суммарная стоимость (max_pending_cost);
+- корзина токенов пользователя (rate в секунду, не больше burst), задача
+  списывает свою стоимость.
+
+Стоимость — scheduling.estimate_task_cost: 1.0 у генерации с DEFAULT_PARAMS,
+2048×2048 на 50 шагах стоит в 40 раз больше. Секунды на единицу стоимости
+уточняются по завершенным пакетам (экспоненциальное сглаживание).
+
+Ограничения задаются по уровням (ADMISSION_TIERS, уровень пользователя —
+USER_TIERS), 0 — без ограничения. Отказ — AdmissionRejected с retry_after.
+На пользователя хранится одна запись фиксированного размера, пока у него
+есть задачи или не пополнилась корзина.
+"""
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable, Dict, Optional
+
+from config import ADMISSION_CONTROL, ADMISSION_SECONDS_PER_COST, ADMISSION_TIERS, USER_TIERS
+from rate_limit import TokenBucket
+from scheduling import estimate_task_cost
+
+if TYPE_CHECKING:
+    from queue_manager import GenerationTask
+
+DEFAULT_TIER = "default"
+
+# Вес нового наблюдения в оценке секунд на единицу стоимости
+_SMOOTHING = 0.2
+
+class AdmissionRejected(Exception):
+    """Задача не принята в очередь.
+    
+    reason: queue_full, overload, queued, inflight, quota или rate;
+    retry_after — через сколько секунд повтор имеет смысл.
+    """
+    
+    def __init__(self, message: str, reason: str, retry_after: float):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = max(1.0, retry_after)
+
+@dataclass(frozen=True)
+class TierLimits:
+    """Ограничения уровня пользователей; 0 — без ограничения"""
+    rate: float = 0.0
+    burst: float = 0.0
+    max_queued: int = 0
+    max_inflight: int = 0
+    max_pending_cost: float = 0.0
+    max_drain_seconds: float = 0.0
+
+class _UserState:
+    __slots__ = ("queued", "processing", "pending_cost", "bucket")
+    
+    def __init__(self):
+        self.queued = 0
+        self.processing = 0
+        self.pending_cost = 0.0
+        self.bucket: Optional[TokenBucket] = None
+
+class AdmissionController:
+    """Допуск задач в очередь; QueueManager сообщает ему переходы задач (track) и завершение пакетов"""
+    
+    def __init__(self, tiers: Optional[Dict[str, Dict]] = None, user_tiers: Optional[Dict[int, str]] = None,
+                 seconds_per_cost: float = ADMISSION_SECONDS_PER_COST, clock: Callable[[], float] = time.time):
+        self.tiers = {name: TierLimits(**limits) for name, limits in (tiers or {}).items()}
+        self.user_tiers = user_tiers if user_tiers is not None else {}
+        self.seconds_per_cost = seconds_per_cost
+        self.clock = clock
+        # Стоимость задач, ожидающих в очереди (для прогноза времени ее разбора)
+        self.queued_cost = 0.0
+        self.queued_tasks = 0
+        # Пользователи с задачами или неполной корзиной; в начале — давно не менявшиеся
+        self._users: "OrderedDict[int, _UserState]" = OrderedDict()
+        # Генерируемые пакеты: время начала и суммарная стоимость
+        self._batches: Dict[str, list] = {}
+    
+    def limits_for(self, user_id: int) -> TierLimits:
+        tier = self.user_tiers.get(user_id, DEFAULT_TIER)
+        return self.tiers.get(tier) or self.tiers.get(DEFAULT_TIER) or TierLimits()
+    
+    def drain_seconds(self, slots: int = 1) -> float:
+        """Прогноз времени, за которое обработчики разберут текущую очередь"""
+        return self.queued_cost * self.seconds_per_cost / max(1, slots)
+    
+    def _state(self, user_id: int) -> _UserState:
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = _UserState()
+        else:
+            self._users.move_to_end(user_id)
+        return state
+    
+    def _prune(self):
+        """Удаляет до двух давно не менявшихся записей без задач и с полной корзиной"""
+        for _ in range(2):
+            if not self._users:
+                return
+            user_id, state = next(iter(self._users.items()))
+            if state.queued or state.processing or (state.bucket is not None and
+                                                    state.bucket.time_until(state.bucket.capacity) > 0):
+                self._users.move_to_end(user_id)
+                return
+            del self._users[user_id]
+    
+    def admit(self, user_id: int, parameters: Optional[Dict], queue_length: int, max_queue_size: int,
+              slots: int = 1) -> float:
+        """
+        Проверяет, можно ли поставить задачу пользователя в очередь, и списывает токены
+        
+        Args:
+            user_id (int): Пользователь
+            parameters (Optional[Dict]): Параметры задачи
+            queue_length (int): Текущая длина очереди
+            max_queue_size (int): Жесткий предел длины очереди
+            slots (int): Число одновременно генерируемых пакетов
+        
+        Returns:
+            float: Стоимость задачи
+        
+        Raises:
+            AdmissionRejected: Задачу сейчас принять нельзя
+        """
+        self._prune()
+        cost = estimate_task_cost(parameters)
+        if queue_length >= max_queue_size:
+            average = self.queued_cost / self.queued_tasks if self.queued_tasks else 1.0
+            raise AdmissionRejected("Очередь переполнена. Попробуйте позже.", "queue_full",
+                                    average * self.seconds_per_cost / max(1, slots))
+        
+        limits = self.limits_for(user_id)
+        drain = self.drain_seconds(slots)
+        if limits.max_drain_seconds and drain > limits.max_drain_seconds:
+            raise AdmissionRejected("Генератор перегружен. Попробуйте позже.", "overload",
+                                    drain - limits.max_drain_seconds)
+        
+        state = self._users.get(user_id)
+        if state is not None:
+            # Время, за которое генерируется одна задача пользователя
+            pending = state.queued + state.processing
+            task_seconds = (state.pending_cost / pending if pending else cost) * self.seconds_per_cost
+            if limits.max_queued and state.queued >= limits.max_queued:
+                raise AdmissionRejected(f"У вас уже {state.queued} задач в очереди.", "queued",
+                                        task_seconds * state.queued / max(1, slots))
+            if limits.max_inflight and pending >= limits.max_inflight:
+                raise AdmissionRejected(f"У вас уже {pending} незавершенных задач.", "inflight", task_seconds)
+            # Дорогую задачу можно поставить, когда других задач у пользователя нет
+            if limits.max_pending_cost and pending and state.pending_cost + cost > limits.max_pending_cost:
+                raise AdmissionRejected("Суммарная стоимость ваших задач превышает лимит.", "quota",
+                                        (state.pending_cost + cost - limits.max_pending_cost) * self.seconds_per_cost)
+        
+        if limits.rate > 0:
+            state = self._state(user_id)
+            if state.bucket is None:
+                state.bucket = TokenBucket(limits.rate, max(limits.burst, 1.0), clock=self.clock)
+            # Задача дороже всей корзины требует полной корзины
+            tokens = min(cost, state.bucket.capacity)
+            if not state.bucket.try_acquire(tokens):
+                raise AdmissionRejected("Слишком много запросов.", "rate", state.bucket.time_until(tokens))
+        return cost
+    
+    def track(self, task: "GenerationTask", queued: int = 0, processing: int = 0):
+        """Учитывает переход задачи: изменение числа ожидающих и генерируемых задач ее пользователя"""
+        cost = estimate_task_cost(task.parameters)
+        if queued:
+            self.queued_cost = max(0.0, self.queued_cost + queued * cost)
+            self.queued_tasks += queued
+        state = self._state(task.user_id)
+        state.queued += queued
+        state.processing += processing
+        state.pending_cost = max(0.0, state.pending_cost + (queued + processing) * cost)
+    
+    def batch_started(self, batch_id: str, task: "GenerationTask"):
+        entry = self._batches.get(batch_id)
+        if entry is None:
+            entry = self._batches[batch_id] = [self.clock(), 0.0]
+        entry[1] += estimate_task_cost(task.parameters)
+    
+    def batch_finished(self, batch_id: str, completed: bool):
+        """Пакет завершен; по успешному уточняется время генерации единицы стоимости"""
+        entry = self._batches.pop(batch_id, None)
+        if entry is None or not completed or entry[1] <= 0:
+            return
+        started, cost = entry
+        observed = (self.clock() - started) / cost
+        self.seconds_per_cost += _SMOOTHING * (observed - self.seconds_per_cost)
+
+def create_admission(enabled: bool = ADMISSION_CONTROL, clock: Callable[[], float] = time.time) -> AdmissionController:
+    """Контроль допуска по настройкам; без ADMISSION_CONTROL остается только предел QUEUE_MAX_SIZE"""
+    return AdmissionController(ADMISSION_TIERS if enabled else None, USER_TIERS, clock=clock)
@@ -5,7 +5,8 @@ from aiogram import types
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
-from sd_client import StableDiffusionClient
+from model_catalog import ModelCatalog
+from user_settings import UserSettings
 
 class AdvancedGenerationStates(StatesGroup):
     waiting_for_prompt = State()
@@ -15,8 +16,9 @@ class AdvancedGenerationStates(StatesGroup):
     waiting_for_size = State()
 
 class AdvancedFeatures:
-    def __init__(self, sd_client: StableDiffusionClient):
-        self.sd_client = sd_client
+    def __init__(self, model_catalog: ModelCatalog, user_settings: UserSettings):
+        self.model_catalog = model_catalog
+        self.user_settings = user_settings
     
     async def start_advanced_generation(self, message: types.Message, state: FSMContext):
         """Начать продвинутую генерацию с настройкой параметров"""
@@ -97,8 +99,12 @@ class AdvancedFeatures:
             "Или отправьте 'default' для 512x512"
         )
     
-    async def handle_size(self, message: types.Message, state: FSMContext):
-        """Обработка размера изображения"""
+    async def handle_size(self, message: types.Message, state: FSMContext) -> Optional[Dict[str, Any]]:
+        """Обработка размера изображения.
+        
+        Возвращает собранные параметры генерации для постановки в очередь
+        или None, если размер введен неверно.
+        """
         if message.text.lower() == 'default':
             width, height = 512, 512
         else:
@@ -112,20 +118,21 @@ class AdvancedFeatures:
                 # Проверяем, что размеры кратные 8 (требование SD)
                 if width % 8 != 0 or height % 8 != 0:
                     await message.answer("❌ Размеры должны быть кратны 8. Попробуйте снова:")
-                    return
+                    return None
                 
                 if width < 64 or height < 64 or width > 2048 or height > 2048:
                     await message.answer("❌ Размеры должны быть от 64 до 2048. Попробуйте снова:")
-                    return
+                    return None
                     
             except (ValueError, IndexError):
                 await message.answer("❌ Неверный формат. Используйте 'ширинаxвысота'. Попробуйте снова:")
-                return
+                return None
         
         await state.update_data(width=width, height=height)
         
         # Получаем все сохраненные данные
         data = await state.get_data()
+        await state.clear()
         
         # Показываем итоговые параметры
         summary = f"""
@@ -136,51 +143,25 @@ class AdvancedFeatures:
 👣 Шаги: {data['steps']}
 ⚖️ CFG Scale: {data['cfg_scale']}
 📏 Размер: {data['width']}x{data['height']}
-
-Генерирую изображение...
         """
         
-        status_msg = await message.answer(summary)
-        
-        try:
-            # Генерируем изображение с кастомными параметрами
-            result = self.sd_client.txt2img(
-                prompt=data['prompt'],
-                negative_prompt=data.get('negative_prompt', ''),
-                steps=data['steps'],
-                cfg_scale=data['cfg_scale'],
-                width=data['width'],
-                height=data['height']
-            )
-            
-            if result and 'images' in result:
-                import base64
-                import io
-                
-                # Декодируем изображение
-                image_data = base64.b64decode(result['images'][0])
-                image_bytes = io.BytesIO(image_data)
-                
-                # Отправляем изображение
-                await message.bot.send_photo(
-                    chat_id=message.chat.id,
-                    photo=types.BufferedInputFile(image_bytes.getvalue(), filename="advanced_generated.png"),
-                    caption=f"🎨 Продвинутая генерация\n\n📝 Промпт: {data['prompt']}"
-                )
-                
-                await status_msg.delete()
-            else:
-                await status_msg.edit_text("❌ Ошибка при генерации изображения")
-                
-        except Exception as e:
-            await status_msg.edit_text(f"❌ Произошла ошибка: {str(e)}")
+        await message.answer(summary)
         
-        finally:
-            await state.clear()
+        # Промпт из продвинутой генерации отправляется как есть, без автоулучшения
+        return {
+            'prompt': data['prompt'],
+            'negative_prompt': data.get('negative_prompt', ''),
+            'steps': data['steps'],
+            'cfg_scale': data['cfg_scale'],
+            'width': data['width'],
+            'height': data['height'],
+            'enhance_prompt': False
+        }
     
     async def show_samplers(self, message: types.Message):
         """Показать доступные сэмплеры"""
-        samplers = [
+        # Список из WebUI, если он уже загружен, иначе — стандартный
+        samplers = await self.model_catalog.get_samplers() or [
             "Euler", "Euler a", "LMS", "Heun", "DPM2", "DPM2 a", "DPM++ 2S a",
             "DPM++ 2M", "DPM++ SDE", "DPM fast", "DPM adaptive", "LMS Karras",
             "DPM2 Karras", "DPM2 a Karras", "DPM++ 2S a Karras", "DPM++ 2M Karras",
@@ -196,7 +177,7 @@ class AdvancedFeatures:
     
     async def show_models(self, message: types.Message):
         """Показать доступные модели с подробной информацией"""
-        models = self.sd_client.get_models()
+        models = await self.model_catalog.get_models()
         if models:
             model_info = []
             for i, model in enumerate(models[:5], 1):  # Показываем первые 5
@@ -210,13 +191,13 @@ class AdvancedFeatures:
             
             await message.answer(
                 f"🤖 Доступные модели:\n\n{model_list}\n\n"
-                "Используйте команду /switch_model для смены модели"
+                "Используйте команду /switch_model, чтобы выбрать модель для своих генераций"
             )
         else:
             await message.answer("❌ Не удалось получить список моделей")
     
     async def switch_model(self, message: types.Message):
-        """Сменить модель"""
+        """Выбрать модель для генераций пользователя (модель WebUI для остальных не меняется)"""
         # Извлекаем название модели из сообщения
         text = message.text
         if text.startswith('/switch_model'):
@@ -229,12 +210,15 @@ class AdvancedFeatures:
                 )
                 return
             
-            status_msg = await message.answer(f"🔄 Переключаю модель на: {model_name}")
+            if await self.model_catalog.find_by_name(model_name) is None:
+                await message.answer(f"❌ Модель не найдена: {model_name}")
+                return
             
-            if self.sd_client.switch_model(model_name):
-                await status_msg.edit_text(f"✅ Модель успешно переключена на: {model_name}")
-            else:
-                await status_msg.edit_text(f"❌ Ошибка при переключении модели: {model_name}")
+            self.user_settings.set_model(message.from_user.id, model_name)
+            await message.answer(
+                f"✅ Модель выбрана: {model_name}\n\n"
+                "Она будет использоваться для ваших следующих генераций."
+            )
         else:
             await message.answer(
                 "❌ Неверный формат команды!\n\n"
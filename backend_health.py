@@ -0,0 +1,145 @@
+"""
+Фоновый мониторинг состояния Stable Diffusion WebUI
+
+Монитор периодически опрашивает легкий /sdapi/v1/progress и учитывает исходы
+всех запросов клиента в скользящем окне. Обработчики читают готовое состояние
+без обращения к сети, диспетчер очереди не запускает задачи, пока выключатель
+клиента разомкнут.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from enum import Enum
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from config import (SD_HEALTH_CHECK_INTERVAL, SD_HEALTH_WINDOW, SD_HEALTH_DEGRADED_LATENCY,
+                    SD_HEALTH_DEGRADED_ERROR_RATE)
+from circuit_breaker import BreakerState
+from sd_client import StableDiffusionClient
+
+class BackendState(Enum):
+    UP = "up"
+    DEGRADED = "degraded"
+    DOWN = "down"
+
+# Эндпоинт проверки: отвечает и во время генерации, не тянет изображение
+_PROBE_ENDPOINT = "/sdapi/v1/progress"
+
+class BackendHealthMonitor:
+    """Состояние бэкенда по окнам задержек проверок и доли ошибок запросов"""
+    
+    def __init__(self, sd_client: StableDiffusionClient,
+                 interval: float = SD_HEALTH_CHECK_INTERVAL,
+                 window: float = SD_HEALTH_WINDOW,
+                 degraded_latency: float = SD_HEALTH_DEGRADED_LATENCY,
+                 degraded_error_rate: float = SD_HEALTH_DEGRADED_ERROR_RATE):
+        self.sd_client = sd_client
+        self.interval = interval
+        self.window = window
+        self.degraded_latency = degraded_latency
+        self.degraded_error_rate = degraded_error_rate
+        # До первой проверки состояние неизвестно — считаем бэкенд доступным
+        self.state = BackendState.UP
+        self.last_check: Optional[float] = None
+        # (время, успех) всех запросов и (время, задержка) успешных проверок
+        self._outcomes: Deque[Tuple[float, bool]] = deque()
+        self._probe_latencies: Deque[Tuple[float, float]] = deque()
+        self._listeners: List[Callable[[], None]] = []
+        self._runner: Optional[asyncio.Task] = None
+        
+        sd_client.add_listener(self._on_request)
+        sd_client.breaker.add_listener(self._on_breaker_change)
+    
+    def add_listener(self, callback: Callable[[], None]):
+        """Подписывает callback на смену состояния бэкенда"""
+        if callback not in self._listeners:
+            self._listeners.append(callback)
+    
+    def remove_listener(self, callback: Callable[[], None]):
+        """Отписывает callback от смены состояния"""
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+    
+    def is_accepting(self) -> bool:
+        """Можно ли отправлять генерации (выключатель замкнут)"""
+        return self.sd_client.breaker.is_closed
+    
+    def _on_request(self, endpoint: str, latency: float, ok: bool):
+        now = time.monotonic()
+        self._outcomes.append((now, ok))
+        if ok and endpoint.startswith(_PROBE_ENDPOINT):
+            self._probe_latencies.append((now, latency))
+        self._update_state()
+    
+    def _on_breaker_change(self, state: BreakerState):
+        self._update_state()
+    
+    def _trim(self, now: float):
+        horizon = now - self.window
+        while self._outcomes and self._outcomes[0][0] < horizon:
+            self._outcomes.popleft()
+        while self._probe_latencies and self._probe_latencies[0][0] < horizon:
+            self._probe_latencies.popleft()
+    
+    def stats(self) -> Dict:
+        """Задержка проверок (медиана) и доля ошибок в окне"""
+        self._trim(time.monotonic())
+        latencies = sorted(latency for _, latency in self._probe_latencies)
+        errors = sum(1 for _, ok in self._outcomes if not ok)
+        return {
+            "state": self.state.value,
+            "breaker": self.sd_client.breaker.state.value,
+            "latency": latencies[len(latencies) // 2] if latencies else None,
+            "error_rate": errors / len(self._outcomes) if self._outcomes else 0.0,
+            "requests": len(self._outcomes),
+        }
+    
+    def _update_state(self):
+        stats = self.stats()
+        if not self.sd_client.breaker.is_closed:
+            state = BackendState.DOWN
+        elif stats["error_rate"] >= self.degraded_error_rate or (stats["latency"] or 0.0) >= self.degraded_latency:
+            state = BackendState.DEGRADED
+        else:
+            state = BackendState.UP
+        
+        if state is not self.state:
+            logging.warning(f"Состояние SD WebUI: {self.state.value} -> {state.value}")
+            self.state = state
+            for callback in self._listeners:
+                callback()
+    
+    async def check(self):
+        """Одна проверка: пробный запрос проходит через выключатель клиента"""
+        await self.sd_client.get_progress()
+        self.last_check = time.monotonic()
+        self._update_state()
+    
+    async def start(self):
+        """Запускает фоновые проверки"""
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.create_task(self._run(), name="backend-health")
+    
+    async def stop(self):
+        """Останавливает фоновые проверки"""
+        if self._runner is not None:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+    
+    async def _run(self):
+        while True:
+            try:
+                await self.check()
+            except Exception as e:
+                logging.error(f"Ошибка при проверке состояния SD WebUI: {e}")
+            # Пока выключатель разомкнут, проверяем сразу по истечении его таймаута
+            delay = self.interval
+            retry_after = self.sd_client.breaker.retry_after()
+            if retry_after > 0:
+                delay = min(delay, retry_after)
+            await asyncio.sleep(delay)
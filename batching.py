@@ -0,0 +1,67 @@
+"""
+Группировка совместимых задач в один пакетный запрос txt2img
+
+Задачи совместимы, если у них совпадают модель, размер, шаги, сэмплер, CFG Scale
+и негативный промпт. Тогда WebUI генерирует их одним запросом с batch_size > 1.
+Полностью одинаковые запросы не генерируются повторно: см. get_dedup_key.
+"""
+import json
+from typing import TYPE_CHECKING, Hashable, Optional
+
+from config import DEFAULT_MODEL, DEFAULT_PARAMS, SD_BATCH_PROMPT_LIST, QUEUE_DEDUP_RANDOM_SEED
+
+if TYPE_CHECKING:
+    from queue_manager import GenerationTask
+
+# Параметры, которые должны совпадать у всех задач пакета
+BATCH_KEY_PARAMS = ("model", "width", "height", "steps", "sampler_name", "cfg_scale", "negative_prompt", "enhance_prompt")
+
+# Задача без модели генерируется на DEFAULT_MODEL (см. StableDiffusionClient.txt2img)
+_KEY_DEFAULTS = {**DEFAULT_PARAMS, "model": DEFAULT_MODEL}
+
+def get_batch_key(task: "GenerationTask", prompt_list: bool = SD_BATCH_PROMPT_LIST) -> Optional[Hashable]:
+    """
+    Возвращает ключ совместимости задачи для пакетной генерации
+    
+    Args:
+        task (GenerationTask): Задача
+        prompt_list (bool): Поддерживает ли WebUI список промптов в одном запросе.
+            Без этого в один пакет попадают только задачи с одинаковым промптом
+    
+    Returns:
+        Optional[Hashable]: Ключ или None, если задачу нельзя объединять с другими
+    """
+    params = task.parameters or {}
+    
+    # Явный seed и собственный batch_size несовместимы с общим пакетом
+    if params.get("seed", -1) not in (-1, None) or params.get("batch_size", 1) != 1:
+        return None
+    
+    key = tuple(params.get(name, _KEY_DEFAULTS.get(name)) for name in BATCH_KEY_PARAMS)
+    if not prompt_list:
+        key += (task.prompt,)
+    return key
+
+def get_dedup_key(prompt: str, parameters: Optional[dict], random_seed: bool = QUEUE_DEDUP_RANDOM_SEED) -> Optional[Hashable]:
+    """
+    Возвращает ключ одинаковых запросов: такие запросы обслуживает одна генерация
+    
+    Args:
+        prompt (str): Исходный промпт
+        parameters (Optional[dict]): Параметры задачи
+        random_seed (bool): Объединять ли запросы со случайным seed (-1)
+    
+    Returns:
+        Optional[Hashable]: Ключ или None, если запрос нельзя объединять с другими
+    """
+    params = _KEY_DEFAULTS.copy()
+    params.update(parameters or {})
+    params["model"] = params["model"] or DEFAULT_MODEL
+    params.pop("prompt", None)
+    
+    if params.get("seed", -1) in (-1, None) and not random_seed:
+        return None
+    
+    # Лишние пробелы и переносы строк не меняют запрос
+    canonical_prompt = " ".join(prompt.split())
+    return canonical_prompt, json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
@@ -0,0 +1,122 @@
+"""
+Бенчмарк контроля допуска задач (admission.py)
+
+1. Перегрузка на симуляторе очереди (benchmarks.queue_sim, виртуальное
+   время): тяжелые пользователи засыпают очередь, затем всплеск от легких.
+   Без контроля допуска очередь растет до QUEUE_MAX_SIZE, с ним — тяжелым
+   отказывают корзина и лимиты пользователя, при прогнозе разбора очереди
+   выше max_drain_seconds отказывают всем; отклоненные повторяют запрос
+   через retry_after (--retries). Сравниваются ожидание легких и тяжелых
+   пользователей, отказы по причинам, загрузка GPU.
+2. Стоимость admit() и память на пользователя: --users пользователей по
+   задаче; после пополнения корзин записи простаивающих удаляются.
+
+Запуск: python -m benchmarks.bench_admission --duration 1800 --users 100000
+"""
+import argparse
+import json
+import os
+import time
+import tracemalloc
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARKbenchmarkBENCHMARKbench")
+
+from admission import AdmissionController, AdmissionRejected
+from benchmarks import queue_sim
+from config import ADMISSION_TIERS, DEFAULT_PARAMS, QUEUE_MAX_SIZE
+from queue_manager import GenerationStage, GenerationStatus, GenerationTask
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+    
+    def __call__(self) -> float:
+        return self.now
+
+
+def sim_args(args, admission: bool) -> argparse.Namespace:
+    return argparse.Namespace(
+        policies=[args.policy], model_affinity=False, dedup=True, max_queue_size=QUEUE_MAX_SIZE,
+        admission=admission, retries=args.retries, batch_max_size=4, batch_max_wait=0.5, gpus=args.gpus,
+        step_latency=0.05, per_image_step_latency=0.01, batch_overhead=0.2, model_load=10.0,
+        duration=args.duration, rate=args.rate, users=args.sim_users, heavy_users=args.heavy_users,
+        heavy_share=args.heavy_share, burst=[f"{args.duration / 2:.0f}:{args.burst}"], burst_spread=5.0,
+        sizes="512:0.6,768:0.3,1024:0.1", models="", steps=DEFAULT_PARAMS["steps"], prompt_pool=0, seed=1,
+        trace=[], load_factor=1.0, per_user=False, output="")
+
+
+def run_overload(args) -> list:
+    results = []
+    for admission in (False, True):
+        report = queue_sim.run(sim_args(args, admission))["results"][0]
+        results.append({
+            "admission": admission,
+            "tasks": report["tasks"],
+            "rejected": report["rejected"],
+            "rejected_by_reason": report["rejected_by_reason"],
+            "rejected_by_user_class": report["rejected_by_user_class"],
+            "retries": report["retries"],
+            "gpu_utilization": report["gpu_utilization"],
+            "wait": report["wait"],
+            "wait_by_user_class": report["wait_by_user_class"],
+        })
+    return results
+
+
+def run_memory(args) -> dict:
+    clock = FakeClock()
+    # Без сброса нагрузки: все --users задач ждут в очереди одновременно
+    controller = AdmissionController({"default": {**ADMISSION_TIERS["default"], "max_drain_seconds": 0}}, clock=clock)
+    params = {"steps": DEFAULT_PARAMS["steps"]}
+    tasks = [GenerationTask(f"t{user_id}", user_id, "prompt", GenerationStatus.QUEUED, GenerationStage.INITIALIZING,
+                            0.0, parameters=params) for user_id in range(args.users)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    for task in tasks:
+        controller.admit(task.user_id, params, 0, QUEUE_MAX_SIZE)
+        controller.track(task, queued=1)
+    admit_us = (time.perf_counter() - started) / len(tasks) * 1e6
+    active_bytes = (tracemalloc.get_traced_memory()[0] - before) / len(tasks)
+    active = len(controller._users)
+    
+    # Задачи выполнены, корзины пополнились: записи удаляются при следующих admit
+    for task in tasks:
+        controller.track(task, queued=-1)
+    clock.now += 3600
+    rejected = 0
+    for user_id in range(args.users, args.users + args.users // 2 + 1):
+        try:
+            controller.admit(user_id, params, 0, QUEUE_MAX_SIZE)
+        except AdmissionRejected:
+            rejected += 1
+    tracemalloc.stop()
+    return {
+        "users": args.users,
+        "admit_track_us": round(admit_us, 2),
+        "bytes_per_active_user": round(active_bytes),
+        "entries_active": active,
+        "entries_after_idle": len(controller._users),
+        "rejected": rejected,
+    }
+
+
+def main(args):
+    report = {"overload": run_overload(args), "memory": run_memory(args)}
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--policy", default="fifo", choices=list(queue_sim.POLICIES))
+    parser.add_argument("--duration", type=float, default=1800, help="секунд виртуального времени")
+    parser.add_argument("--rate", type=float, default=0.6, help="задач в секунду")
+    parser.add_argument("--sim-users", type=int, default=200)
+    parser.add_argument("--heavy-users", type=int, default=5)
+    parser.add_argument("--heavy-share", type=float, default=0.6)
+    parser.add_argument("--burst", type=int, default=300, help="задач во всплеске посередине")
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--gpus", type=int, default=1)
+    parser.add_argument("--users", type=int, default=100000, help="пользователей для замера памяти")
+    main(parser.parse_args())
@@ -0,0 +1,93 @@
+"""
+Бенчмарк пропускной способности пакетной генерации
+
+Заглушка WebUI моделирует стоимость пакета: фиксированные накладные расходы
+на запрос + шаги * (step_latency + per_image_step_latency * batch_size).
+Сравнивается число изображений в минуту и размеры собранных пакетов при разных
+BATCH_MAX_SIZE. Задачи поступают с интервалом --interval от 8 пользователей
+с --prompts разными промптами и случайным seed; по умолчанию настройки
+(SD_BATCH_PROMPT_LIST, BATCH_MAX_WAIT, QUEUE_DEDUP_RANDOM_SEED) берутся из config.
+
+Запуск: python -m benchmarks.bench_batching --tasks 32 --batch-sizes 1 4 8
+        python -m benchmarks.bench_batching --prompt-list --prompts 32
+"""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import time
+from collections import Counter
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARKbenchmarkBENCHMARKbench")
+# Задачи одного синтетического пользователя не должны упираться в его лимиты
+os.environ.setdefault("ADMISSION_CONTROL", "false")
+
+from config import BATCH_MAX_WAIT, SD_BATCH_PROMPT_LIST
+
+
+async def run(batch_size: int, args) -> dict:
+    from benchmarks.fake_webui import FakeWebUI
+    import bot_advanced
+    from batching import get_batch_key
+    from generation_dispatcher import GenerationDispatcher
+    from queue_manager import queue_manager
+    
+    webui = FakeWebUI(step_latency=args.step_latency, batch_overhead=args.batch_overhead,
+                      per_image_step_latency=args.per_image_step_latency, noise=False)
+    bot_advanced.sd_client.base_url = await webui.start()
+    
+    # Заглушка принимает и список промптов, поэтому --prompt-list объединяет разные промпты
+    queue_manager._batch_key = functools.partial(get_batch_key, prompt_list=args.prompt_list)
+    done = asyncio.Event()
+    finished = []
+    batch_sizes = Counter()
+    
+    async def process(tasks):
+        batch_sizes[len(tasks)] += 1
+        finished.extend(await bot_advanced.process_batch(tasks))
+        if len(finished) >= args.tasks:
+            done.set()
+    
+    dispatcher = GenerationDispatcher(queue_manager, process, max_batch_size=batch_size, max_wait=args.max_wait)
+    started = time.perf_counter()
+    await dispatcher.start()
+    for i in range(args.tasks):
+        queue_manager.add_task(user_id=i % 8, prompt=f"batch probe {i % args.prompts}", parameters={"steps": args.steps})
+        dispatcher.notify()
+        await asyncio.sleep(args.interval)
+    await done.wait()
+    elapsed = time.perf_counter() - started
+    await dispatcher.stop()
+    await bot_advanced.sd_client.close()
+    await webui.stop()
+    
+    assert all(finished)
+    return {
+        "batch_max_size": batch_size,
+        "requests": webui.requests,
+        "mean_batch": round(args.tasks / webui.requests, 2),
+        "batch_sizes": dict(sorted(batch_sizes.items())),
+        "elapsed_s": round(elapsed, 3),
+        "images_per_min": round(args.tasks / elapsed * 60, 1),
+    }
+
+
+async def main(args):
+    report = [await run(batch_size, args) for batch_size in args.batch_sizes]
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tasks", type=int, default=32)
+    parser.add_argument("--prompts", type=int, default=4, help="разных промптов среди задач")
+    parser.add_argument("--interval", type=float, default=0.05, help="секунд между поступлением задач")
+    parser.add_argument("--prompt-list", action=argparse.BooleanOptionalAction, default=SD_BATCH_PROMPT_LIST)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--step-latency", type=float, default=0.01)
+    parser.add_argument("--per-image-step-latency", type=float, default=0.003)
+    parser.add_argument("--batch-overhead", type=float, default=0.15)
+    parser.add_argument("--max-wait", type=float, default=BATCH_MAX_WAIT)
+    asyncio.run(main(parser.parse_args()))
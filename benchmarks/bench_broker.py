@@ -0,0 +1,289 @@
+"""
+Бенчмарк генерации через брокер и процессы worker.py (GENERATION_BACKEND=broker)
+
+Каждый SD WebUI (заглушка, по одной на "GPU") запускается отдельным процессом.
+Сравниваются:
+- local: пакеты выполняются в процессе бота (generation.generate_batch), как
+  при GENERATION_BACKEND=local — один WebUI;
+- broker: бот только ставит пакеты в брокер (BrokerClient), их выполняют
+  --workers процессов worker.py, каждый со своим WebUI.
+Измеряются пропускная способность и задержка event loop бота (декодирование
+base64 и запись изображений уходят в worker). Отдельно проверяется
+восстановление: worker убивается (SIGKILL) посреди пакета, пакет после
+истечения аренды выполняет другой worker. И перезапуск бота (очередь в
+SQLiteTaskStore) посреди генерации: пакет не отправляется заново, worker
+его не прерывает — и когда бот вернулся до конца генерации, и когда пакет
+завершился, пока бота не было (событие результата ждет в брокере).
+
+Запуск: python -m benchmarks.bench_broker --batches 24 --workers 1 2 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARKbenchmarkBENCHMARKbench")
+
+from benchmarks.bench_event_loop import LoopLagProbe
+from broker import BrokerClient, create_broker
+from generation import close_images, generate_batch
+from generation_dispatcher import GenerationDispatcher
+from queue_manager import GenerationStage, GenerationStatus, QueueManager
+from sd_client import StableDiffusionClient
+from task_store import SQLiteTaskStore
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def start_webui(args) -> tuple:
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.fake_webui", "--port", str(port), "--step-latency", str(args.step_latency),
+         "--batch-overhead", str(args.batch_overhead), "--per-image-step-latency", "0"],
+        cwd=ROOT, stdout=subprocess.DEVNULL
+    )
+    url = f"http://127.0.0.1:{port}"
+    client = StableDiffusionClient(url)
+    for _ in range(100):
+        if await client.is_available():
+            break
+        await asyncio.sleep(0.1)
+    await client.close()
+    return process, url
+
+
+def start_worker(url: str, broker_url: str, files_dir: str, lease_seconds: float) -> subprocess.Popen:
+    env = dict(os.environ, SD_WEBUI_URL=url, BROKER_URL=broker_url, BROKER_FILES_DIR=files_dir,
+               BROKER_LEASE_SECONDS=str(lease_seconds), BROKER_POLL_INTERVAL="0.05", SD_PROGRESS_POLL_INTERVAL="0.1")
+    return subprocess.Popen([sys.executable, "worker.py"], cwd=ROOT, env=env, stderr=subprocess.DEVNULL)
+
+
+def stop_processes(processes: list):
+    for process in processes:
+        if process.poll() is None:
+            process.send_signal(signal.SIGTERM)
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def batch_params(args) -> dict:
+    return {"steps": args.steps, "width": args.size, "height": args.size, "batch_size": args.batch_size}
+
+
+def ignore_progress(stage, progress, eta):
+    pass
+
+
+async def run_local(args) -> dict:
+    webui, url = await start_webui(args)
+    sd_client = StableDiffusionClient(url)
+    probe = LoopLagProbe()
+    probe.start()
+    started = time.perf_counter()
+    images = 0
+    try:
+        for _ in range(args.batches):
+            results, _ = await generate_batch(sd_client, "bench", batch_params(args), args.batch_size, ignore_progress)
+            images += len(results)
+            close_images(result["image"] for result in results)
+        elapsed = time.perf_counter() - started
+    finally:
+        lag = await probe.stop()
+        await sd_client.close()
+        stop_processes([webui])
+    return {"mode": "local", "images": images, "elapsed_s": round(elapsed, 2),
+            "images_per_min": round(images / elapsed * 60, 1), "bot_loop_lag": lag}
+
+
+async def run_broker(workers: int, args, tmp: str) -> dict:
+    broker_url = f"sqlite:///{tmp}/broker_{workers}.db"
+    files_dir = os.path.join(tmp, f"files_{workers}")
+    client = BrokerClient(create_broker(broker_url), poll_interval=0.05)
+    await client.start()
+    webuis = [await start_webui(args) for _ in range(workers)]
+    processes = [start_worker(url, broker_url, files_dir, args.lease_seconds) for _, url in webuis]
+    # Как queue_manager.max_active_batches = BROKER_MAX_ACTIVE_JOBS
+    active = asyncio.Semaphore(workers)
+    
+    async def one() -> int:
+        async with active:
+            results, _ = await client.generate("bench", batch_params(args), args.batch_size, ignore_progress)
+        for result in results:
+            result["image"].close()
+            os.remove(result["image_path"])
+        return len(results)
+    
+    # Прогрев: время запуска процессов worker не входит в замер
+    await asyncio.gather(*(one() for _ in range(workers)))
+    probe = LoopLagProbe()
+    probe.start()
+    started = time.perf_counter()
+    try:
+        images = sum(await asyncio.gather(*(one() for _ in range(args.batches))))
+        elapsed = time.perf_counter() - started
+    finally:
+        lag = await probe.stop()
+        stop_processes(processes)
+        stop_processes([process for process, _ in webuis])
+        await client.stop()
+    return {"mode": "broker", "workers": workers, "images": images, "elapsed_s": round(elapsed, 2),
+            "images_per_min": round(images / elapsed * 60, 1), "bot_loop_lag": lag,
+            "files_left": len(os.listdir(files_dir))}
+
+
+async def run_crash(args, tmp: str) -> dict:
+    """SIGKILL worker посреди пакета: пакет выполняет второй worker после истечения аренды"""
+    broker_url = f"sqlite:///{tmp}/broker_crash.db"
+    files_dir = os.path.join(tmp, "files_crash")
+    lease_seconds = 2.0
+    client = BrokerClient(create_broker(broker_url), poll_interval=0.05)
+    await client.start()
+    webui, url = await start_webui(args)
+    first = start_worker(url, broker_url, files_dir, lease_seconds)
+    started_progress = asyncio.Event()
+    
+    def on_progress(stage, progress, eta):
+        started_progress.set()
+    
+    job = asyncio.create_task(client.generate("bench", batch_params(args), args.batch_size, on_progress))
+    await asyncio.wait_for(started_progress.wait(), timeout=30)
+    first.kill()
+    killed_at = time.perf_counter()
+    second = start_worker(url, broker_url, files_dir, lease_seconds)
+    try:
+        results, _ = await asyncio.wait_for(job, timeout=60)
+        recovered_after = time.perf_counter() - killed_at
+        for result in results:
+            result["image"].close()
+            os.remove(result["image_path"])
+    finally:
+        stop_processes([second, webui])
+        await client.stop()
+    return {"lease_seconds": lease_seconds, "recovered": len(results) == args.batch_size,
+            "result_after_kill_s": round(recovered_after, 2)}
+
+
+class BotSide:
+    """Очередь, хранилище и диспетчер одного запуска бота; пакеты выполняются как в bot_advanced.process_batch"""
+    
+    def __init__(self, broker_url: str, store_path: str):
+        self.client = BrokerClient(create_broker(broker_url), poll_interval=0.05)
+        self.submits = 0
+        submit = self.client.broker.submit
+        
+        async def counting_submit(job_id, payload):
+            self.submits += 1
+            await submit(job_id, payload)
+        
+        self.client.broker.submit = counting_submit
+        self.manager = QueueManager(dedup_key=None)
+        self.restored = self.manager.open_store(SQLiteTaskStore(store_path, flush_interval=0.05), resume_jobs=True)
+        self.dispatcher = GenerationDispatcher(self.manager, self.process_batch, max_batch_size=1, max_wait=0)
+    
+    async def process_batch(self, tasks):
+        def on_progress(stage, progress, eta):
+            for task in tasks:
+                self.manager.update_task_progress(task.id, stage, progress, eta)
+        
+        job_id = self.manager.attach_job(tasks)
+        results, _ = await self.client.generate("bench", tasks[0].parameters, len(tasks), on_progress, job_id=job_id)
+        for task, result in zip(tasks, results or [None] * len(tasks)):
+            if result is None:
+                self.manager.fail_task(task.id, "error")
+                continue
+            result["image"].close()
+            os.remove(result["image_path"])
+            self.manager.complete_task(task.id, {})
+    
+    async def start(self):
+        resumed = self.manager.processing_batches()
+        await self.client.start(resume_jobs=[batch[0].job_id for batch in resumed.values()])
+        await self.dispatcher.start()
+        for batch in resumed.values():
+            self.dispatcher.resume(batch)
+    
+    async def stop(self):
+        self.client.detach()
+        await self.dispatcher.stop()
+        await self.client.stop()
+        self.manager.store.close()
+
+
+async def run_restart(args, tmp: str, downtime: float) -> dict:
+    """Бот останавливается посреди генерации и запускается снова через downtime секунд"""
+    broker_url = f"sqlite:///{tmp}/broker_restart_{downtime}.db"
+    store_path = os.path.join(tmp, f"queue_restart_{downtime}.db")
+    files_dir = os.path.join(tmp, f"files_restart_{downtime}")
+    webui, url = await start_webui(args)
+    worker = start_worker(url, broker_url, files_dir, args.lease_seconds)
+    steps = args.steps * 5
+    try:
+        bot = BotSide(broker_url, store_path)
+        await bot.start()
+        task = bot.manager.add_task(1, "restart", {"steps": steps, "width": args.size, "height": args.size}, chat_id=1)
+        started = time.perf_counter()
+        while task.stage != GenerationStage.GENERATING_IMAGE or task.progress < 20:
+            await asyncio.sleep(0.02)
+        await bot.stop()
+        stopped_at = time.perf_counter()
+        await asyncio.sleep(downtime)
+        
+        bot = BotSide(broker_url, store_path)
+        restored = bot.manager.get_task(task.id)
+        resumed_status = restored.status.value
+        await bot.start()
+        while restored.status not in (GenerationStatus.COMPLETED, GenerationStatus.FAILED):
+            await asyncio.sleep(0.02)
+        finished_at = time.perf_counter()
+        await bot.stop()
+        worker_alive = worker.poll() is None
+    finally:
+        stop_processes([worker, webui])
+    return {
+        "downtime_s": downtime,
+        "restored_status": resumed_status,
+        "status": restored.status.value,
+        "resubmitted": bot.submits,
+        "total_s": round(finished_at - started, 2),
+        "done_after_restart_s": round(finished_at - stopped_at - downtime, 2),
+        "worker_alive": worker_alive,
+        "files_left": len(os.listdir(files_dir)) if os.path.isdir(files_dir) else 0,
+    }
+
+
+async def main(args):
+    report = {"local": await run_local(args), "broker": []}
+    with tempfile.TemporaryDirectory() as tmp:
+        for workers in args.workers:
+            report["broker"].append(await run_broker(workers, args, tmp))
+        report["crash_recovery"] = await run_crash(args, tmp)
+        report["bot_restart"] = [await run_restart(args, tmp, downtime) for downtime in (0.2, args.steps * 5 * args.step_latency)]
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batches", type=int, default=24)
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--step-latency", type=float, default=0.02)
+    parser.add_argument("--batch-overhead", type=float, default=0.1)
+    parser.add_argument("--lease-seconds", type=float, default=5.0)
+    asyncio.run(main(parser.parse_args()))
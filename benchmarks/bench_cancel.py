@@ -0,0 +1,179 @@
+"""
+Бенчмарк отмены генерируемой задачи
+
+Долгая задача A генерируется на заглушке SD WebUI (в этом процессе), за ней
+в очереди короткая задача B; A отменяется посреди генерации
+(queue_manager.cancel_task, как кнопка «Отменить»). Пакеты обрабатывает
+process_batch_async бота (отправка в Telegram заменена подсчетом).
+Режимы:
+- local: генерация в процессе бота; interrupt — прерывание WebUI и
+  освобождение места после его подтверждения, no-interrupt — прежнее
+  поведение (место освобождается сразу, WebUI дорисовывает A);
+- broker: пакет выполняет GenerationWorker через SQLiteBroker.
+Измеряются: сколько GPU работал на A после отмены, когда началась и
+завершилась B, были ли доставлены результаты A. Отдельно — пакет из двух
+задач, одна из которых отменена: вторая доставляется, первая нет.
+
+Запуск: python -m benchmarks.bench_cancel --steps 150 --step-latency 0.02
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARKbenchmarkBENCHMARKbench")
+# Задачи одного синтетического пользователя не должны упираться в его лимиты
+os.environ.setdefault("ADMISSION_CONTROL", "false")
+
+import bot_advanced
+from benchmarks.fake_webui import FakeWebUI
+from broker import BrokerClient, create_broker
+from generation_dispatcher import GenerationDispatcher
+from queue_manager import GenerationStage, GenerationStatus, queue_manager
+from sd_client import StableDiffusionClient
+from worker import GenerationWorker
+
+
+class Deliveries:
+    """Замена отправки результатов и ошибок в Telegram"""
+    
+    def __init__(self):
+        self.results = []
+        self.errors = []
+    
+    async def send_result(self, task, result):
+        self.results.append(task.id)
+    
+    async def send_error(self, task, error):
+        self.errors.append(task.id)
+    
+    async def skip(self, *args):
+        pass
+
+
+async def wait_for(condition, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("Условие бенчмарка не выполнено")
+        await asyncio.sleep(0.005)
+
+
+def params(steps: int) -> dict:
+    # Без улучшения промпта и с фиксированным seed: задачи не объединяются кэшами
+    return {"steps": steps, "width": 512, "height": 512, "seed": 1, "enhance_prompt": False}
+
+
+async def run_cancel(mode: str, interrupt: bool, webui: FakeWebUI, url: str, args, tmp: str) -> dict:
+    deliveries = Deliveries()
+    bot_advanced.send_generation_result = deliveries.send_result
+    bot_advanced.send_generation_error = deliveries.send_error
+    bot_advanced.cache_generation_result = deliveries.skip
+    bot_advanced.prepare_result = deliveries.skip
+    bot_advanced.sd_client.base_url = url
+    webui.jobs.clear()
+    
+    worker = worker_runner = None
+    if mode == "broker":
+        broker_url = f"sqlite:///{os.path.join(tmp, f'broker-{time.monotonic_ns()}.db')}"
+        bot_advanced.broker_client = BrokerClient(create_broker(broker_url), poll_interval=args.poll_interval)
+        await bot_advanced.broker_client.start()
+        worker = GenerationWorker(create_broker(broker_url), StableDiffusionClient(url), files_dir=tmp,
+                                  lease_seconds=args.lease_seconds, poll_interval=args.poll_interval)
+        worker_runner = asyncio.create_task(worker.run())
+    else:
+        bot_advanced.broker_client = None
+    
+    dispatcher = GenerationDispatcher(queue_manager, bot_advanced.process_batch_async, max_batch_size=1, max_wait=0)
+    await dispatcher.start()
+    if not interrupt:
+        # Прежнее поведение: место освобождается при отмене, генерация не прерывается
+        queue_manager.remove_cancel_listener(dispatcher.interrupt)
+    try:
+        task_a = queue_manager.add_task(1, f"long {mode} {interrupt}", params(args.steps), chat_id=1)
+        await wait_for(lambda: task_a.stage == GenerationStage.GENERATING_IMAGE and task_a.progress >= 50)
+        task_b = queue_manager.add_task(2, f"short {mode} {interrupt}", params(args.short_steps), chat_id=2)
+        cancelled_at, cancelled_mono = time.time(), time.monotonic()
+        queue_manager.cancel_task(task_a.id, chat_id=1)
+        await wait_for(lambda: task_b.status == GenerationStatus.COMPLETED and len(webui.jobs) >= 2)
+        await asyncio.sleep(0.2)
+    finally:
+        await dispatcher.stop()
+        if worker is not None:
+            worker.stop()
+            await worker_runner
+            await bot_advanced.broker_client.stop()
+    
+    job_a = next(job for job in webui.jobs if job["prompt"].startswith("long"))
+    job_b = next(job for job in webui.jobs if job["prompt"].startswith("short"))
+    return {
+        "mode": mode,
+        "interrupt": interrupt,
+        "gpu_after_cancel_s": round(job_a["finished"] - cancelled_mono, 3),
+        "backend_interrupted": job_a["interrupted"],
+        "next_task_queue_start_s": round(task_b.started_at - cancelled_at, 3),
+        "next_task_gpu_start_s": round(job_b["started"] - cancelled_mono, 3),
+        "next_task_done_s": round(task_b.completed_at - cancelled_at, 3),
+        # Время, когда B числилась генерируемой, а GPU еще занимала A
+        "overlap_s": round(max(0.0, job_a["finished"] - cancelled_mono - (task_b.started_at - cancelled_at)), 3),
+        "cancelled_delivered": deliveries.results.count(task_a.id) + deliveries.errors.count(task_a.id),
+        "cancelled_status": task_a.status.value,
+    }
+
+
+async def run_partial(webui: FakeWebUI, url: str, args) -> dict:
+    """Пакет из двух задач, одна отменена во время генерации: GPU дорисовывает пакет для второй"""
+    deliveries = Deliveries()
+    bot_advanced.send_generation_result = deliveries.send_result
+    bot_advanced.send_generation_error = deliveries.send_error
+    bot_advanced.broker_client = None
+    webui.jobs.clear()
+    # Одинаковый промпт со случайным seed — одна пакетная генерация двух задач, а не одна задача на двоих
+    dedup_key, queue_manager._dedup_key = queue_manager._dedup_key, None
+    batch_params = {**params(args.short_steps * 2), "seed": -1}
+    dispatcher = GenerationDispatcher(queue_manager, bot_advanced.process_batch_async, max_batch_size=2, max_wait=0.5)
+    await dispatcher.start()
+    try:
+        first = queue_manager.add_task(1, "partial batch", dict(batch_params), chat_id=1)
+        second = queue_manager.add_task(2, "partial batch", dict(batch_params), chat_id=2)
+        await wait_for(lambda: first.stage == GenerationStage.GENERATING_IMAGE)
+        queue_manager.cancel_task(first.id, chat_id=1)
+        await wait_for(lambda: second.status == GenerationStatus.COMPLETED)
+        await asyncio.sleep(0.1)
+    finally:
+        await dispatcher.stop()
+        queue_manager._dedup_key = dedup_key
+    return {
+        "batch_jobs": len(webui.jobs),
+        "backend_interrupted": any(job["interrupted"] for job in webui.jobs),
+        "cancelled_delivered": deliveries.results.count(first.id) + deliveries.errors.count(first.id),
+        "kept_delivered": deliveries.results.count(second.id),
+    }
+
+
+async def main(args):
+    webui = FakeWebUI(step_latency=args.step_latency, batch_overhead=0.05)
+    url = await webui.start()
+    queue_manager.max_completed_tasks = 1000
+    report = {"cancel": [], "partial_batch": None}
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for mode, interrupt in (("local", False), ("local", True), ("broker", True)):
+                report["cancel"].append(await run_cancel(mode, interrupt, webui, url, args, tmp))
+            report["partial_batch"] = await run_partial(webui, url, args)
+    finally:
+        await bot_advanced.sd_client.close()
+        await webui.stop()
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--steps", type=int, default=150, help="шагов отменяемой задачи")
+    parser.add_argument("--short-steps", type=int, default=20)
+    parser.add_argument("--step-latency", type=float, default=0.02)
+    parser.add_argument("--poll-interval", type=float, default=0.1, help="опрос брокера")
+    parser.add_argument("--lease-seconds", type=float, default=30)
+    asyncio.run(main(parser.parse_args()))
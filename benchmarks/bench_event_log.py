@@ -0,0 +1,202 @@
+"""
+Бенчмарк журнала событий (event_log)
+
+- время, которое log_user_message занимает на event loop: прежняя запись
+  через logging.basicConfig (строка с datetime.now() и repr, синхронная
+  запись) и EventLog (запись в фоновом потоке); запись замедляется на
+  --write-delay-ms, как при нагруженном диске или stdout;
+- задержка event loop при потоке сообщений (--rate в секунду);
+- цикл задач QueueManager: одна запись на переход, согласованное
+  прореживание task_stage и ротация файла журнала.
+
+Запуск: python -m benchmarks.bench_event_log --messages 2000 --write-delay-ms 1
+"""
+import argparse
+import asyncio
+import glob
+import json
+import logging
+import os
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARKbenchmarkBENCHMARKbench")
+
+from aiogram import types
+
+import event_log
+import queue_manager as queue_module
+from benchmarks.bench_event_loop import LoopLagProbe
+from bot_advanced import log_user_message
+from event_log import EventLog
+from queue_manager import GenerationStage, QueueManager
+
+
+def legacy_log_user_message(message: types.Message):
+    """log_user_message до журнала событий"""
+    user = message.from_user
+    log_msg = (
+        f"[USER MSG] {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} | "
+        f"user_id={user.id} | username={user.username or 'None'} | first_name={user.first_name or 'None'} | "
+        f"text={repr(message.text)}"
+    )
+    logging.info(log_msg)
+
+
+class SlowFileHandler(RotatingFileHandler):
+    """Файл журнала на медленном диске"""
+    
+    delay_s = 0.0
+    
+    def emit(self, record):
+        time.sleep(self.delay_s)
+        super().emit(record)
+
+
+class SlowStream:
+    def __init__(self, path: str, delay_s: float):
+        self.file = open(path, "a", encoding="utf-8")
+        self.delay_s = delay_s
+    
+    def write(self, data: str):
+        time.sleep(self.delay_s)
+        self.file.write(data)
+    
+    def flush(self):
+        self.file.flush()
+
+
+def make_message(i: int) -> types.Message:
+    return types.Message.model_validate({
+        "message_id": i,
+        "date": int(time.time()),
+        "chat": {"id": 1000 + i % 50, "type": "private"},
+        "from": {"id": 1000 + i % 50, "is_bot": False, "first_name": "Bench", "username": f"user{i % 50}"},
+        "text": f"a cat in a hat, highly detailed, {i}",
+    })
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def run_messages(log, messages: list, rate: float) -> dict:
+    """Сообщения с частотой rate; время вызова и задержка event loop"""
+    calls = []
+    probe = LoopLagProbe()
+    probe.start()
+    started = time.perf_counter()
+    for i, message in enumerate(messages):
+        call_started = time.perf_counter()
+        log(message)
+        calls.append(time.perf_counter() - call_started)
+        await asyncio.sleep(max(0.0, started + (i + 1) / rate - time.perf_counter()))
+    lag = await probe.stop()
+    return {"call_p50_us": round(percentile(calls, 0.5) * 1e6, 1), "call_p99_us": round(percentile(calls, 0.99) * 1e6, 1),
+            "loop_lag": lag}
+
+
+def reset_root():
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+
+
+async def bench_messages(args, tmp: str) -> dict:
+    messages = [make_message(i) for i in range(args.messages)]
+    delay = args.write_delay_ms / 1000
+    report = {}
+    
+    reset_root()
+    logging.basicConfig(level=logging.INFO, stream=SlowStream(os.path.join(tmp, "legacy.log"), delay))
+    report["basicConfig"] = await run_messages(legacy_log_user_message, messages, args.rate)
+    reset_root()
+    
+    SlowFileHandler.delay_s = delay
+    event_log.RotatingFileHandler = SlowFileHandler
+    log = EventLog(os.path.join(tmp, "events.jsonl"), queue_size=args.queue_size)
+    event_log.events = log
+    # log_user_message пишет в глобальный журнал бота
+    import bot_advanced
+    bot_advanced.events = log
+    log.start()
+    report["event_log"] = await run_messages(log_user_message, messages, args.rate)
+    drain_started = time.perf_counter()
+    log.stop()
+    report["event_log"].update({
+        "drain_after_s": round(time.perf_counter() - drain_started, 2),
+        "written": sum(1 for _ in open(os.path.join(tmp, "events.jsonl"), encoding="utf-8")),
+        "dropped": log.dropped,
+    })
+    event_log.RotatingFileHandler = RotatingFileHandler
+    reset_root()
+    return report
+
+
+def run_task_cycle(tasks: int) -> float:
+    manager = QueueManager(max_queue_size=tasks + 1)
+    stages = (GenerationStage.INITIALIZING, GenerationStage.GENERATING_IMAGE, GenerationStage.FINALIZING)
+    started = time.perf_counter()
+    for i in range(tasks):
+        task = manager.add_task(i % 100, f"prompt {i}", {"seed": i}, chat_id=i % 100)
+        manager.start_batch(1)
+        for stage in stages:
+            manager.update_task_progress(task.id, stage, 50)
+        if i % 10 == 9:
+            manager.fail_task(task.id, "bench")
+        else:
+            manager.complete_task(task.id, {"seed": i})
+    return (time.perf_counter() - started) / tasks * 1e6
+
+
+def bench_tasks(args, tmp: str) -> dict:
+    path = os.path.join(tmp, "tasks.jsonl")
+    log = EventLog(path, max_mb=args.rotate_kb / 1024, backup_count=100,
+                   sample_rates={"task_stage": args.stage_rate}, queue_size=10 ** 6)
+    queue_module.events = log
+    # До start() emit ничего не делает
+    without_events = run_task_cycle(args.tasks)
+    log.start()
+    with_events = run_task_cycle(args.tasks)
+    log.stop()
+    reset_root()
+    queue_module.events = event_log.events
+    
+    records = []
+    for name in sorted(glob.glob(path + "*")):
+        with open(name, encoding="utf-8") as f:
+            records.extend(json.loads(line) for line in f)
+    events = Counter(record["event"] for record in records)
+    stage_tasks = Counter(record["task_id"] for record in records if record["event"] == "task_stage")
+    return {
+        "task_cycle_us": {"without_events": round(without_events, 2), "with_events": round(with_events, 2)},
+        "events": dict(events),
+        # Две смены этапа на задачу: у попавшей в выборку задачи записаны обе
+        "sampled_tasks": {"kept": len(stage_tasks), "complete": sum(1 for n in stage_tasks.values() if n == 2),
+                          "expected_share": args.stage_rate, "share": round(len(stage_tasks) / args.tasks, 3)},
+        "files": len(glob.glob(path + "*")),
+        "sampled_out": log.sampled_out,
+    }
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        report = {"messages": await bench_messages(args, tmp), "tasks": bench_tasks(args, tmp)}
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=500, help="сообщений в секунду")
+    parser.add_argument("--write-delay-ms", type=float, default=1.0)
+    parser.add_argument("--queue-size", type=int, default=10000)
+    parser.add_argument("--tasks", type=int, default=5000)
+    parser.add_argument("--stage-rate", type=float, default=0.1)
+    parser.add_argument("--rotate-kb", type=float, default=256)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,126 @@
+"""
+Бенчмарк отзывчивости event loop при параллельных генерациях
+
+Сравнивает блокирующие запросы на event loop (как было раньше) с асинхронным
+StableDiffusionClient. Отзывчивость измеряется задержкой таймера-пробы:
+насколько позже запланированного просыпается asyncio.sleep(interval).
+
+Запуск: python -m benchmarks.bench_event_loop --concurrency 8
+"""
+import argparse
+import asyncio
+import json
+import time
+import urllib.request
+
+from benchmarks.fake_webui import FakeWebUI
+from sd_client import StableDiffusionClient
+
+
+class LoopLagProbe:
+    """Измеряет задержку event loop с помощью периодического таймера"""
+    
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+    
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(time.perf_counter() - started - self.interval)
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self) -> dict:
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        lags = sorted(self.lags) or [0.0]
+        return {
+            "samples": len(lags),
+            "p50_ms": round(lags[len(lags) // 2] * 1000, 2),
+            "p99_ms": round(lags[min(len(lags) - 1, int(len(lags) * 0.99))] * 1000, 2),
+            "max_ms": round(lags[-1] * 1000, 2),
+        }
+
+
+def blocking_txt2img(base_url: str, payload: dict) -> dict:
+    """Старое поведение: блокирующий запрос с новым соединением на каждый вызов"""
+    request = urllib.request.Request(
+        f"{base_url}/sdapi/v1/txt2img",
+        data=json.dumps(payload).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request, timeout=300) as response:
+        return json.loads(response.read())
+
+
+async def run_blocking(base_url: str, concurrency: int, steps: int) -> dict:
+    probe = LoopLagProbe()
+    probe.start()
+    started = time.perf_counter()
+    
+    async def one():
+        # Вызов прямо на event loop, как делали обработчики до перехода на async клиент
+        blocking_txt2img(base_url, {"prompt": "bench", "steps": steps, "width": 64, "height": 64})
+        await asyncio.sleep(0)
+    
+    await asyncio.gather(*(one() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {"mode": "blocking", "elapsed_s": round(elapsed, 3), "loop_lag": await probe.stop()}
+
+
+async def run_async(base_url: str, concurrency: int, steps: int) -> dict:
+    client = StableDiffusionClient(base_url)
+    probe = LoopLagProbe()
+    probe.start()
+    started = time.perf_counter()
+    results = await asyncio.gather(*(
+        client.txt2img("bench", steps=steps, width=64, height=64) for _ in range(concurrency)
+    ))
+    # Параллельно с генерациями обработчики продолжают обслуживать быстрые запросы
+    models = await client.get_models()
+    elapsed = time.perf_counter() - started
+    await client.close()
+    assert all(results) and models
+    return {"mode": "async", "elapsed_s": round(elapsed, 3), "loop_lag": await probe.stop()}
+
+
+async def main(args):
+    # Эмулировать блокирующий клиент в одном потоке с сервером нельзя, поэтому
+    # заглушка WebUI работает в отдельном потоке со своим event loop
+    import threading
+    webui = FakeWebUI(step_latency=args.step_latency, batch_overhead=0.0, noise=False)
+    ready = threading.Event()
+    holder = {}
+    
+    def serve():
+        loop = asyncio.new_event_loop()
+        holder["loop"] = loop
+        holder["url"] = loop.run_until_complete(webui.start())
+        ready.set()
+        loop.run_forever()
+    
+    threading.Thread(target=serve, daemon=True).start()
+    ready.wait()
+    base_url = holder["url"]
+    
+    report = [
+        await run_blocking(base_url, args.concurrency, args.steps),
+        await run_async(base_url, args.concurrency, args.steps),
+    ]
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    holder["loop"].call_soon_threadsafe(holder["loop"].stop)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--step-latency", type=float, default=0.01)
+    asyncio.run(main(parser.parse_args()))
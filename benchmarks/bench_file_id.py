@@ -0,0 +1,98 @@
+"""
+Бенчмарк повторных отправок изображения по file_id
+
+Один результат генерации доставляется нескольким подписчикам задачи, затем
+тот же запрос несколько раз отдается из кэша результатов — через функции
+bot_advanced и заглушку Bot API с ограниченной скоростью загрузки:
+- upload: кэш file_id выключен, каждая отправка загружает файл (прежний путь);
+- file_id: загрузка только первая, дальше — по file_id.
+Отдельно проверяется откат: заглушка «забывает» file_id, бот загружает заново.
+
+Запуск: python -m benchmarks.bench_file_id --subscribers 4 --hits 8 --uplink-mbit 20
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARKbenchmarkBENCHMARKbench")
+# Задачи одного синтетического пользователя не должны упираться в его лимиты
+os.environ.setdefault("ADMISSION_CONTROL", "false")
+os.environ["RESULT_CACHE_DIR"] = tempfile.mkdtemp(prefix="bench-file-id-")
+os.environ["FILE_ID_DB_PATH"] = ""
+
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+import bot_advanced
+from benchmarks.bench_postprocess import make_test_png
+from benchmarks.fake_bot_api import FakeBotAPI
+from file_id_cache import FileIdCache
+
+
+async def deliver(chat_ids, png: bytes, cache_key: str, cached: bool) -> float:
+    """Доставляет результат во все чаты и возвращает время доставки"""
+    started = time.perf_counter()
+    if cached:
+        result = await bot_advanced.result_cache.get(cache_key)
+    else:
+        result = {"image": io.BytesIO(png), "seed": 42}
+    try:
+        await bot_advanced.prepare_result(result)
+        for chat_id in chat_ids:
+            await bot_advanced.deliver_image(chat_id, "bench cat", {"seed": 42}, result)
+        if not cached:
+            await bot_advanced.result_cache.put(cache_key, result["image"], {"seed": 42})
+    finally:
+        bot_advanced.release_result_image(result)
+    return time.perf_counter() - started
+
+
+async def run_mode(mode: str, png: bytes, args) -> dict:
+    api = FakeBotAPI(chat_interval=0, global_rate=1000, upload_bandwidth=args.uplink_mbit * 1024 * 1024 / 8)
+    url = await api.start()
+    bot_advanced.bot.session = AiohttpSession(api=TelegramAPIServer.from_base(url))
+    # max_entries=0 — каждый file_id сразу вытесняется, т.е. кэш выключен
+    bot_advanced.file_id_cache = FileIdCache(None, max_entries=0 if mode == "upload" else 100)
+    cache_key = f"bench-{mode}"
+    
+    fresh = await deliver(range(1, args.subscribers + 1), png, cache_key, cached=False)
+    hits = [await deliver([100 + i], png, cache_key, cached=True) for i in range(args.hits)]
+    # Telegram больше не принимает сохраненные file_id — откат на загрузку
+    api.file_ids.clear()
+    rejected = await deliver([999], png, cache_key, cached=True)
+    
+    deliveries = args.subscribers + args.hits + 1
+    report = {
+        "mode": mode,
+        "uploads": api.uploads,
+        "upload_kb_per_delivery": round(api.bytes_received / deliveries / 1024, 1),
+        "fresh_s": round(fresh, 3),
+        "cache_hit_p50_s": round(sorted(hits)[len(hits) // 2], 3),
+        "after_reject_s": round(rejected, 3),
+        "rejected_file_ids": api.responses["bad_file_id"],
+    }
+    await bot_advanced.bot.session.close()
+    await api.stop()
+    return report
+
+
+async def main(args):
+    png = make_test_png(args.size, 0)
+    await bot_advanced.image_postprocessor.start()
+    bot_advanced.result_cache.load()
+    reports = [await run_mode(mode, png, args) for mode in ("upload", "file_id")]
+    await bot_advanced.image_postprocessor.stop()
+    print(json.dumps(reports, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--subscribers", type=int, default=4, help="чатов, ожидающих одну задачу")
+    parser.add_argument("--hits", type=int, default=8, help="повторных запросов из кэша результатов")
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--uplink-mbit", type=float, default=20.0, help="скорость загрузки в Telegram, Мбит/с")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,138 @@
+"""
+Бенчмарк хранилища состояний FSM (fsm_storage.SQLiteStorage)
+
+Имитирует шаги мастера персонажа: get_state + update_data + set_state на
+каждое сообщение для --users пользователей. Сравниваются:
+- memory: aiogram MemoryStorage (прежнее поведение, теряется при перезапуске);
+- sqlite: SQLiteStorage с фоновой пакетной записью;
+- write-through: запись в SQLite с фиксацией на каждое изменение (для сравнения).
+Отдельно проверяются восстановление сессий после перезапуска, время загрузки
+и то, что завершенные (state.clear()) и истекшие сессии не
+остаются в памяти.
+
+Запуск: python -m benchmarks.bench_fsm_storage --users 2000 --steps 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARKbenchmarkBENCHMARKbench")
+
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from fsm_storage import SQLiteStorage
+from sqlite_store import connect_sqlite
+
+
+class WriteThroughStorage(BaseStorage):
+    """Наивная реализация: каждое изменение — отдельная транзакция SQLite"""
+    
+    def __init__(self, path: str):
+        self.conn = connect_sqlite(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS fsm (key TEXT PRIMARY KEY, state TEXT, data TEXT)")
+    
+    def _row(self, key: StorageKey):
+        return self.conn.execute("SELECT state, data FROM fsm WHERE key = ?", (str(key),)).fetchone() or (None, "{}")
+    
+    async def set_state(self, key, state=None):
+        state = getattr(state, "state", state)
+        self.conn.execute("INSERT INTO fsm (key, state, data) VALUES (?, ?, '{}') "
+                          "ON CONFLICT(key) DO UPDATE SET state = excluded.state", (str(key), state))
+    
+    async def get_state(self, key):
+        return self._row(key)[0]
+    
+    async def set_data(self, key, data):
+        self.conn.execute("INSERT INTO fsm (key, state, data) VALUES (?, NULL, ?) "
+                          "ON CONFLICT(key) DO UPDATE SET data = excluded.data", (str(key), json.dumps(data)))
+    
+    async def get_data(self, key):
+        return json.loads(self._row(key)[1])
+    
+    async def close(self):
+        self.conn.close()
+
+
+def make_key(user: int) -> StorageKey:
+    return StorageKey(bot_id=1, chat_id=user, user_id=user)
+
+
+async def run_wizard(storage: BaseStorage, args) -> dict:
+    """Шаги мастера для всех пользователей; возвращает задержку шага"""
+    timings = []
+    for step in range(args.steps):
+        for user in range(args.users):
+            key = make_key(user)
+            started = time.perf_counter()
+            await storage.get_state(key)
+            await storage.update_data(key, {f"field_{step}": f"value {step} for user {user}"})
+            await storage.set_state(key, f"GenerationStates:step_{step + 1}")
+            timings.append(time.perf_counter() - started)
+    timings.sort()
+    return {
+        "steps": len(timings),
+        "step_p50_us": round(timings[len(timings) // 2] * 1e6, 1),
+        "step_p99_us": round(timings[int(len(timings) * 0.99)] * 1e6, 1),
+        "total_s": round(sum(timings), 3),
+    }
+
+
+async def main(args):
+    report = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = MemoryStorage()
+        report["memory"] = await run_wizard(memory, args)
+        
+        write_through = WriteThroughStorage(os.path.join(tmp, "write_through.db"))
+        report["write_through"] = await run_wizard(write_through, args)
+        await write_through.close()
+        
+        path = os.path.join(tmp, "fsm.db")
+        storage = SQLiteStorage(path)
+        storage.load()
+        report["sqlite"] = await run_wizard(storage, args)
+        # Половина пользователей завершила мастер
+        for user in range(0, args.users, 2):
+            await storage.set_state(make_key(user), None)
+            await storage.set_data(make_key(user), {})
+            await memory.set_state(make_key(user), None)
+            await memory.set_data(make_key(user), {})
+        await storage.close()
+        
+        started = time.perf_counter()
+        restarted = SQLiteStorage(path)
+        restarted.load()
+        load_ms = (time.perf_counter() - started) * 1000
+        restored = 0
+        for user in range(args.users):
+            key = make_key(user)
+            if (await restarted.get_state(key) == f"GenerationStates:step_{args.steps}"
+                    and len(await restarted.get_data(key)) == args.steps):
+                restored += 1
+        report["restart"] = {
+            "expected_sessions": args.users // 2,
+            "restored_sessions": restored,
+            "load_ms": round(load_ms, 1),
+            "sessions_in_memory": {"memory_storage": len(memory.storage), "sqlite": len(restarted._sessions)},
+        }
+        await restarted.close()
+        
+        expiring = SQLiteStorage(path, ttl_hours=0.5 / 3600)
+        expiring.load()
+        await asyncio.sleep(1)
+        await expiring.set_state(make_key(-1), "GenerationStates:step_1")
+        # Остается только новая сессия
+        report["expiry"] = {"loaded_sessions": args.users // 2, "sessions_after_ttl": len(expiring._sessions)}
+        await expiring.close()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--steps", type=int, default=10)
+    asyncio.run(main(parser.parse_args()))
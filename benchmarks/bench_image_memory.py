@@ -0,0 +1,126 @@
+"""
+Бенчмарк пиковой памяти при получении изображений от SD WebUI
+
+Сравнивает прирост пикового RSS процесса на одно изображение:
+- json: весь ответ через response.json(), base64.b64decode, BufferedInputFile
+  (прежний путь);
+- stream: потоковый разбор sd_client.txt2img (image_stream) и SpooledInputFile.
+Каждый режим выполняется в отдельном процессе, заглушка WebUI — тоже, чтобы ее
+кэш PNG не попадал в замер. "Загрузка" в Telegram эмулируется чтением InputFile.
+
+Запуск: python -m benchmarks.bench_image_memory --size 2048 --batch 2
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARKbenchmarkBENCHMARKbench")
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss в Linux — килобайты
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def upload(input_file) -> int:
+    size = 0
+    async for chunk in input_file.read(None):
+        size += len(chunk)
+    return size
+
+
+async def run_json(base_url: str, payload: dict) -> list:
+    import base64
+    import aiohttp
+    from aiogram.types import BufferedInputFile
+    
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"{base_url}/sdapi/v1/txt2img", json=payload) as response:
+            result = await response.json()
+    images = [base64.b64decode(image) for image in result["images"]]
+    return [await upload(BufferedInputFile(image, filename="generated.png")) for image in images]
+
+
+async def run_stream(base_url: str, payload: dict) -> list:
+    from sd_client import StableDiffusionClient
+    from image_stream import SpooledInputFile
+    
+    client = StableDiffusionClient(base_url)
+    result = await client.txt2img(payload.pop("prompt"), **payload)
+    await client.close()
+    sizes = [await upload(SpooledInputFile(image, filename="generated.png")) for image in result["images"]]
+    for image in result["images"]:
+        image.close()
+    return sizes
+
+
+async def measure(args):
+    payload = {"prompt": "memory probe", "steps": 1, "width": args.size, "height": args.size, "batch_size": args.batch}
+    run = run_json if args.mode == "json" else run_stream
+    # Прогрев: импорты и первое соединение не должны попадать в прирост
+    await run(args.url, {**payload, "width": 64, "height": 64, "batch_size": 1})
+    baseline = peak_rss_mb()
+    started = time.perf_counter()
+    sizes = await run(args.url, payload)
+    elapsed = time.perf_counter() - started
+    print(json.dumps({
+        "mode": args.mode,
+        "image_mb": round(sizes[0] / (1024 * 1024), 2),
+        "peak_rss_delta_mb_per_image": round((peak_rss_mb() - baseline) / len(sizes), 2),
+        "seconds": round(elapsed, 3),
+    }))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def main(args):
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.fake_webui", "--port", str(port),
+         "--step-latency", "0", "--batch-overhead", "0", "--per-image-step-latency", "0"],
+        stdout=subprocess.DEVNULL
+    )
+    try:
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        reports = []
+        for mode in ("json", "stream"):
+            output = subprocess.check_output(
+                [sys.executable, "-m", "benchmarks.bench_image_memory", "--child", "--mode", mode, "--url", url,
+                 "--size", str(args.size), "--batch", str(args.batch)]
+            )
+            reports.append(json.loads(output.decode().strip().splitlines()[-1]))
+        print(json.dumps(reports, indent=2))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=2048, help="сторона изображения, px")
+    parser.add_argument("--batch", type=int, default=2)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--mode", choices=("json", "stream"), default="stream", help=argparse.SUPPRESS)
+    parser.add_argument("--url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        asyncio.run(measure(args))
+    else:
+        main(args)
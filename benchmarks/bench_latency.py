@@ -0,0 +1,64 @@
+"""
+Бенчмарк задержки queue-to-result
+
+Проверяет, что время от постановки задачи в очередь до готового результата
+равно времени работы бэкенда плюс небольшая константа: пайплайн не добавляет
+искусственных пауз на критическом пути.
+
+Запуск: python -m benchmarks.bench_latency --tasks 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARKbenchmarkBENCHMARKbench")
+# Задачи одного синтетического пользователя не должны упираться в его лимиты
+os.environ.setdefault("ADMISSION_CONTROL", "false")
+
+
+async def main(args):
+    from benchmarks.fake_webui import FakeWebUI
+    import bot_advanced
+    from queue_manager import queue_manager
+    
+    webui = FakeWebUI(step_latency=args.step_latency, batch_overhead=args.batch_overhead, noise=False)
+    bot_advanced.sd_client.base_url = await webui.start()
+    
+    overheads = []
+    for i in range(args.tasks):
+        task = queue_manager.add_task(user_id=1, prompt=f"latency probe {i}", parameters={"steps": args.steps})
+        enqueued = time.perf_counter()
+        started = queue_manager.start_processing()
+        assert started is task
+        result = await bot_advanced.process_task(task)
+        total = time.perf_counter() - enqueued
+        assert result and result.get("image")
+        overheads.append(total - webui.durations[-1])
+    
+    await bot_advanced.sd_client.close()
+    await webui.stop()
+    
+    overheads.sort()
+    report = {
+        "tasks": args.tasks,
+        "backend_s": round(sum(webui.durations) / len(webui.durations), 4),
+        "overhead_ms": {
+            "p50": round(overheads[len(overheads) // 2] * 1000, 2),
+            "max": round(overheads[-1] * 1000, 2),
+        },
+    }
+    print(json.dumps(report, indent=2))
+    if overheads[-1] > args.max_overhead:
+        raise SystemExit(f"Накладные расходы {overheads[-1]:.3f} с превышают {args.max_overhead} с")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tasks", type=int, default=5)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--step-latency", type=float, default=0.02)
+    parser.add_argument("--batch-overhead", type=float, default=0.1)
+    parser.add_argument("--max-overhead", type=float, default=0.1)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,112 @@
+"""
+Бенчмарк обновлений сообщений статуса при лимитах Telegram
+
+Несколько чатов одновременно обновляют прогресс своих задач раз в progress-interval
+секунд, затем получают результат. Сравниваются прямые вызовы edit_message_text
+(как раньше в мониторинге прогресса) и MessageUpdater: число вызовов Bot API,
+ответов 429 и "message is not modified", а также задержка доставки результата.
+
+Запуск: python -m benchmarks.bench_message_updater --chats 20 --duration 6
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramRetryAfter
+
+from benchmarks.fake_bot_api import FakeBotAPI
+from message_updater import MessageUpdater, Priority
+
+TOKEN = "123456:BENCHMARKbenchmarkBENCHMARKbench"
+
+
+def progress_text(step: int) -> str:
+    # Прогресс растет рывками: часть соседних обновлений совпадает по тексту
+    return f"🎨 Генерация изображения...\n⏳ Прогресс: {step // 2 * 10}%"
+
+
+async def retry(factory):
+    while True:
+        try:
+            return await factory()
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+
+
+async def run_chat(bot: Bot, chat_id: int, args, updater=None) -> float:
+    """Прогресс одного чата; возвращает задержку доставки результата после готовности"""
+    send_status = lambda: bot.send_message(chat_id=chat_id, text="📋 Задача добавлена в очередь")
+    status = await (retry(send_status) if updater is None else updater.call(chat_id, send_status, Priority.STATUS))
+    steps = int(args.duration / args.progress_interval)
+    for step in range(steps):
+        await asyncio.sleep(args.progress_interval)
+        text = progress_text(step)
+        if updater is None:
+            try:
+                await bot.edit_message_text(chat_id=chat_id, message_id=status.message_id, text=text)
+            except Exception:
+                pass
+        else:
+            updater.edit_text(chat_id, status.message_id, text, parse_mode=None)
+    
+    ready = time.perf_counter()
+    if updater is None:
+        # Без планировщика после 429 вызовы приходится повторять вручную
+        await retry(lambda: bot.send_message(chat_id=chat_id, text="✅ Результат"))
+        delay = time.perf_counter() - ready
+        await retry(lambda: bot.delete_message(chat_id=chat_id, message_id=status.message_id))
+        return delay
+    await updater.call(chat_id, lambda: bot.send_message(chat_id=chat_id, text="✅ Результат"))
+    updater.delete_message(chat_id, status.message_id, priority=Priority.STATUS)
+    return time.perf_counter() - ready
+
+
+async def run_mode(mode: str, args) -> dict:
+    api = FakeBotAPI(chat_interval=args.chat_interval, global_rate=args.global_rate)
+    url = await api.start()
+    bot = Bot(token=TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(url)))
+    updater = None
+    if mode == "updater":
+        updater = MessageUpdater(bot, global_rate=args.global_rate * 0.8, chat_interval=args.chat_interval)
+        await updater.start()
+    
+    delays = await asyncio.gather(*(run_chat(bot, chat_id, args, updater) for chat_id in range(1, args.chats + 1)))
+    if updater is not None:
+        await updater.stop()
+    await bot.session.close()
+    await api.stop()
+    
+    delays = sorted(delays)
+    report = {
+        "api_calls": sum(api.calls.values()),
+        "edits": api.calls["editMessageText"],
+        "429": api.responses["429"],
+        "not_modified": api.responses["not_modified"],
+        "result_delay_s": {"p50": round(delays[len(delays) // 2], 3), "max": round(delays[-1], 3)},
+    }
+    if updater is not None:
+        report["updater"] = updater.stats
+    return report
+
+
+async def main(args):
+    report = {mode: await run_mode(mode, args) for mode in ("direct", "updater")}
+    print(json.dumps(report, indent=2))
+    if not args.no_assert:
+        assert report["updater"]["429"] <= report["direct"]["429"]
+        assert report["updater"]["not_modified"] == 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=6.0)
+    parser.add_argument("--progress-interval", type=float, default=0.5)
+    parser.add_argument("--chat-interval", type=float, default=1.0)
+    parser.add_argument("--global-rate", type=float, default=30.0)
+    parser.add_argument("--no-assert", action="store_true")
+    asyncio.run(main(parser.parse_args()))
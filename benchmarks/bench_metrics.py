@@ -0,0 +1,151 @@
+"""
+Бенчмарк метрик Prometheus (metrics)
+
+- стоимость обновления счетчика и гистограммы на горячем пути;
+- цикл задачи в QueueManager (добавление, запуск, этапы, завершение) с
+  метриками и с отключенными метриками;
+- вызовы Bot API через TelegramMetricsMiddleware к заглушке Telegram:
+  накладные расходы middleware и сверка счетчиков 429 и загруженных байтов
+  с тем, что приняла заглушка;
+- время ответа /metrics (MetricsServer).
+
+Запуск: python -m benchmarks.bench_metrics --tasks 20000 --calls 300
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+import timeit
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARKbenchmarkBENCHMARKbench")
+
+import aiohttp
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import BufferedInputFile
+
+import metrics
+import queue_manager as queue_module
+from benchmarks.fake_bot_api import FakeBotAPI
+from queue_manager import GenerationStage, QueueManager
+
+
+class NoMetric:
+    def inc(self, *args, **kwargs):
+        pass
+    
+    def observe(self, *args, **kwargs):
+        pass
+
+
+def bench_primitives() -> dict:
+    counter = metrics.Counter("bench_total", "bench", ("method",))
+    histogram = metrics.Histogram("bench_seconds", "bench", ("method",))
+    number = 100000
+    return {
+        "counter_inc_ns": round(timeit.timeit(lambda: counter.inc("sendPhoto"), number=number) / number * 1e9),
+        "histogram_observe_ns": round(timeit.timeit(lambda: histogram.observe(0.123, "sendPhoto"), number=number)
+                                      / number * 1e9),
+    }
+
+
+def run_queue_cycle(tasks: int) -> float:
+    manager = QueueManager(max_queue_size=tasks + 1)
+    started = time.perf_counter()
+    for i in range(tasks):
+        manager.add_task(i % 100, f"prompt {i}", {"seed": i}, chat_id=i % 100)
+        task = manager.start_batch(1)[0]
+        for stage in (GenerationStage.INITIALIZING, GenerationStage.GENERATING_IMAGE, GenerationStage.FINALIZING):
+            manager.update_task_progress(task.id, stage, 50)
+        manager.complete_task(task.id, {"seed": i})
+    return (time.perf_counter() - started) / tasks
+
+
+def bench_queue(tasks: int, rounds: int = 3) -> dict:
+    original = queue_module.metrics
+    disabled = type("Disabled", (), {name: NoMetric() for name in (
+        "queue_wait_seconds", "stage_seconds", "generation_seconds")})
+    run_queue_cycle(tasks)
+    # Чередуем режимы и берем лучший результат: шум сборщика мусора больше измеряемой разницы
+    with_metrics = without_metrics = float("inf")
+    try:
+        for _ in range(rounds):
+            queue_module.metrics = original
+            with_metrics = min(with_metrics, run_queue_cycle(tasks))
+            queue_module.metrics = disabled
+            without_metrics = min(without_metrics, run_queue_cycle(tasks))
+    finally:
+        queue_module.metrics = original
+    return {
+        "task_cycle_us": {"with_metrics": round(with_metrics * 1e6, 2), "without_metrics": round(without_metrics * 1e6, 2)},
+        "overhead_us": round((with_metrics - without_metrics) * 1e6, 2),
+    }
+
+
+async def send_photos(bot: Bot, calls: int) -> dict:
+    photo = os.urandom(64 * 1024)
+    latencies, retry_after = [], 0
+    for i in range(calls):
+        started = time.perf_counter()
+        try:
+            await bot.send_photo(chat_id=1 + i % 10, photo=BufferedInputFile(photo, filename="bench.jpg"))
+        except TelegramRetryAfter:
+            retry_after += 1
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    return {"p50_ms": round(latencies[len(latencies) // 2] * 1000, 3), "retry_after": retry_after}
+
+
+async def bench_telegram(calls: int) -> dict:
+    # Лимиты заглушки дают часть ответов 429
+    fake = FakeBotAPI(chat_interval=0.0, global_rate=200.0)
+    url = await fake.start()
+    report = {}
+    # Первый проход — прогрев соединений и заглушки
+    for mode in ("warmup", "plain", "middleware"):
+        bot = Bot(os.environ["BOT_TOKEN"], session=AiohttpSession(api=TelegramAPIServer.from_base(url)))
+        if mode == "middleware":
+            bot.session.middleware(metrics.TelegramMetricsMiddleware())
+            fake.bytes_received = 0
+            fake.responses.clear()
+        report[mode] = await send_photos(bot, calls)
+        await bot.session.close()
+    await fake.stop()
+    del report["warmup"]
+    report["check"] = {
+        "retry_after": {"server": fake.responses["429"], "metric": metrics.telegram_retry_after.value("sendPhoto")},
+        "requests": {"client": calls, "metric": metrics.telegram_request_seconds.count("sendPhoto")},
+        # Метрика считает только содержимое файлов, заглушка — все поля формы
+        "upload_bytes": {"server": fake.bytes_received, "metric": int(metrics.telegram_upload_bytes.value("sendPhoto"))},
+    }
+    return report
+
+
+async def bench_scrape() -> dict:
+    server = metrics.MetricsServer(port=0)
+    await server.start()
+    async with aiohttp.ClientSession() as session:
+        started = time.perf_counter()
+        async with session.get(f"http://127.0.0.1:{server.port}/metrics") as response:
+            body = await response.text()
+            content_type = response.headers["Content-Type"]
+        elapsed = time.perf_counter() - started
+    await server.stop()
+    samples = [line for line in body.splitlines() if line and not line.startswith("#")]
+    return {"scrape_ms": round(elapsed * 1000, 2), "samples": len(samples), "bytes": len(body), "content_type": content_type}
+
+
+async def main(args):
+    report = {"primitives": bench_primitives(), "queue": bench_queue(args.tasks),
+              "telegram": await bench_telegram(args.calls), "scrape": await bench_scrape()}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tasks", type=int, default=20000)
+    parser.add_argument("--calls", type=int, default=300)
+    asyncio.run(main(parser.parse_args()))
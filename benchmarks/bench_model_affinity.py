@@ -0,0 +1,75 @@
+"""
+Бенчмарк планирования с учетом модели (model affinity)
+
+Пользователи вперемешку отправляют задачи на двух чекпоинтах. Заглушка WebUI
+тратит model_load_latency на каждую смену чекпоинта. Сравнивается число
+загрузок модели и общее время без группировки по модели и с ней.
+
+Запуск: python -m benchmarks.bench_model_affinity --tasks 24
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARKbenchmarkBENCHMARKbench")
+
+
+async def run(model_affinity: bool, args) -> dict:
+    from benchmarks.fake_webui import FakeWebUI
+    import bot_advanced
+    from queue_manager import QueueManager
+    from scheduling import create_policy
+    
+    webui = FakeWebUI(step_latency=args.step_latency, batch_overhead=args.batch_overhead,
+                      model_load_latency=args.model_load_latency, noise=False)
+    bot_advanced.sd_client.base_url = await webui.start()
+    bot_advanced.sd_client.current_model = None
+    
+    manager = QueueManager(policy=create_policy("round_robin", model_affinity=model_affinity), dedup_key=None)
+    bot_advanced.queue_manager = manager
+    
+    rng = random.Random(7)
+    for i in range(args.tasks):
+        model = rng.choice(["model_a", "model_b"])
+        manager.add_task(user_id=i % 6, prompt=f"affinity probe {i}", parameters={"steps": args.steps, "model": model})
+    
+    started = time.perf_counter()
+    while True:
+        task = manager.start_processing()
+        if task is None:
+            break
+        await bot_advanced.process_task(task)
+    elapsed = time.perf_counter() - started
+    
+    await bot_advanced.sd_client.close()
+    await webui.stop()
+    return {
+        "policy": manager.policy.name,
+        "model_loads": webui.model_loads,
+        "elapsed_s": round(elapsed, 3),
+    }
+
+
+async def main(args):
+    import bot_advanced
+    original = bot_advanced.queue_manager
+    report = []
+    try:
+        for model_affinity in (False, True):
+            report.append(await run(model_affinity, args))
+    finally:
+        bot_advanced.queue_manager = original
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tasks", type=int, default=24)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--step-latency", type=float, default=0.005)
+    parser.add_argument("--batch-overhead", type=float, default=0.02)
+    parser.add_argument("--model-load-latency", type=float, default=0.5)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,105 @@
+"""
+Бенчмарк постобработки изображений перед отправкой
+
+Пакет изображений одновременно доставляется в Telegram (заглушка
+benchmarks/fake_bot_api.py с ограниченной скоростью загрузки):
+- raw: PNG как есть (прежнее поведение);
+- thread: перекодирование в потоке бота (IMAGE_POSTPROCESS_WORKERS=0);
+- pool: перекодирование в пуле процессов.
+Сравниваются загруженные байты на изображение, задержка от готовности
+результата до ответа sendPhoto и максимальная задержка event loop.
+
+Запуск: python -m benchmarks.bench_postprocess --images 8 --size 1024 --uplink-mbit 20
+"""
+import argparse
+import asyncio
+import io
+import json
+import time
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import BufferedInputFile
+from PIL import Image, ImageFilter, PngImagePlugin
+
+from benchmarks.fake_bot_api import FakeBotAPI
+from image_postprocess import ImagePostprocessor
+
+TOKEN = "123456:BENCHMARKbenchmarkBENCHMARKbench"
+
+
+def make_test_png(size: int, index: int) -> bytes:
+    """Гладкое изображение с мелкой текстурой — сжимается примерно как результаты SD"""
+    fractal = Image.effect_mandelbrot((size, size), (-2.0 + index * 0.01, -1.5, 1.0, 1.5), 64)
+    noise = Image.effect_noise((size, size), 32).filter(ImageFilter.GaussianBlur(1))
+    image = Image.merge("RGB", (fractal, noise, Image.linear_gradient("L").resize((size, size))))
+    info = PngImagePlugin.PngInfo()
+    info.add_text("parameters", "bench prompt, Steps: 20, Sampler: Euler a, CFG scale: 7, Seed: 42")
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG", pnginfo=info)
+    return buffer.getvalue()
+
+
+async def measure_lag(stop: asyncio.Event, lags: list):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.005)
+        lags.append(time.perf_counter() - started - 0.005)
+
+
+async def deliver(bot: Bot, chat_id: int, png: bytes, postprocessor) -> float:
+    started = time.perf_counter()
+    if postprocessor is None:
+        photo = BufferedInputFile(png, filename="generated.png")
+    else:
+        prepared = await postprocessor.prepare(io.BytesIO(png))
+        photo = BufferedInputFile(prepared.photo, filename=prepared.photo_filename)
+    await bot.send_photo(chat_id=chat_id, photo=photo)
+    return time.perf_counter() - started
+
+
+async def run_mode(mode: str, pngs: list, args) -> dict:
+    api = FakeBotAPI(chat_interval=0, global_rate=1000, upload_bandwidth=args.uplink_mbit * 1024 * 1024 / 8)
+    url = await api.start()
+    bot = Bot(token=TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(url)))
+    postprocessor = None
+    if mode != "raw":
+        postprocessor = ImagePostprocessor(workers=args.workers if mode == "pool" else 0)
+        await postprocessor.start()
+    
+    stop, lags = asyncio.Event(), []
+    lag_task = asyncio.create_task(measure_lag(stop, lags))
+    latencies = await asyncio.gather(*(deliver(bot, chat_id, png, postprocessor)
+                                       for chat_id, png in enumerate(pngs, start=1)))
+    stop.set()
+    await lag_task
+    
+    if postprocessor is not None:
+        await postprocessor.stop()
+    await bot.session.close()
+    await api.stop()
+    
+    latencies.sort()
+    return {
+        "mode": mode,
+        "upload_kb_per_image": round(api.bytes_received / len(pngs) / 1024, 1),
+        "latency_s": {"p50": round(latencies[len(latencies) // 2], 3), "max": round(latencies[-1], 3)},
+        "max_loop_lag_ms": round(max(lags) * 1000, 1),
+    }
+
+
+async def main(args):
+    pngs = [make_test_png(args.size, i) for i in range(args.images)]
+    print(f"PNG: {sum(map(len, pngs)) / len(pngs) / 1024:.0f} КБ в среднем")
+    reports = [await run_mode(mode, pngs, args) for mode in ("raw", "thread", "pool")]
+    print(json.dumps(reports, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--images", type=int, default=8)
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--uplink-mbit", type=float, default=20.0, help="скорость загрузки в Telegram, Мбит/с")
+    parser.add_argument("--workers", type=int, default=2)
+    asyncio.run(main(parser.parse_args()))
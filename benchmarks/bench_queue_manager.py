@@ -0,0 +1,130 @@
+"""
+Микробенчмарк QueueManager: старая реализация на списках против индексированной
+
+Для каждого размера очереди (по умолчанию 10, 1k, 50k) измеряет среднее время
+операций и стоимость одного «тика» обновления статусов, когда monitor_task_progress
+запрашивает позицию для каждой ожидающей задачи.
+
+Запуск: python -m benchmarks.bench_queue_manager --sizes 10 1000 50000
+"""
+import argparse
+import json
+import random
+import time
+
+from queue_manager import QueueManager, GenerationTask, GenerationStatus, GenerationStage
+
+
+class LegacyQueueManager:
+    """Прежняя реализация QueueManager (линейные списки), оставлена для сравнения"""
+    
+    def __init__(self):
+        self.queue = []
+        self.processing = None
+        self.completed_tasks = []
+        self.task_counter = 0
+        self.max_completed_tasks = 100
+    
+    def add_task(self, user_id, prompt, parameters=None):
+        self.task_counter += 1
+        task = GenerationTask(
+            id=f"task_{self.task_counter}_{int(time.time())}", user_id=user_id, prompt=prompt,
+            status=GenerationStatus.QUEUED, stage=GenerationStage.INITIALIZING,
+            created_at=time.time(), parameters=parameters or {},
+        )
+        self.queue.append(task)
+        return task
+    
+    def get_queue_position(self, task_id):
+        for i, task in enumerate(self.queue):
+            if task.id == task_id:
+                return i + 1
+        return -1
+    
+    def start_processing(self):
+        if self.processing is not None or not self.queue:
+            return None
+        task = self.queue.pop(0)
+        task.status = GenerationStatus.PROCESSING
+        self.processing = task
+        return task
+    
+    def complete_task(self, task_id, result):
+        if self.processing and self.processing.id == task_id:
+            self.processing.status = GenerationStatus.COMPLETED
+            self.completed_tasks.append(self.processing)
+            if len(self.completed_tasks) > self.max_completed_tasks:
+                self.completed_tasks.pop(0)
+            self.processing = None
+    
+    def cancel_task(self, task_id):
+        for i, task in enumerate(self.queue):
+            if task.id == task_id:
+                task.status = GenerationStatus.CANCELLED
+                self.queue.pop(i)
+                return True
+        return False
+    
+    def get_user_tasks(self, user_id):
+        tasks = [task for task in self.queue if task.user_id == user_id]
+        if self.processing and self.processing.user_id == user_id:
+            tasks.append(self.processing)
+        tasks.extend(task for task in self.completed_tasks if task.user_id == user_id)
+        return tasks
+
+
+def _timeit(func, items) -> float:
+    """Среднее время вызова func(item) в микросекундах"""
+    started = time.perf_counter()
+    for item in items:
+        func(item)
+    return (time.perf_counter() - started) / max(1, len(items)) * 1e6
+
+
+def bench(factory, size: int, samples: int, users: int) -> dict:
+    rng = random.Random(42)
+    manager = factory()
+    
+    started = time.perf_counter()
+    tasks = [manager.add_task(rng.randrange(users), "prompt") for _ in range(size)]
+    add_us = (time.perf_counter() - started) / size * 1e6
+    
+    sample = [task.id for task in rng.sample(tasks, min(samples, size))]
+    position_us = _timeit(manager.get_queue_position, sample)
+    user_tasks_us = _timeit(manager.get_user_tasks, [rng.randrange(users) for _ in range(samples)])
+    
+    def process_one(_):
+        task = manager.start_processing()
+        manager.complete_task(task.id, {})
+    
+    drain = min(samples, size // 4 or 1)
+    dequeue_us = _timeit(process_one, range(drain))
+    
+    remaining = [task_id for task_id in sample if manager.get_queue_position(task_id) > 0]
+    cancel_us = _timeit(manager.cancel_task, remaining[:samples // 2 or 1])
+    
+    return {
+        "add_us": round(add_us, 2),
+        "position_us": round(position_us, 2),
+        "user_tasks_us": round(user_tasks_us, 2),
+        "dequeue_complete_us": round(dequeue_us, 2),
+        "cancel_us": round(cancel_us, 2),
+        # Тик monitor_task_progress: позиция для каждой ожидающей задачи
+        "status_tick_ms": round(position_us * size / 1000, 3),
+    }
+
+
+def main(args):
+    report = []
+    for size in args.sizes:
+        for name, factory in (("legacy", LegacyQueueManager), ("indexed", lambda: QueueManager(max_queue_size=size, dedup_key=None))):
+            report.append({"impl": name, "size": size, **bench(factory, size, args.samples, args.users)})
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 50000])
+    parser.add_argument("--samples", type=int, default=500)
+    parser.add_argument("--users", type=int, default=200)
+    main(parser.parse_args())
@@ -0,0 +1,147 @@
+"""
+Бенчмарк приема обновлений через webhook (webhook_server)
+
+Синтетические обновления с сообщениями отправляются на локальный сервер
+webhook с тем же числом одновременных соединений, что у Telegram
+(max_connections). Обработчик имитирует работу (--handler-ms). Измеряются:
+- ack: время ответа на POST (Telegram ждет его перед следующей доставкой);
+- update->handler: от отправки обновления до входа в обработчик;
+- максимум одновременно работающих обработчиков (ограничение --max-concurrent).
+Отдельно проверяются отказ при неверном секрете, 503 при переполнении и
+эндпоинты /healthz и /readyz.
+
+Запуск: python -m benchmarks.bench_webhook --updates 2000 --connections 40 --handler-ms 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARKbenchmarkBENCHMARKbench")
+
+import aiohttp
+from aiogram import Bot, Dispatcher, types
+
+from webhook_server import WebhookServer
+
+SECRET = "bench-secret"
+
+
+def make_update(update_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": 1000 + update_id % 50, "type": "private"},
+            "from": {"id": 1000 + update_id % 50, "is_bot": False, "first_name": "Bench"},
+            "text": str(update_id),
+        },
+    }
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def run_load(args) -> dict:
+    dp = Dispatcher()
+    sent_at, handled_at = {}, {}
+    active = {"now": 0, "max": 0}
+    all_handled = asyncio.Event()
+    
+    @dp.message()
+    async def on_message(message: types.Message):
+        handled_at[int(message.text)] = time.perf_counter()
+        active["now"] += 1
+        active["max"] = max(active["max"], active["now"])
+        await asyncio.sleep(args.handler_ms / 1000)
+        active["now"] -= 1
+        if len(handled_at) == args.updates:
+            all_handled.set()
+    
+    server = WebhookServer(dp, Bot(os.environ["BOT_TOKEN"]), url="", secret_token=SECRET, host="127.0.0.1", port=0,
+                           max_concurrent=args.max_concurrent, max_pending=args.updates)
+    await server.start()
+    base = f"http://127.0.0.1:{server.port}"
+    acks = []
+    queue = asyncio.Queue()
+    for update_id in range(args.updates):
+        queue.put_nowait(update_id)
+    
+    async def connection(session: aiohttp.ClientSession):
+        # Как Telegram: следующее обновление по соединению — после ответа на предыдущее
+        while not queue.empty():
+            update_id = queue.get_nowait()
+            sent_at[update_id] = started = time.perf_counter()
+            async with session.post(f"{base}/webhook", json=make_update(update_id),
+                                    headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}) as response:
+                assert response.status == 200, response.status
+            acks.append(time.perf_counter() - started)
+    
+    async with aiohttp.ClientSession() as session:
+        started = time.perf_counter()
+        await asyncio.gather(*(connection(session) for _ in range(args.connections)))
+        await asyncio.wait_for(all_handled.wait(), timeout=120)
+        elapsed = time.perf_counter() - started
+        async with session.get(f"{base}/readyz") as response:
+            ready = await response.json()
+    await server.stop()
+    
+    delays = [handled_at[update_id] - sent_at[update_id] for update_id in handled_at]
+    return {
+        "updates": args.updates,
+        "throughput_per_s": round(args.updates / elapsed, 1),
+        "ack_ms": {"p50": round(percentile(acks, 0.5) * 1000, 2), "p99": round(percentile(acks, 0.99) * 1000, 2)},
+        "update_to_handler_ms": {"p50": round(percentile(delays, 0.5) * 1000, 2),
+                                 "p99": round(percentile(delays, 0.99) * 1000, 2)},
+        "max_concurrent_handlers": active["max"],
+        "readyz": ready,
+    }
+
+
+async def run_checks() -> dict:
+    """Неверный секрет, переполнение и эндпоинты здоровья"""
+    dp = Dispatcher()
+    release = asyncio.Event()
+    
+    @dp.message()
+    async def on_message(message: types.Message):
+        await release.wait()
+    
+    server = WebhookServer(dp, Bot(os.environ["BOT_TOKEN"]), url="", secret_token=SECRET, host="127.0.0.1", port=0,
+                           max_concurrent=1, max_pending=2)
+    await server.start()
+    base = f"http://127.0.0.1:{server.port}"
+    statuses = {}
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"{base}/webhook", json=make_update(1),
+                                headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}) as response:
+            statuses["wrong_secret"] = response.status
+        codes = []
+        for update_id in range(3):
+            async with session.post(f"{base}/webhook", json=make_update(update_id),
+                                    headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}) as response:
+                codes.append(response.status)
+        statuses["overload"] = codes
+        for endpoint in ("healthz", "readyz"):
+            async with session.get(f"{base}/{endpoint}") as response:
+                statuses[endpoint] = response.status
+    release.set()
+    await server.stop()
+    return statuses
+
+
+async def main(args):
+    print(json.dumps({"load": await run_load(args), "checks": await run_checks()}, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--connections", type=int, default=40, help="одновременных соединений (max_connections Telegram)")
+    parser.add_argument("--handler-ms", type=float, default=20.0, help="время работы обработчика, мс")
+    parser.add_argument("--max-concurrent", type=int, default=64)
+    asyncio.run(main(parser.parse_args()))
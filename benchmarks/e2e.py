@@ -0,0 +1,297 @@
+"""
+Сквозной бенчмарк бота без GPU и без Telegram
+
+Запускает заглушки отдельными процессами — SD WebUI (benchmarks.fake_webui)
+и Telegram Bot API (benchmarks.fake_bot_api, с лимитами и 429) — и
+bot_advanced в этом процессе с SD_WEBUI_URL и TELEGRAM_API_URL на них.
+Синтетические пользователи отправляют обновления через диспетчер aiogram
+(dp.feed_update), как при long polling:
+- text: сообщение с промптом (handle_text_message);
+- advanced: продвинутая генерация (промпт, негатив, шаги, CFG, размер);
+- wizard: простая пошаговая генерация персонажа (10 шагов).
+Между шагами пользователь «думает» --think-ms, после результата начинает
+следующий раунд.
+
+Отчет в JSON (stdout и --output) для сравнения между версиями: ожидание в
+очереди, сквозная задержка от последнего шага пользователя до доставки фото
+(p50/p95/p99), изображения в минуту, задержка event loop бота, вызовы и 429
+заглушки Bot API.
+
+Запуск: python -m benchmarks.e2e --users 20 --rounds 2 --output e2e.json
+"""
+import argparse
+import asyncio
+import itertools
+from collections import Counter
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WIZARD_ANSWERS = ("fox", "male", "red", "hoodie", "sitting", "happy", "forest", "reading", "2")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+def summary(values: list) -> dict:
+    return {"count": len(values), "p50_s": round(percentile(values, 0.5), 3), "p95_s": round(percentile(values, 0.95), 3),
+            "p99_s": round(percentile(values, 0.99), 3), "max_s": round(max(values, default=0.0), 3)}
+
+
+def parse_mix(value: str) -> dict:
+    mix = {}
+    for item in value.split(","):
+        name, weight = item.split("=")
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+def git_version() -> str:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+async def wait_ready(url: str):
+    async with aiohttp.ClientSession() as session:
+        for _ in range(100):
+            try:
+                async with session.get(url) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"Заглушка {url} не запустилась")
+
+
+def start_stubs(args) -> tuple:
+    webui_port, api_port = free_port(), free_port()
+    webui = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.fake_webui", "--port", str(webui_port),
+         "--step-latency", str(args.step_latency), "--batch-overhead", str(args.batch_overhead),
+         "--per-image-step-latency", str(args.per_image_step_latency), "--image-size", str(args.image_size),
+         "--unique-images"],
+        cwd=ROOT, stdout=subprocess.DEVNULL
+    )
+    api = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.fake_bot_api", "--port", str(api_port),
+         "--chat-interval", str(args.chat_interval), "--global-rate", str(args.global_rate),
+         "--latency", str(args.api_latency), "--uplink-mbit", str(args.uplink_mbit),
+         "--retry-after-rate", str(args.retry_after_rate)],
+        cwd=ROOT, stdout=subprocess.DEVNULL
+    )
+    return webui, f"http://127.0.0.1:{webui_port}", api, f"http://127.0.0.1:{api_port}"
+
+
+def configure_bot(webui_url: str, api_url: str, tmp: str):
+    """Окружение бота до импорта bot_advanced: заглушки и данные во временном каталоге"""
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARKbenchmarkBENCHMARKbench")
+    # Замеряется пропускная способность, а не отказы в допуске; ADMISSION_CONTROL=true включает их
+    os.environ.setdefault("ADMISSION_CONTROL", "false")
+    os.environ.update({
+        "SD_WEBUI_URL": webui_url,
+        "TELEGRAM_API_URL": api_url,
+        "QUEUE_DB_PATH": os.path.join(tmp, "queue.db"),
+        "FSM_DB_PATH": os.path.join(tmp, "fsm.db"),
+        "FILE_ID_DB_PATH": "",
+        # Каждый запрос уникален: кэш результатов не влияет на замер
+        "RESULT_CACHE_DIR": "",
+        "EVENT_LOG_PATH": os.path.join(tmp, "events.jsonl"),
+        "METRICS_PORT": "0",
+        "BOT_MODE": "polling",
+        "GENERATION_BACKEND": "local",
+    })
+
+
+class Harness:
+    """Синтетические пользователи и учет доставленных результатов"""
+    
+    def __init__(self, bot_module, args):
+        self.bot_module = bot_module
+        self.args = args
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        # chat_id -> future доставки фото
+        self.waiting = {}
+        self.latencies = {"text": [], "advanced": [], "wizard": []}
+        self.delivered = 0
+        self.timeouts = 0
+        # Исключения обработчиков по типам (например, 429 на прямых ответах message.answer)
+        self.handler_errors = Counter()
+    
+    async def on_request(self, make_request, bot, method):
+        """Middleware сессии бота: доставка фото пользователю"""
+        response = await make_request(bot, method)
+        if method.__api_method__ == "sendPhoto":
+            future = self.waiting.pop(method.chat_id, None)
+            if future is not None and not future.done():
+                future.set_result(time.perf_counter())
+        return response
+    
+    async def send(self, user_id: int, text: str):
+        from aiogram import types
+        update = types.Update.model_validate({
+            "update_id": next(self.update_ids),
+            "message": {
+                "message_id": next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"},
+                "text": text,
+            },
+        })
+        await self.bot_module.dp.feed_update(self.bot_module.bot, update)
+    
+    async def on_error(self, handler, event, data):
+        """Outer middleware dp.errors: ошибки обработчиков до errors_handler бота"""
+        self.handler_errors[type(event.exception).__name__] += 1
+        return await handler(event, data)
+    
+    async def think(self):
+        await asyncio.sleep(random.uniform(0.75, 1.25) * self.args.think_ms / 1000)
+    
+    def steps(self, scenario: str, user_id: int, prompt: str) -> list:
+        """Сообщения сценария; результат ждется после последнего"""
+        if scenario == "text":
+            return [prompt]
+        if scenario == "advanced":
+            return ["🔄 Продвинутая генерация", prompt, "skip", str(self.args.steps), "default",
+                    f"{self.args.size}x{self.args.size}"]
+        return ["🐾 Простая генерация", *WIZARD_ANSWERS[:-1], WIZARD_ANSWERS[-1]]
+    
+    async def user(self, user_id: int, scenarios: list):
+        for round_no, scenario in enumerate(scenarios):
+            prompt = f"e2e user {user_id} round {round_no}, {scenario}, detailed"
+            messages = self.steps(scenario, user_id, prompt)
+            if scenario == "wizard":
+                # Уникальный персонаж: одинаковые запросы бот объединяет в одну генерацию
+                messages[1] = f"fox{user_id}x{round_no}"
+            for text in messages[:-1]:
+                await self.send(user_id, text)
+                await self.think()
+            future = asyncio.get_running_loop().create_future()
+            self.waiting[user_id] = future
+            started = time.perf_counter()
+            await self.send(user_id, messages[-1])
+            try:
+                delivered_at = await asyncio.wait_for(future, timeout=self.args.timeout)
+            except asyncio.TimeoutError:
+                self.waiting.pop(user_id, None)
+                self.timeouts += 1
+                continue
+            self.delivered += 1
+            self.latencies[scenario].append(delivered_at - started)
+            await self.think()
+
+
+async def fetch_stats(api_url: str) -> dict:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{api_url}/stats") as response:
+            return await response.json()
+
+
+async def main(args):
+    random.seed(args.seed)
+    mix = parse_mix(args.mix)
+    webui, webui_url, api, api_url = start_stubs(args)
+    tmp = tempfile.mkdtemp(prefix="sdbot-e2e-")
+    try:
+        await wait_ready(f"{webui_url}/sdapi/v1/options")
+        await wait_ready(f"{api_url}/stats")
+        configure_bot(webui_url, api_url, tmp)
+        import bot_advanced
+        from benchmarks.bench_event_loop import LoopLagProbe
+        from queue_manager import queue_manager
+        
+        queue_manager.max_completed_tasks = args.users * args.rounds
+        harness = Harness(bot_module=bot_advanced, args=args)
+        bot_advanced.bot.session.middleware(harness.on_request)
+        bot_advanced.dp.errors.outer_middleware(harness.on_error)
+        await bot_advanced.dp.emit_startup()
+        
+        scenarios = {user_id: random.choices(list(mix), weights=list(mix.values()), k=args.rounds)
+                     for user_id in range(1000, 1000 + args.users)}
+        probe = LoopLagProbe()
+        probe.start()
+        started = time.perf_counter()
+        await asyncio.gather(*(harness.user(user_id, rounds) for user_id, rounds in scenarios.items()))
+        elapsed = time.perf_counter() - started
+        loop_lag = await probe.stop()
+        
+        queue_wait = [task.started_at - task.created_at for task in queue_manager.completed_tasks
+                      if task.started_at is not None]
+        await bot_advanced.dp.emit_shutdown()
+        await bot_advanced.bot.session.close()
+        stats = await fetch_stats(api_url)
+    finally:
+        for process in (webui, api):
+            process.terminate()
+            process.wait(timeout=10)
+    
+    history = stats.pop("history")
+    report = {
+        "version": git_version(),
+        "params": vars(args),
+        "users": args.users,
+        "requests": args.users * args.rounds,
+        "delivered": harness.delivered,
+        "timeouts": harness.timeouts,
+        "handler_errors": harness.handler_errors,
+        "elapsed_s": round(elapsed, 2),
+        "images_per_min": round(harness.delivered / elapsed * 60, 1),
+        "queue_wait": summary(queue_wait),
+        "end_to_end": summary([latency for latencies in harness.latencies.values() for latency in latencies]),
+        "end_to_end_by_flow": {name: summary(latencies) for name, latencies in harness.latencies.items() if latencies},
+        "bot_loop_lag": loop_lag,
+        "bot_api": {**stats, "calls_total": len(history)},
+    }
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=2, help="генераций на пользователя")
+    parser.add_argument("--mix", default="text=0.5,advanced=0.25,wizard=0.25", help="доли сценариев")
+    parser.add_argument("--think-ms", type=float, default=1500, help="пауза пользователя между шагами")
+    parser.add_argument("--timeout", type=float, default=300, help="ожидание результата, секунды")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="", help="файл для отчета JSON")
+    # SD WebUI
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--step-latency", type=float, default=0.02)
+    parser.add_argument("--batch-overhead", type=float, default=0.1)
+    parser.add_argument("--per-image-step-latency", type=float, default=0.005)
+    parser.add_argument("--image-size", type=int, default=0, help="сторона изображения WebUI; 0 — из запроса")
+    # Telegram Bot API
+    parser.add_argument("--chat-interval", type=float, default=1.0)
+    parser.add_argument("--global-rate", type=float, default=30.0)
+    parser.add_argument("--api-latency", type=float, default=0.02)
+    parser.add_argument("--uplink-mbit", type=float, default=0.0, help="0 — без ограничения")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="доля вызовов с внеочередным 429")
+    asyncio.run(main(parser.parse_args()))
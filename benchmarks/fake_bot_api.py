@@ -0,0 +1,198 @@
+"""
+Заглушка Telegram Bot API для бенчмарков
+
+Принимает POST /bot<token>/<method>, как api.telegram.org, и эмулирует лимиты:
+не чаще одного вызова в chat_interval секунд на чат и не больше global_rate
+вызовов в секунду на бота — сверх лимита отвечает 429 с retry_after.
+Правка сообщения тем же текстом возвращает 400 "message is not modified".
+upload_bandwidth (байт/с) эмулирует общий канал загрузки файлов в Telegram:
+одновременные загрузки делят его между собой.
+Загруженные фото и документы получают file_id; повторная отправка по
+неизвестному file_id отклоняется, как настоящим API.
+retry_after_rate — доля вызовов, которым 429 отвечается сверх лимитов
+(как при временной перегрузке Telegram). Все вызовы записываются в history,
+GET /stats отдает счетчики и историю в JSON.
+Подключение: AiohttpSession(api=TelegramAPIServer.from_base(url)) или
+TELEGRAM_API_URL для бота.
+Запуск отдельно: python -m benchmarks.fake_bot_api --port 8081 --retry-after-rate 0.02
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import math
+import random
+import time
+from collections import Counter, deque
+
+from aiohttp import web
+
+
+class FakeBotAPI:
+    """Заглушка Bot API со счетчиками вызовов по методам и ответам"""
+    
+    def __init__(self, chat_interval: float = 1.0, global_rate: float = 30.0, latency: float = 0.0,
+                 upload_bandwidth: float = 0.0, retry_after_rate: float = 0.0):
+        self.chat_interval = chat_interval
+        self.retry_after_rate = retry_after_rate
+        self.global_rate = global_rate
+        self.latency = latency
+        self.upload_bandwidth = upload_bandwidth
+        self.bytes_received = 0
+        self._uplink = asyncio.Lock()
+        self.calls = Counter()
+        self.responses = Counter()
+        self.messages = {}
+        self._chat_last_call = {}
+        self._global_calls = deque()
+        self._message_ids = itertools.count(1)
+        self.file_ids = set()
+        self.uploads = 0
+        # (время, метод, chat_id, ответ)
+        self.history = []
+    
+    def _retry_after(self, chat_id: int, now: float) -> float:
+        """Через сколько секунд вызов будет разрешен (0 — можно сейчас)"""
+        while self._global_calls and self._global_calls[0] <= now - 1.0:
+            self._global_calls.popleft()
+        wait = 0.0
+        if len(self._global_calls) >= self.global_rate:
+            wait = self._global_calls[0] + 1.0 - now
+        last = self._chat_last_call.get(chat_id)
+        if last is not None and now - last < self.chat_interval:
+            wait = max(wait, last + self.chat_interval - now)
+        return wait
+    
+    def _message(self, chat_id: int, message_id: int, text: str = "") -> dict:
+        return {"message_id": message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"}, "text": text}
+    
+    @staticmethod
+    def _field_size(value) -> int:
+        if isinstance(value, str):
+            return len(value.encode())
+        return value.file.seek(0, io.SEEK_END)
+    
+    def _attach_file(self, method: str, data, result: dict):
+        """Добавляет файл в ответ send* метода; None — неизвестный file_id"""
+        field = "photo" if method == "sendPhoto" else "document"
+        value = data.get(field)
+        if isinstance(value, str) and value.startswith("attach://"):
+            # aiogram передает файл отдельной частью multipart
+            value = data.get(value[len("attach://"):])
+        if isinstance(value, str):
+            if value not in self.file_ids:
+                return None
+            file_id = value
+        else:
+            self.uploads += 1
+            file_id = f"file-{len(self.file_ids) + 1}"
+            self.file_ids.add(file_id)
+        file = {"file_id": file_id, "file_unique_id": file_id}
+        result[field] = [{**file, "width": 1280, "height": 1280}] if field == "photo" else file
+        return result
+    
+    @staticmethod
+    def _error(code: int, description: str, **parameters) -> web.Response:
+        payload = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            payload["parameters"] = parameters
+        # Статус HTTP совпадает с error_code, по нему aiogram выбирает исключение
+        return web.json_response(payload, status=code)
+    
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = await request.post() if request.content_type != "application/json" else await request.json()
+        # Файлы приходят chunked multipart без Content-Length — считаем размер полей
+        size = sum(map(self._field_size, data.values()))
+        chat_id = int(data.get("chat_id", 0))
+        self.calls[method] += 1
+        self.bytes_received += size
+        if self.upload_bandwidth:
+            async with self._uplink:
+                await asyncio.sleep(size / self.upload_bandwidth)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        
+        now = time.monotonic()
+        wait = self._retry_after(chat_id, now)
+        if not wait and self.retry_after_rate and random.random() < self.retry_after_rate:
+            wait = 1.0
+        if wait > 0:
+            self.responses["429"] += 1
+            self.history.append((time.time(), method, chat_id, "429"))
+            retry_after = max(1, math.ceil(wait))
+            return self._error(429, f"Too Many Requests: retry after {retry_after}", retry_after=retry_after)
+        self._global_calls.append(now)
+        self._chat_last_call[chat_id] = now
+        response = self._call(method, chat_id, data)
+        self.history.append((time.time(), method, chat_id, "ok" if response.status == 200 else str(response.status)))
+        return response
+    
+    def _call(self, method: str, chat_id: int, data) -> web.Response:
+        if method == "editMessageText":
+            key = (chat_id, int(data["message_id"]))
+            text = data.get("text", "")
+            if self.messages.get(key) == text:
+                self.responses["not_modified"] += 1
+                return self._error(400, "Bad Request: message is not modified: specified new message content "
+                                        "and reply markup are exactly the same as a current content and reply markup of the message")
+            self.messages[key] = text
+            result = self._message(chat_id, key[1], text)
+        elif method == "deleteMessage":
+            self.messages.pop((chat_id, int(data["message_id"])), None)
+            result = True
+        elif method in ("sendMessage", "sendPhoto", "sendDocument"):
+            message_id = next(self._message_ids)
+            self.messages[(chat_id, message_id)] = data.get("text", "")
+            result = self._message(chat_id, message_id, data.get("text", ""))
+            if method != "sendMessage" and self._attach_file(method, data, result) is None:
+                self.responses["bad_file_id"] += 1
+                return self._error(400, "Bad Request: wrong file identifier/HTTP URL specified")
+        else:
+            result = True
+        self.responses["ok"] += 1
+        return web.json_response({"ok": True, "result": result})
+    
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "calls": self.calls, "responses": self.responses, "uploads": self.uploads,
+            "bytes_received": self.bytes_received, "history": self.history,
+        })
+    
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_get("/stats", self.stats)
+        return app
+    
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Запускает сервер и возвращает его базовый URL"""
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+    
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+async def _serve(args):
+    api = FakeBotAPI(chat_interval=args.chat_interval, global_rate=args.global_rate, latency=args.latency,
+                     upload_bandwidth=args.uplink_mbit * 1024 * 1024 / 8, retry_after_rate=args.retry_after_rate)
+    url = await api.start(port=args.port)
+    print(f"Fake Bot API: {url}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--chat-interval", type=float, default=1.0)
+    parser.add_argument("--global-rate", type=float, default=30.0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--uplink-mbit", type=float, default=0.0, help="0 — без ограничения")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0)
+    asyncio.run(_serve(parser.parse_args()))
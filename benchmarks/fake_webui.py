@@ -0,0 +1,206 @@
+"""
+Заглушка Stable Diffusion WebUI API для бенчмарков
+
+Эмулирует /sdapi/v1/* с настраиваемой задержкой на шаг и размером изображения
+(по умолчанию — запрошенный width x height, image_size задает сторону явно).
+Одно изображение на размер кэшируется; unique_images — новое шумовое
+изображение на каждый результат (кэши по содержимому не срабатывают).
+Запуск отдельно: python -m benchmarks.fake_webui --port 7861
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import struct
+import time
+import zlib
+
+from aiohttp import web
+
+
+def make_png(width: int, height: int, noise: bool = True) -> bytes:
+    """Создает валидный RGB PNG без зависимостей (шум не сжимается, как реальные изображения)"""
+    def chunk(kind: bytes, payload: bytes) -> bytes:
+        body = kind + payload
+        return struct.pack(">I", len(payload)) + body + struct.pack(">I", zlib.crc32(body) & 0xFFFFFFFF)
+    
+    row_size = width * 3
+    if noise:
+        raw = b"".join(b"\x00" + os.urandom(row_size) for _ in range(height))
+    else:
+        raw = (b"\x00" + b"\x80" * row_size) * height
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", header)
+        + chunk(b"IDAT", zlib.compress(raw, 0 if noise else 6))
+        + chunk(b"IEND", b"")
+    )
+
+
+class FakeWebUI:
+    """Заглушка SD WebUI с моделью стоимости: overhead + шаги * (step_latency + per_image * batch)"""
+    
+    def __init__(self, step_latency: float = 0.01, batch_overhead: float = 0.05,
+                 per_image_step_latency: float = 0.0, noise: bool = True, model_load_latency: float = 0.0,
+                 image_size: int = 0, unique_images: bool = False):
+        self.step_latency = step_latency
+        self.image_size = image_size
+        self.unique_images = unique_images
+        self.model_load_latency = model_load_latency
+        self.batch_overhead = batch_overhead
+        self.per_image_step_latency = per_image_step_latency
+        self.noise = noise
+        self.models = [
+            {"title": "model_a.safetensors [abc123]", "model_name": "model_a"},
+            {"title": "model_b.safetensors [def456]", "model_name": "model_b"},
+        ]
+        self.options = {"sd_model_checkpoint": self.models[0]["title"]}
+        self.requests = 0
+        self.model_loads = 0
+        self.images_generated = 0
+        self.durations = []
+        # Выполненные txt2img: время начала и конца (time.monotonic) и признак прерывания
+        self.jobs = []
+        self.busy = asyncio.Lock()
+        self._png_cache = {}
+        self._progress = {"progress": 0.0, "eta_relative": 0.0, "state": {
+            "skipped": False, "interrupted": False, "job": "", "job_count": 0,
+            "job_no": 0, "sampling_step": 0, "sampling_steps": 0}}
+        self._interrupted = False
+    
+    def _png_b64(self, width: int, height: int) -> str:
+        key = (width, height)
+        if self.unique_images:
+            return base64.b64encode(make_png(width, height, self.noise)).decode()
+        if key not in self._png_cache:
+            self._png_cache[key] = base64.b64encode(make_png(width, height, self.noise)).decode()
+        return self._png_cache[key]
+    
+    async def txt2img(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        self.requests += 1
+        steps = int(data.get("steps", 20))
+        width = int(data.get("width", 512))
+        height = int(data.get("height", 512))
+        prompts = data.get("prompt", "")
+        batch_size = len(prompts) if isinstance(prompts, list) else int(data.get("batch_size", 1))
+        seed = int(data.get("seed", -1))
+        if seed == -1:
+            seed = int.from_bytes(os.urandom(3), "big")
+        
+        # GPU один: запросы выполняются последовательно, как в настоящем WebUI
+        async with self.busy:
+            checkpoint = (data.get("override_settings") or {}).get("sd_model_checkpoint")
+            if checkpoint and checkpoint not in self._loaded_names():
+                # Загрузка другого чекпоинта перед генерацией
+                self.model_loads += 1
+                await asyncio.sleep(self.model_load_latency)
+                self.options["sd_model_checkpoint"] = self._find_title(checkpoint)
+            self._interrupted = False
+            state = self._progress["state"]
+            state.update(job="txt2img", job_count=1, sampling_steps=steps, interrupted=False)
+            step_time = self.step_latency + self.per_image_step_latency * batch_size
+            started = time.monotonic()
+            await asyncio.sleep(self.batch_overhead)
+            for step in range(steps):
+                if self._interrupted:
+                    break
+                state["sampling_step"] = step + 1
+                self._progress["progress"] = (step + 1) / steps
+                elapsed = time.monotonic() - started
+                self._progress["eta_relative"] = max(0.0, elapsed / (step + 1) * (steps - step - 1))
+                await asyncio.sleep(step_time)
+            self.durations.append(time.monotonic() - started)
+            self.jobs.append({"prompt": prompts, "steps": steps, "started": started, "finished": time.monotonic(),
+                              "interrupted": self._interrupted})
+            self._progress.update(progress=0.0, eta_relative=0.0)
+            state.update(job="", job_count=0, sampling_step=0, sampling_steps=0)
+        
+        self.images_generated += batch_size
+        if self.image_size:
+            width = height = self.image_size
+        images = [self._png_b64(width, height) for _ in range(batch_size)]
+        info = {
+            "seed": seed,
+            "all_seeds": [seed + i for i in range(batch_size)],
+            "sd_model_name": self.options["sd_model_checkpoint"],
+        }
+        return web.json_response({"images": images, "parameters": data, "info": json.dumps(info)})
+    
+    def _loaded_names(self) -> tuple:
+        title = self.options["sd_model_checkpoint"]
+        model = next((m for m in self.models if m["title"] == title), {})
+        return title, model.get("model_name")
+    
+    def _find_title(self, name: str) -> str:
+        return next((m["title"] for m in self.models if name in (m["title"], m["model_name"])), name)
+    
+    async def sd_models(self, request: web.Request) -> web.Response:
+        return web.json_response(self.models)
+    
+    async def samplers(self, request: web.Request) -> web.Response:
+        return web.json_response([{"name": "Euler a"}, {"name": "DPM++ 2M Karras"}])
+    
+    async def loras(self, request: web.Request) -> web.Response:
+        return web.json_response([{"name": "detail_tweaker"}])
+    
+    async def get_options(self, request: web.Request) -> web.Response:
+        return web.json_response(self.options)
+    
+    async def set_options(self, request: web.Request) -> web.Response:
+        self.options.update(await request.json())
+        return web.json_response(None)
+    
+    async def progress(self, request: web.Request) -> web.Response:
+        return web.json_response(self._progress)
+    
+    async def interrupt(self, request: web.Request) -> web.Response:
+        self._interrupted = True
+        self._progress["state"]["interrupted"] = True
+        return web.json_response(None)
+    
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/sdapi/v1/txt2img", self.txt2img)
+        app.router.add_get("/sdapi/v1/sd-models", self.sd_models)
+        app.router.add_get("/sdapi/v1/samplers", self.samplers)
+        app.router.add_get("/sdapi/v1/loras", self.loras)
+        app.router.add_get("/sdapi/v1/options", self.get_options)
+        app.router.add_post("/sdapi/v1/options", self.set_options)
+        app.router.add_get("/sdapi/v1/progress", self.progress)
+        app.router.add_post("/sdapi/v1/interrupt", self.interrupt)
+        return app
+    
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Запускает сервер и возвращает его базовый URL"""
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+    
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+async def _serve(args):
+    webui = FakeWebUI(step_latency=args.step_latency, batch_overhead=args.batch_overhead,
+                      per_image_step_latency=args.per_image_step_latency, image_size=args.image_size,
+                      unique_images=args.unique_images)
+    url = await webui.start(port=args.port)
+    print(f"Fake SD WebUI: {url}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=7861)
+    parser.add_argument("--step-latency", type=float, default=0.05)
+    parser.add_argument("--batch-overhead", type=float, default=0.2)
+    parser.add_argument("--per-image-step-latency", type=float, default=0.01)
+    parser.add_argument("--image-size", type=int, default=0, help="сторона изображения; 0 — из запроса")
+    parser.add_argument("--unique-images", action="store_true", help="новое изображение на каждый результат")
+    asyncio.run(_serve(parser.parse_args()))
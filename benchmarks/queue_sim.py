@@ -0,0 +1,414 @@
+"""
+Симулятор очереди генерации на виртуальном времени
+
+Настоящие QueueManager, политика планирования (scheduling), объединение в
+пакеты (batching, BATCH_MAX_WAIT) и GenerationDispatcher работают в event
+loop с виртуальными часами: ожидание таймера не спит, а переводит часы
+вперед, поэтому час нагрузки проигрывается за секунды. Бэкенд заменен
+моделью стоимости: overhead пакета + шаги * (время шага + время на
+изображение) с поправкой на разрешение и загрузку другой модели; --gpus
+задает число одновременно выполняемых пакетов (worker).
+
+Поступления задач:
+- синтетические: пуассоновский поток --rate, всплески --burst, тяжелые
+  пользователи (--heavy-users дают --heavy-share задач), смесь разрешений
+  --sizes и моделей --models;
+- трасса: журнал событий бота (EVENT_LOG_PATH, записи task_enqueued и
+  task_subscribed) или база очереди (QUEUE_DB_PATH); --load-factor сжимает
+  время между поступлениями.
+
+Для каждой политики (--policies) отчет в JSON: ожидание в очереди и полное
+время ответа, распределения по пользователям, индексы справедливости Джайна
+(по среднему ожиданию и по замедлению), загрузка GPU, отказы при
+переполнении очереди и контроле допуска (--admission, по причинам),
+объединенные одинаковые запросы. С --retries отклоненный пользователь
+повторяет запрос через retry_after.
+
+Запуск:
+    python -m benchmarks.queue_sim --duration 3600 --rate 0.3 --users 200 --burst 600:80
+    python -m benchmarks.queue_sim --trace logs/events.jsonl --load-factor 2
+    python -m benchmarks.queue_sim --admission --retries 3 --heavy-share 0.6
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import selectors
+import sqlite3
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARKbenchmarkBENCHMARKbench")
+
+from admission import AdmissionRejected, create_admission
+from batching import get_dedup_key
+from config import (ADMISSION_CONTROL, BATCH_MAX_SIZE, BATCH_MAX_WAIT, DEFAULT_PARAMS, MODEL_AFFINITY, QUEUE_DEDUP,
+                    QUEUE_MAX_SIZE, SCHEDULING_POLICY)
+from generation_dispatcher import GenerationDispatcher
+from queue_manager import TRACE_PARAMETERS, QueueManager
+from scheduling import POLICIES, create_policy
+
+
+class _VirtualSelector(selectors.SelectSelector):
+    """Опрос без ожидания: время ожидания таймера добавляется к виртуальным часам"""
+    
+    def __init__(self, loop: "VirtualClockLoop"):
+        super().__init__()
+        self._loop = loop
+    
+    def select(self, timeout=None):
+        events = super().select(0)
+        if not events:
+            if timeout is None:
+                raise RuntimeError("Симуляция остановилась: нет ни готовых задач, ни таймеров")
+            self._loop.now += timeout
+        return events
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """Event loop, в котором loop.time() — виртуальные часы"""
+    
+    def __init__(self):
+        self.now = 0.0
+        super().__init__(_VirtualSelector(self))
+    
+    def time(self) -> float:
+        return self.now
+
+
+class Arrival:
+    __slots__ = ("at", "user_id", "prompt", "parameters", "task", "rejected", "attempts")
+    
+    def __init__(self, at: float, user_id: int, prompt: str, parameters: Dict):
+        self.at = at
+        self.user_id = user_id
+        self.prompt = prompt
+        self.parameters = parameters
+        self.task = None
+        # Причина последнего отказа, если задача так и не принята
+        self.rejected: Optional[str] = None
+        self.attempts = 0
+
+
+class CostModel:
+    """Время пакета на GPU, секунды (та же модель, что у benchmarks.fake_webui, плюс разрешение)"""
+    
+    def __init__(self, step_latency: float = 0.05, per_image_step_latency: float = 0.01,
+                 batch_overhead: float = 0.2, model_load: float = 10.0):
+        self.step_latency = step_latency
+        self.per_image_step_latency = per_image_step_latency
+        self.batch_overhead = batch_overhead
+        self.model_load = model_load
+    
+    def batch_seconds(self, tasks: list, loaded_model: Optional[str]) -> float:
+        params = {**DEFAULT_PARAMS, **(tasks[0].parameters or {})}
+        images = sum(int((task.parameters or {}).get("batch_size", 1)) for task in tasks)
+        scale = params["width"] * params["height"] / (512 * 512)
+        seconds = self.batch_overhead + params["steps"] * (self.step_latency + self.per_image_step_latency * images) * scale
+        model = params.get("model")
+        if model and model != loaded_model:
+            seconds += self.model_load
+        return seconds
+
+
+def _weighted(value: str, cast=str) -> list:
+    """"a:0.6,b:0.4" -> [(a, 0.6), (b, 0.4)]"""
+    items = []
+    for item in value.split(","):
+        if item.strip():
+            name, weight = item.rsplit(":", 1)
+            items.append((cast(name.strip()), float(weight)))
+    return items
+
+
+def synthetic_arrivals(args, rng: random.Random) -> List[Arrival]:
+    users = list(range(1, args.users + 1))
+    heavy = users[:args.heavy_users]
+    light = users[args.heavy_users:] or users
+    sizes = _weighted(args.sizes, int)
+    models = _weighted(args.models)
+    
+    def make(at: float, index: int, user_id: Optional[int] = None) -> Arrival:
+        if user_id is None:
+            user_id = rng.choice(heavy) if heavy and rng.random() < args.heavy_share else rng.choice(light)
+        size = rng.choices([s for s, _ in sizes], [w for _, w in sizes])[0]
+        parameters = {"steps": args.steps, "width": size, "height": size}
+        if models:
+            parameters["model"] = rng.choices([m for m, _ in models], [w for _, w in models])[0]
+        prompt = f"prompt {rng.randrange(args.prompt_pool)}" if args.prompt_pool else f"prompt {index}"
+        return Arrival(at, user_id, prompt, parameters)
+    
+    arrivals = []
+    at = rng.expovariate(args.rate) if args.rate > 0 else args.duration
+    while at < args.duration:
+        arrivals.append(make(at, len(arrivals)))
+        at += rng.expovariate(args.rate)
+    for burst in args.burst:
+        start, count = burst.split(":")
+        for _ in range(int(count)):
+            # Всплеск: много разных пользователей за --burst-spread секунд
+            arrivals.append(make(float(start) + rng.random() * args.burst_spread, len(arrivals), rng.choice(light)))
+    arrivals.sort(key=lambda arrival: arrival.at)
+    return arrivals
+
+
+def _parse_ts(value: str) -> float:
+    return datetime.fromisoformat(value).timestamp()
+
+
+def load_event_log(paths: List[str]) -> List[Arrival]:
+    """Поступления из журнала событий: task_enqueued и присоединения к одинаковым запросам"""
+    records = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                if record.get("event") in ("task_enqueued", "task_subscribed"):
+                    records.append(record)
+    records.sort(key=lambda record: record["ts"])
+    tasks = {}
+    arrivals = []
+    for record in records:
+        if record["event"] == "task_enqueued":
+            parameters = {name: record[name] for name in TRACE_PARAMETERS if name in record}
+            prompt = f"crc {record['prompt_crc']}" if "prompt_crc" in record else record["task_id"]
+            tasks[record["task_id"]] = (prompt, parameters)
+        elif record["task_id"] in tasks:
+            prompt, parameters = tasks[record["task_id"]]
+        else:
+            continue
+        arrivals.append(Arrival(_parse_ts(record["ts"]), record["user_id"], prompt, dict(parameters)))
+    return arrivals
+
+
+def load_task_store(path: str) -> List[Arrival]:
+    """Поступления из базы очереди (task_store): задачи за QUEUE_DB_RETENTION_HOURS"""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        rows = conn.execute("SELECT created_at, user_id, prompt, parameters FROM tasks ORDER BY created_at").fetchall()
+    finally:
+        conn.close()
+    return [Arrival(created_at, user_id, prompt, json.loads(parameters or "{}"))
+            for created_at, user_id, prompt, parameters in rows]
+
+
+def load_trace(paths: List[str], load_factor: float) -> List[Arrival]:
+    if paths[0].endswith(".db"):
+        arrivals = load_task_store(paths[0])
+    else:
+        arrivals = load_event_log(paths)
+    if arrivals:
+        start = arrivals[0].at
+        for arrival in arrivals:
+            arrival.at = (arrival.at - start) / load_factor
+    return arrivals
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+def summary(values: list) -> dict:
+    return {"count": len(values), "mean_s": round(sum(values) / len(values), 2) if values else 0.0,
+            "p50_s": round(percentile(values, 0.5), 2), "p95_s": round(percentile(values, 0.95), 2),
+            "p99_s": round(percentile(values, 0.99), 2), "max_s": round(max(values, default=0.0), 2)}
+
+
+def jain_index(values: list) -> float:
+    """Индекс справедливости Джайна: 1 — у всех поровну, 1/n — все досталось одному"""
+    total = sum(values)
+    squares = sum(value * value for value in values)
+    return round(total * total / (len(values) * squares), 4) if squares else 1.0
+
+
+async def simulate(arrivals: List[Arrival], policy_name: str, args) -> dict:
+    loop = asyncio.get_running_loop()
+    manager = QueueManager(max_queue_size=args.max_queue_size,
+                           policy=create_policy(policy_name, args.model_affinity, clock=loop.time),
+                           dedup_key=get_dedup_key if args.dedup else None, clock=loop.time,
+                           admission=create_admission(args.admission, clock=loop.time))
+    manager.max_active_batches = args.gpus
+    manager.max_completed_tasks = 0
+    cost_model = CostModel(args.step_latency, args.per_image_step_latency, args.batch_overhead, args.model_load)
+    loaded_models: List[Optional[str]] = [None] * args.gpus
+    free_gpus = list(range(args.gpus))
+    busy = {"seconds": 0.0}
+    service: Dict[str, float] = {}
+    done = asyncio.Event()
+    arrivals_done = False
+    retrying = {"count": 0}
+    
+    def check_done():
+        if arrivals_done and not retrying["count"] and not manager.queue and not manager.processing:
+            done.set()
+    
+    def submit(arrival: Arrival):
+        arrival.attempts += 1
+        try:
+            arrival.task = manager.add_task(arrival.user_id, arrival.prompt, arrival.parameters, chat_id=arrival.user_id)
+            arrival.rejected = None
+        except AdmissionRejected as e:
+            arrival.rejected = e.reason
+            if arrival.attempts <= args.retries:
+                retrying["count"] += 1
+                loop.call_later(e.retry_after, retry, arrival)
+    
+    def retry(arrival: Arrival):
+        retrying["count"] -= 1
+        submit(arrival)
+        check_done()
+    
+    async def process_batch(tasks):
+        model = (tasks[0].parameters or {}).get("model")
+        # Свободный GPU с уже загруженной моделью пакета, иначе любой
+        gpu = next((gpu for gpu in free_gpus if loaded_models[gpu] == model), free_gpus[0])
+        free_gpus.remove(gpu)
+        seconds = cost_model.batch_seconds(tasks, loaded_models[gpu])
+        if model:
+            loaded_models[gpu] = model
+        await asyncio.sleep(seconds)
+        busy["seconds"] += seconds
+        free_gpus.append(gpu)
+        for task in tasks:
+            service[task.id] = seconds
+            manager.complete_task(task.id, {})
+        check_done()
+    
+    dispatcher = GenerationDispatcher(manager, process_batch, max_batch_size=args.batch_max_size,
+                                      max_wait=args.batch_max_wait)
+    await dispatcher.start()
+    started_wall = time.perf_counter()
+    start = loop.time()
+    for arrival in arrivals:
+        delay = start + arrival.at - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        arrival.at = loop.time()
+        submit(arrival)
+    arrivals_done = True
+    check_done()
+    await done.wait()
+    makespan = loop.time() - start
+    await dispatcher.stop()
+    wall = time.perf_counter() - started_wall
+    
+    served = [arrival for arrival in arrivals if arrival.task is not None]
+    unique = {id(arrival.task) for arrival in served}
+    waits, responses, slowdowns = [], [], []
+    by_user = defaultdict(list)
+    user_slowdown = defaultdict(list)
+    by_size = defaultdict(list)
+    for arrival in served:
+        task = arrival.task
+        # Присоединившийся к уже запущенной задаче не ждет очереди
+        wait = max(0.0, task.started_at - arrival.at)
+        response = task.completed_at - arrival.at
+        waits.append(wait)
+        responses.append(response)
+        slowdown = response / service[task.id]
+        slowdowns.append(slowdown)
+        by_user[arrival.user_id].append(wait)
+        user_slowdown[arrival.user_id].append(slowdown)
+        by_size[f"{task.parameters.get('width', DEFAULT_PARAMS['width'])}x"
+                f"{task.parameters.get('height', DEFAULT_PARAMS['height'])}"].append(wait)
+    
+    user_means = {user_id: sum(values) / len(values) for user_id, values in by_user.items()}
+    heavy_ids = set(range(1, args.heavy_users + 1)) if not args.trace else set()
+    rejected = defaultdict(int)
+    for arrival in arrivals:
+        if arrival.rejected:
+            rejected[arrival.rejected] += 1
+    report = {
+        "policy": create_policy(policy_name, args.model_affinity).name,
+        "arrivals": len(arrivals),
+        "tasks": len(unique),
+        "merged": len(served) - len(unique),
+        "rejected": sum(rejected.values()),
+        "rejected_by_reason": dict(sorted(rejected.items())),
+        "retries": sum(max(0, arrival.attempts - 1) for arrival in arrivals),
+        "makespan_s": round(makespan, 1),
+        "wall_s": round(wall, 2),
+        "gpu_utilization": round(busy["seconds"] / (makespan * args.gpus), 3) if makespan else 0.0,
+        "wait": summary(waits),
+        "response": summary(responses),
+        "slowdown": {"p50": round(percentile(slowdowns, 0.5), 2), "p95": round(percentile(slowdowns, 0.95), 2)},
+        "fairness": {
+            "jain_mean_wait": jain_index(list(user_means.values())),
+            "jain_slowdown": jain_index([sum(values) / len(values) for values in user_slowdown.values()]),
+        },
+        "per_user_mean_wait": summary(list(user_means.values())),
+        "wait_by_size": {size: summary(values) for size, values in sorted(by_size.items())},
+    }
+    if heavy_ids:
+        report["wait_by_user_class"] = {
+            "heavy": summary([w for user_id, values in by_user.items() if user_id in heavy_ids for w in values]),
+            "light": summary([w for user_id, values in by_user.items() if user_id not in heavy_ids for w in values]),
+        }
+        report["rejected_by_user_class"] = {
+            "heavy": sum(1 for arrival in arrivals if arrival.rejected and arrival.user_id in heavy_ids),
+            "light": sum(1 for arrival in arrivals if arrival.rejected and arrival.user_id not in heavy_ids),
+        }
+    if args.per_user:
+        report["per_user"] = {str(user_id): summary(values) for user_id, values in sorted(by_user.items())}
+    return report
+
+
+def run(args) -> dict:
+    reports = []
+    for policy_name in args.policies:
+        if args.trace:
+            arrivals = load_trace(args.trace, args.load_factor)
+        else:
+            arrivals = synthetic_arrivals(args, random.Random(args.seed))
+        with asyncio.Runner(loop_factory=VirtualClockLoop) as runner:
+            reports.append(runner.run(simulate(arrivals, policy_name, args)))
+    return {"params": vars(args), "results": reports}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--policies", nargs="+", default=[SCHEDULING_POLICY], choices=list(POLICIES))
+    parser.add_argument("--model-affinity", action=argparse.BooleanOptionalAction, default=MODEL_AFFINITY)
+    parser.add_argument("--dedup", action=argparse.BooleanOptionalAction, default=QUEUE_DEDUP)
+    parser.add_argument("--max-queue-size", type=int, default=QUEUE_MAX_SIZE)
+    parser.add_argument("--admission", action=argparse.BooleanOptionalAction, default=ADMISSION_CONTROL,
+                        help="контроль допуска по ADMISSION_TIERS")
+    parser.add_argument("--retries", type=int, default=0, help="повторов отклоненного запроса через retry_after")
+    parser.add_argument("--batch-max-size", type=int, default=BATCH_MAX_SIZE)
+    parser.add_argument("--batch-max-wait", type=float, default=BATCH_MAX_WAIT)
+    parser.add_argument("--gpus", type=int, default=1, help="одновременно выполняемых пакетов")
+    # Модель стоимости
+    parser.add_argument("--step-latency", type=float, default=0.05, help="секунд на шаг 512x512")
+    parser.add_argument("--per-image-step-latency", type=float, default=0.01)
+    parser.add_argument("--batch-overhead", type=float, default=0.2)
+    parser.add_argument("--model-load", type=float, default=10.0, help="загрузка другой модели, секунды")
+    # Синтетическая нагрузка
+    parser.add_argument("--duration", type=float, default=3600, help="секунд виртуального времени")
+    parser.add_argument("--rate", type=float, default=0.3, help="задач в секунду")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--heavy-users", type=int, default=5)
+    parser.add_argument("--heavy-share", type=float, default=0.4, help="доля задач от тяжелых пользователей")
+    parser.add_argument("--burst", nargs="*", default=[], help="всплески 'время:задач', например 600:80")
+    parser.add_argument("--burst-spread", type=float, default=5.0)
+    parser.add_argument("--sizes", default="512:0.6,768:0.3,1024:0.1", help="сторона:доля")
+    parser.add_argument("--models", default="", help="модель:доля, пусто — модель по умолчанию")
+    parser.add_argument("--steps", type=int, default=DEFAULT_PARAMS["steps"])
+    parser.add_argument("--prompt-pool", type=int, default=0, help="число разных промптов; 0 — все разные")
+    parser.add_argument("--seed", type=int, default=1)
+    # Трасса
+    parser.add_argument("--trace", nargs="*", default=[], help="журнал событий (.jsonl, можно несколько) или база очереди (.db)")
+    parser.add_argument("--load-factor", type=float, default=1.0, help="во сколько раз сжать время трассы")
+    parser.add_argument("--per-user", action="store_true", help="распределение ожидания каждого пользователя")
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    output = json.dumps(run(args), indent=2, ensure_ascii=False)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
@@ -1,71 +1,116 @@
 import asyncio
-import base64
-import io
 import logging
-import time
+import math
+import os
 import threading
-from concurrent.futures import ThreadPoolExecutor
+import time
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.types import FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
-from datetime import datetime
 
 from config import BOT_TOKEN, SD_MODEL_PATH
 from sd_client import StableDiffusionClient
+from generation_dispatcher import GenerationDispatcher
+from generation import generate_batch
+from broker import BrokerClient, create_broker
+from task_store import SQLiteTaskStore
+from result_cache import ResultCache, make_cache_key
 from advanced_features import AdvancedFeatures, AdvancedGenerationStates
 from queue_manager import queue_manager, GenerationStatus, GenerationStage
+from admission import AdmissionRejected
 from prompt_enhancer import enhance_prompt, get_default_negative_prompt
+from user_settings import user_settings
+from model_catalog import ModelCatalog, make_model_id
+from backend_health import BackendHealthMonitor, BackendState
+from image_stream import SpooledInputFile
+from image_postprocess import ImagePostprocessor
+from file_id_cache import FileIdCache, file_digest, make_file_key
+from fsm_storage import SQLiteStorage
+from message_updater import MessageUpdater, Priority
+from webhook_server import WebhookServer
+from event_log import events
+import metrics
+from metrics import MetricsServer, TelegramMetricsMiddleware
 import config
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 
-# Функции логирования
+# Функции логирования (журнал событий пишется в фоновом потоке, см. event_log.py)
 def log_user_message(message: types.Message):
     """Логирование сообщений пользователей"""
     user = message.from_user
     if user:
-        log_msg = (
-            f"[USER MSG] {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} | "
-            f"user_id={user.id} | username={user.username or 'None'} | first_name={user.first_name or 'None'} | "
-            f"text={repr(message.text)}"
-        )
-        logging.info(log_msg)
+        events.emit("user_message", user_id=user.id, username=user.username, first_name=user.first_name,
+                    chat_id=message.chat.id, text=message.text)
     else:
-        logging.warning(f"[USER MSG] {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} | Unknown user | text={repr(message.text)}")
+        events.emit("user_message", logging.WARNING, chat_id=message.chat.id, text=message.text)
 
 def log_user_callback(callback: types.CallbackQuery):
     """Логирование callback запросов пользователей"""
     user = callback.from_user
     if user:
-        log_msg = (
-            f"[USER CALLBACK] {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} | "
-            f"user_id={user.id} | username={user.username or 'None'} | first_name={user.first_name or 'None'} | "
-            f"data={repr(callback.data)}"
-        )
-        logging.info(log_msg)
+        events.emit("user_callback", user_id=user.id, username=user.username, first_name=user.first_name,
+                    data=callback.data)
     else:
-        logging.warning(f"[USER CALLBACK] {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} | Unknown user | data={repr(callback.data)}")
+        events.emit("user_callback", logging.WARNING, data=callback.data)
 
 # Инициализация бота и диспетчера
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN не установлен в config.py")
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+# Собственный сервер Bot API (локальный telegram-bot-api или заглушка бенчмарков)
+session = AiohttpSession(api=TelegramAPIServer.from_base(config.TELEGRAM_API_URL)) if config.TELEGRAM_API_URL else None
+bot = Bot(token=BOT_TOKEN, session=session)
+# Статусы, прогресс и результаты отправляются в пределах лимитов Telegram
+message_updater = MessageUpdater(bot)
+# Шаги мастеров сохраняются в SQLite и переживают перезапуск
+storage = SQLiteStorage(config.FSM_DB_PATH or None)
 dp = Dispatcher(storage=storage)
 
 # Инициализация клиентов
 sd_client = StableDiffusionClient()
-advanced_features = AdvancedFeatures(sd_client)
-
-# Создаем пул потоков для обработки генерации
-generation_executor = ThreadPoolExecutor(max_workers=3, thread_name_prefix="SD_Generator")
-
-# Словарь для отслеживания активных задач
-active_tasks = {}
+model_catalog = ModelCatalog(sd_client)
+backend_health = BackendHealthMonitor(sd_client)
+advanced_features = AdvancedFeatures(model_catalog, user_settings)
+result_cache = ResultCache() if config.RESULT_CACHE_DIR else None
+image_postprocessor = ImagePostprocessor()
+# Повторные отправки того же изображения идут по file_id без загрузки
+file_id_cache = FileIdCache(config.FILE_ID_DB_PATH or None)
+# В режиме broker пакеты выполняют процессы worker.py, бот только ставит их в брокер
+broker_client = BrokerClient(create_broker()) if config.GENERATION_BACKEND == "broker" else None
+if broker_client is not None:
+    queue_manager.max_active_batches = config.BROKER_MAX_ACTIVE_JOBS
+
+# Метрики Prometheus: обработчики на горячих путях и снимки состояния компонентов при запросе /metrics
+metrics_server = MetricsServer() if config.METRICS_PORT else None
+bot.session.middleware(TelegramMetricsMiddleware())
+sd_client.add_listener(metrics.observe_sd_request)
+metrics.registry.gauge("sdbot_queue_tasks", "Задачи в очереди и в генерации", lambda: {
+    (GenerationStatus.QUEUED.value,): len(queue_manager.queue),
+    (GenerationStatus.PROCESSING.value,): len(queue_manager.processing),
+}, ("status",))
+metrics.registry.gauge("sdbot_backend_up", "SD WebUI принимает запросы (1) или нет (0)",
+                       lambda: float(backend_health.is_accepting()))
+metrics.registry.gauge("sdbot_postprocess_in_flight", "Изображения в пуле постобработки",
+                       lambda: image_postprocessor.in_flight)
+metrics.registry.gauge("sdbot_postprocess_workers", "Процессы пула постобработки",
+                       lambda: image_postprocessor.workers)
+metrics.registry.gauge("sdbot_telegram_pending_operations", "Отправки и правки, ожидающие лимитов Telegram",
+                       lambda: message_updater.pending)
+metrics.registry.callback_counter("sdbot_telegram_updater_operations_total", "Операции MessageUpdater по исходу",
+                                  lambda: {(name,): value for name, value in message_updater.stats.items()}, ("result",))
+metrics.registry.callback_counter("sdbot_cache_lookups_total", "Обращения к кэшам результатов и file_id", lambda: {
+    **({("result", "hit"): result_cache.hits, ("result", "miss"): result_cache.misses} if result_cache else {}),
+    ("file_id", "hit"): file_id_cache.hits, ("file_id", "miss"): file_id_cache.misses,
+}, ("cache", "result"))
+metrics.registry.callback_counter("sdbot_event_log_records_total", "Записи журнала событий, не попавшие в журнал",
+                                  lambda: {("dropped",): events.dropped, ("sampled_out",): events.sampled_out},
+                                  ("result",))
 
 # Состояния FSM
 class GenerationStates(StatesGroup):
@@ -161,10 +206,10 @@ def get_advanced_keyboard():
     )
     return keyboard
 
-def get_models_keyboard():
-    """Создает клавиатуру для выбора моделей"""
+async def get_models_keyboard(page: int = 0):
+    """Создает клавиатуру для выбора моделей (по страницам, модели — из каталога в памяти)"""
     try:
-        models = sd_client.get_models()
+        models, page, pages = await model_catalog.get_page(page, config.MODEL_KEYBOARD_PAGE_SIZE)
         if not models:
             # Если не удалось получить модели, показываем стандартную
             keyboard = InlineKeyboardMarkup(
@@ -182,7 +227,7 @@ def get_models_keyboard():
             )
             return keyboard
         
-        # Создаем кнопки для каждой модели
+        # Создаем кнопки для моделей текущей страницы
         buttons = []
         for model in models:
             model_title = model.get('title', model.get('model_name', 'Неизвестная модель'))
@@ -194,14 +239,24 @@ def get_models_keyboard():
             else:
                 button_text = model_title
             
-            # Используем model_name для callback_data, так как это точное имя файла
+            # Короткий ID вместо имени файла: callback_data ограничена 64 байтами
             buttons.append([
                 InlineKeyboardButton(
                     text=button_text,
-                    callback_data=f"switch_model_{model_name}"
+                    callback_data=f"model:{make_model_id(model)}"
                 )
             ])
         
+        # Навигация по страницам
+        if pages > 1:
+            navigation = []
+            if page > 0:
+                navigation.append(InlineKeyboardButton(text="◀️", callback_data=f"models_page:{page - 1}"))
+            navigation.append(InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data="models_page:noop"))
+            if page < pages - 1:
+                navigation.append(InlineKeyboardButton(text="▶️", callback_data=f"models_page:{page + 1}"))
+            buttons.append(navigation)
+        
         # Добавляем кнопку "Назад"
         buttons.append([
             InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")
@@ -209,7 +264,7 @@ def get_models_keyboard():
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
         return keyboard
-        
+    
     except Exception as e:
         logging.error(f"Ошибка при создании клавиатуры моделей: {e}")
         # Возвращаем простую клавиатуру с ошибкой
@@ -225,7 +280,6 @@ def get_models_keyboard():
         )
         return keyboard
 
-
 # Функции для работы с очередью
 def get_stage_description(stage: GenerationStage) -> str:
     """Получает описание этапа генерации"""
@@ -239,184 +293,391 @@ def get_stage_description(stage: GenerationStage) -> str:
     }
     return descriptions.get(stage, "⏳ Обработка...")
 
-def get_stage_progress_range(stage: GenerationStage) -> tuple:
-    """Получает диапазон прогресса для этапа"""
-    ranges = {
-        GenerationStage.INITIALIZING: (0, 10),
-        GenerationStage.LOADING_MODEL: (10, 25),
-        GenerationStage.PROCESSING_PROMPT: (25, 35),
-        GenerationStage.GENERATING_IMAGE: (35, 85),
-        GenerationStage.ENCODING_RESULT: (85, 95),
-        GenerationStage.FINALIZING: (95, 100)
-    }
-    return ranges.get(stage, (0, 100))
-
-async def process_generation_queue():
-    """Обработчик очереди генерации с многопоточностью"""
-    while True:
-        try:
-            # Начинаем обработку следующей задачи
-            task = queue_manager.start_processing()
-            if task:
-                # Запускаем обработку задачи в отдельном потоке
-                if task.id not in active_tasks:
-                    active_tasks[task.id] = True
-                    asyncio.create_task(process_task_async(task))
-            else:
-                # Нет задач в очереди, ждем
-                await asyncio.sleep(1)
-        except Exception as e:
-            logging.error(f"Ошибка в обработке очереди: {e}")
-            await asyncio.sleep(5)
-
-async def process_task_async(task):
-    """Асинхронная обработка задачи с многопоточностью"""
+async def process_batch_async(tasks):
+    """Асинхронная обработка пакета задач и доставка результатов"""
     try:
-        # Запускаем генерацию в отдельном потоке
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(generation_executor, process_task_sync, task)
-        
+        # Запросы к SD WebUI выполняются асинхронно и не блокируют event loop
+        results = await process_batch(tasks)
+    except Exception as e:
+        logging.error(f"Ошибка при обработке пакета задач: {e}")
+        for task in tasks:
+            queue_manager.fail_task(task.id, str(e))
+        results = [None] * len(tasks)
+    
+    # Кодирование для Telegram — в пуле процессов, параллельно для всего пакета
+    await asyncio.gather(*(prepare_result(result) for result in results if result))
+    
+    for task, result in zip(tasks, results):
         if result:
             # Отправляем результат пользователю
             await send_generation_result(task, result)
+            await cache_generation_result(task, result)
+            # Изображение больше не нужно: на задаче остаются только seed и параметры
+            release_result_image(result)
+        elif task.status in (GenerationStatus.QUEUED, GenerationStatus.CANCELLED):
+            # Задача вернулась в очередь после сбоя WebUI и будет выполнена позже или отменена
+            continue
         else:
-            await send_generation_error(task, "Ошибка при генерации изображения")
-            
+            await send_generation_error(task, task.error or "Ошибка при генерации изображения")
+
+async def prepare_result(result: dict):
+    """Готовит результат к отправке: ключи file_id по хэшу изображения и, если файл еще не загружался, фото"""
+    try:
+        digest = await asyncio.to_thread(file_digest, result['image'])
+        result['file_keys'] = {
+            'photo': make_file_key(digest, f"photo:{image_postprocessor.photo_variant}"),
+            'document': make_file_key(digest, 'document'),
+        }
     except Exception as e:
-        logging.error(f"Ошибка при обработке задачи {task.id}: {e}")
-        queue_manager.fail_task(task.id, str(e))
-        await send_generation_error(task, str(e))
-    finally:
-        # Удаляем задачу из активных
-        active_tasks.pop(task.id, None)
+        logging.error(f"Ошибка при вычислении хэша изображения: {e}")
+        result['file_keys'] = {}
+    
+    # Уже загруженное изображение уйдет по file_id, перекодирование не нужно
+    keys = result['file_keys']
+    if keys and keys['photo'] in file_id_cache and (not image_postprocessor.send_original or keys['document'] in file_id_cache):
+        return
+    await prepare_upload(result)
 
-def process_task_sync(task):
-    """Синхронная обработка задачи в отдельном потоке"""
+async def prepare_upload(result: dict):
+    """Готовит фото для загрузки (image_postprocess); при ошибке будет отправлен исходный PNG"""
     try:
-        # Этап 1: Инициализация
-        queue_manager.update_task_progress(task.id, GenerationStage.INITIALIZING, 5)
-        time.sleep(0.5)
-        
-        # Этап 2: Загрузка модели
-        queue_manager.update_task_progress(task.id, GenerationStage.LOADING_MODEL, 15)
-        time.sleep(1)
-        
-        # Этап 3: Обработка промпта
-        queue_manager.update_task_progress(task.id, GenerationStage.PROCESSING_PROMPT, 30)
-        time.sleep(0.5)
-        
-        # Улучшаем промпт автоматически
-        enhanced_prompt = enhance_prompt(task.prompt)
-        enhanced_negative = get_default_negative_prompt()
-        
-        # Этап 4: Генерация изображения
-        queue_manager.update_task_progress(task.id, GenerationStage.GENERATING_IMAGE, 40)
-        
-        # Симуляция прогресса генерации
-        for progress in range(40, 85, 5):
-            queue_manager.update_task_progress(task.id, GenerationStage.GENERATING_IMAGE, progress)
-            time.sleep(0.3)
+        result['prepared'] = await image_postprocessor.prepare(result['image'])
+    except Exception as e:
+        logging.error(f"Ошибка при постобработке изображения: {e}")
+        result['prepared'] = None
+
+async def get_result_upload(result: dict, kind: str):
+    """Файл результата для загрузки в Telegram ('photo' или 'document'); None — такой вид отправки недоступен"""
+    if 'prepared' not in result:
+        await prepare_upload(result)
+    prepared = result['prepared']
+    if prepared is None:
+        # Постобработка не удалась — фото отправляется исходным PNG
+        return SpooledInputFile(result['image'], filename="generated.png") if kind == 'photo' else None
+    data, filename = (prepared.photo, prepared.photo_filename) if kind == 'photo' else (prepared.document, "generated.png")
+    return types.BufferedInputFile(data, filename=filename) if data is not None else None
+
+async def send_result_file(chat_id: int, result: dict, kind: str, **kwargs) -> bool:
+    """Отправляет фото или документ результата, по file_id, если файл уже загружался.
+    
+    Returns:
+        bool: False, если такой вид отправки для изображения недоступен
+    """
+    send_method = bot.send_photo if kind == 'photo' else bot.send_document
+    key = result.get('file_keys', {}).get(kind)
+    file_id = file_id_cache.get(key) if key else None
+    if file_id is not None:
+        try:
+            await message_updater.call(chat_id, lambda: send_method(chat_id=chat_id, **{kind: file_id}, **kwargs))
+            return True
+        except TelegramBadRequest as e:
+            # file_id устарел или выдан другому боту — загружаем файл заново
+            logging.warning(f"Telegram отклонил file_id ({e.message}), файл будет загружен заново")
+            file_id_cache.discard(key)
+    
+    upload = await get_result_upload(result, kind)
+    if upload is None:
+        return False
+    sent = await message_updater.call(chat_id, lambda: send_method(chat_id=chat_id, **{kind: upload}, **kwargs))
+    uploaded = sent.photo[-1] if kind == 'photo' and sent.photo else sent.document
+    if key and uploaded is not None:
+        file_id_cache.put(key, uploaded.file_id)
+    return True
+
+def release_result_image(result: dict):
+    """Освобождает память (или временный файл) изображения доставленного результата"""
+    result.pop('prepared', None)
+    result.pop('file_keys', None)
+    image = result.get('image')
+    if image is not None:
+        image.close()
+        result['image'] = None
+    image_path = result.pop('image_path', None)
+    if image_path:
+        # Файл результата от worker больше не нужен
+        try:
+            os.remove(image_path)
+        except OSError:
+            pass
+
+def get_generation_prompts(prompt: str, parameters: dict | None) -> tuple:
+    """Возвращает итоговые промпт и негативный промпт для исходного промпта и параметров"""
+    parameters = parameters or {}
+    if parameters.get('enhance_prompt', True):
+        prompt = enhance_prompt(prompt)
+    negative_prompt = parameters.get('negative_prompt', get_default_negative_prompt())
+    return prompt, negative_prompt
+
+def get_task_prompts(task) -> tuple:
+    """Возвращает итоговые промпт и негативный промпт задачи"""
+    return get_generation_prompts(task.prompt, task.parameters)
+
+async def get_cache_model(parameters: dict | None):
+    """Модель, под которой результат попадает в кэш"""
+    return (parameters or {}).get('model') or await sd_client.get_current_model()
+
+def get_cache_key(prompt: str, parameters: dict | None, model, seed: int) -> str:
+    """Ключ кэша результата для промпта и параметров задачи"""
+    enhanced_prompt, negative_prompt = get_generation_prompts(prompt, parameters)
+    return make_cache_key(model, enhanced_prompt, negative_prompt, parameters, seed)
+
+async def cache_generation_result(task, result):
+    """Сохраняет доставленный результат в кэш"""
+    if result_cache is None:
+        return
+    try:
+        requested_seed = int((task.parameters or {}).get('seed', -1))
+        key = get_cache_key(task.prompt, task.parameters, result.get('model'), result['seed'])
+        # Запрос со случайным seed запоминается как псевдоним фактического seed
+        alias = get_cache_key(task.prompt, task.parameters, result.get('model'), -1) if requested_seed == -1 else None
+        await result_cache.put(key, result['image'], {'seed': result['seed'], 'parameters': result.get('parameters')}, alias=alias)
+    except Exception as e:
+        logging.error(f"Ошибка при сохранении результата в кэш: {e}")
+
+def report_progress(tasks):
+    """Callback прогресса генерации, обновляющий все задачи пакета"""
+    def on_progress(stage: GenerationStage, progress: float, eta: float | None):
+        for task in tasks:
+            queue_manager.update_task_progress(task.id, stage, progress, eta=eta)
+    return on_progress
+
+def build_generation_request(tasks) -> tuple:
+    """Промпт (или список промптов) и параметры txt2img для пакета задач"""
+    # Улучшаем промпты автоматически; негативный промпт у задач пакета общий
+    prompts = [get_task_prompts(task)[0] for task in tasks]
+    enhanced_negative = get_task_prompts(tasks[0])[1]
+    
+    # Подготавливаем параметры с улучшенными промптами
+    generation_params = dict(tasks[0].parameters or {})
+    generation_params.pop('enhance_prompt', None)
+    generation_params['negative_prompt'] = enhanced_negative
+    if len(tasks) > 1:
+        generation_params['batch_size'] = len(tasks)
+    
+    # Одинаковые промпты генерируются через batch_size, разные — списком промптов
+    prompt = prompts[0] if len(set(prompts)) == 1 else prompts
+    return prompt, generation_params
+
+async def process_batch(tasks) -> list:
+    """Генерирует пакет совместимых задач одним запросом txt2img и раздает изображения задачам.
+    
+    С GENERATION_BACKEND=broker запрос выполняет процесс worker.py, изображения приходят файлами.
+    """
+    try:
+        for task in tasks:
+            queue_manager.update_task_progress(task.id, GenerationStage.INITIALIZING, 5)
         
-        # Подготавливаем параметры с улучшенными промптами
-        generation_params = task.parameters or {}
-        generation_params['prompt'] = enhanced_prompt
-        generation_params['negative_prompt'] = enhanced_negative
+        prompt, generation_params = build_generation_request(tasks)
+        model = await get_cache_model(generation_params)
+        if broker_client is not None:
+            # Пакет запоминается в задачах: после перезапуска бот дождется его, а не отправит заново
+            job_id = queue_manager.attach_job(tasks)
+            task_results, backend_failed = await broker_client.generate(prompt, generation_params, len(tasks),
+                                                                        report_progress(tasks), job_id=job_id)
+        else:
+            task_results, backend_failed = await generate_batch(sd_client, prompt, generation_params, len(tasks), report_progress(tasks))
         
-        # Генерируем изображение
-        result = sd_client.txt2img(enhanced_prompt, negative_prompt=enhanced_negative, **(task.parameters or {}))
+        if task_results is None:
+            # Отказ WebUI (сеть, 5xx, таймаут): задачи возвращаются в очередь и ждут его восстановления
+            for task in tasks:
+                if backend_failed and task.attempts < config.SD_MAX_RETRIES and queue_manager.requeue_task(task.id):
+                    logging.warning(f"Задача {task.id} возвращена в очередь после сбоя SD WebUI")
+                    continue
+                queue_manager.fail_task(task.id, "Ошибка при генерации изображения")
+            return [None] * len(tasks)
         
-        if result and 'images' in result:
-            # Этап 5: Кодирование результата
-            queue_manager.update_task_progress(task.id, GenerationStage.ENCODING_RESULT, 90)
-            time.sleep(0.5)
-            
-            # Этап 6: Финальная обработка
+        results = []
+        for task, task_result in zip(tasks, task_results):
+            if task.status == GenerationStatus.CANCELLED:
+                # Задачу отменили во время генерации пакета: ее изображение не доставляется и не кэшируется
+                release_result_image(task_result)
+                results.append(None)
+                continue
+            task_result['model'] = model
             queue_manager.update_task_progress(task.id, GenerationStage.FINALIZING, 100)
-            time.sleep(0.3)
             
             # Завершаем задачу
-            queue_manager.complete_task(task.id, result)
-            return result
-        else:
-            queue_manager.fail_task(task.id, "Ошибка при генерации изображения")
-            return None
-            
+            queue_manager.complete_task(task.id, task_result)
+            results.append(task_result)
+        return results
+    
     except Exception as e:
-        logging.error(f"Ошибка при обработке задачи {task.id}: {e}")
-        queue_manager.fail_task(task.id, str(e))
-        return None
-
-
+        logging.error(f"Ошибка при обработке задач {[task.id for task in tasks]}: {e}")
+        for task in tasks:
+            queue_manager.fail_task(task.id, str(e))
+        return [None] * len(tasks)
+
+async def process_task(task):
+    """Обработка одной задачи генерации"""
+    return (await process_batch([task]))[0]
+
+async def deliver_image(chat_id: int, prompt: str, parameters: dict | None, result: dict):
+    """Отправляет изображение с промптами и seed в подписи"""
+    # Получаем улучшенный промпт для отображения
+    enhanced_prompt, negative_prompt = get_generation_prompts(prompt, parameters)
+    source = "⚡ Результат из кэша" if result.get('cached') else "✅ Задача завершена успешно!"
+    caption = f"🎨 <b>Сгенерированное изображение</b>\n\n📝 Промпт: <code>{enhanced_prompt}</code>\n\n🚫 Негативный: <code>{negative_prompt}</code>\n\n🌱 Seed: <code>{result.get('seed', -1)}</code>\n\n{source}"
+    
+    prepared = result.get('prepared')
+    # Соотношение сторон недопустимо для фото — только документом
+    kind = 'document' if prepared is not None and prepared.photo is None else 'photo'
+    if not await send_result_file(chat_id, result, kind, caption=caption, reply_markup=get_main_keyboard(), parse_mode="HTML"):
+        raise ValueError("Изображение превышает лимиты Telegram")
+    if kind == 'photo' and image_postprocessor.send_original:
+        await send_result_file(chat_id, result, 'document', caption="🗂 Оригинал без сжатия")
 
 async def send_generation_result(task, result):
-    """Отправляет результат генерации пользователю"""
-    try:
-        # Декодируем изображение
-        image_data = base64.b64decode(result['images'][0])
-        image_bytes = io.BytesIO(image_data)
-        
-        # Получаем улучшенный промпт для отображения
-        enhanced_prompt = enhance_prompt(task.prompt)
-        negative_prompt = get_default_negative_prompt()
-        
-        # Отправляем изображение
-        await bot.send_photo(
-            chat_id=task.user_id,
-            photo=types.BufferedInputFile(image_bytes.getvalue(), filename="generated.png"),
-            caption=f"🎨 <b>Сгенерированное изображение</b>\n\n📝 Промпт: <code>{enhanced_prompt}</code>\n\n🚫 Негативный: <code>{negative_prompt}</code>\n\n✅ Задача завершена успешно!",
-            reply_markup=get_main_keyboard(),
-            parse_mode="HTML"
-        )
-    except Exception as e:
-        logging.error(f"Ошибка при отправке результата: {e}")
+    """Отправляет результат генерации во все чаты, ожидающие задачу"""
+    for subscriber in list(task.subscribers):
+        started = time.monotonic()
+        try:
+            await deliver_image(subscriber.chat_id, task.prompt, task.parameters, result)
+            metrics.delivery_seconds.observe(time.monotonic() - started, "ok")
+        except Exception as e:
+            metrics.delivery_seconds.observe(time.monotonic() - started, "error")
+            logging.error(f"Ошибка при отправке результата в чат {subscriber.chat_id}: {e}")
 
 async def send_generation_error(task, error):
-    """Отправляет сообщение об ошибке пользователю"""
+    """Отправляет сообщение об ошибке во все чаты, ожидающие задачу"""
+    # Получаем улучшенный промпт для отображения
+    enhanced_prompt, negative_prompt = get_task_prompts(task)
+    
+    for subscriber in list(task.subscribers):
+        try:
+            await message_updater.call(subscriber.chat_id, lambda chat_id=subscriber.chat_id: bot.send_message(
+                chat_id=chat_id,
+                text=f"❌ <b>Ошибка генерации</b>\n\n📝 Промпт: <code>{enhanced_prompt}</code>\n\n🚫 Негативный: <code>{negative_prompt}</code>\n\n🚫 Ошибка: {error}",
+                reply_markup=get_main_keyboard(),
+                parse_mode="HTML"
+            ))
+        except Exception as e:
+            logging.error(f"Ошибка при отправке ошибки в чат {subscriber.chat_id}: {e}")
+
+# Доступность WebUI в режиме broker отслеживают сами worker
+generation_dispatcher = GenerationDispatcher(queue_manager, process_batch_async,
+                                             backend=None if broker_client is not None else backend_health)
+
+async def enqueue_generation(message: types.Message, prompt: str, parameters: dict | None = None, details: str = ""):
+    """Добавляет задачу в очередь и запускает мониторинг ее прогресса.
+    
+    Если такой же запрос уже есть в кэше результатов, изображение отправляется сразу.
+    """
+    # Модель, выбранная пользователем, становится параметром его задачи
+    parameters = user_settings.apply(message.from_user.id, parameters)
+    if await send_cached_result(message, prompt, parameters):
+        return None
+    
     try:
-        # Получаем улучшенный промпт для отображения
-        enhanced_prompt = enhance_prompt(task.prompt)
-        negative_prompt = get_default_negative_prompt()
-        
-        await bot.send_message(
-            chat_id=task.user_id,
-            text=f"❌ <b>Ошибка генерации</b>\n\n📝 Промпт: <code>{enhanced_prompt}</code>\n\n🚫 Негативный: <code>{negative_prompt}</code>\n\n🚫 Ошибка: {error}",
-            reply_markup=get_main_keyboard(),
-            parse_mode="HTML"
-        )
-    except Exception as e:
-        logging.error(f"Ошибка при отправке ошибки: {e}")
+        task = queue_manager.add_task(message.from_user.id, prompt, parameters, chat_id=message.chat.id)
+    except AdmissionRejected as e:
+        await message.answer(f"⏳ {e} Повторите примерно через {math.ceil(e.retry_after)} с.",
+                             reply_markup=get_main_keyboard())
+        return None
+    subscriber = task.get_subscriber(message.chat.id)
+    if subscriber.status_message_id is not None:
+        # Повторное нажатие: в этом чате уже ждут такой же результат
+        await message.answer("⏳ Такой запрос уже в работе, результат придет в этот чат.")
+        return task
+    
+    queue_position = queue_manager.get_queue_position(task.id)
+    shared = "👥 Такой же запрос уже генерируется — результат придет всем ожидающим.\n\n" if len(task.subscribers) > 1 else ""
+    
+    # Отправляем сообщение о добавлении в очередь
+    status_msg = await message.answer(
+        f"📋 <b>Задача добавлена в очередь</b>\n\n"
+        f"{details}"
+        f"{shared}"
+        f"📝 Промпт: <code>{prompt}</code>\n\n"
+        f"📊 {format_queue_position(queue_position)}\n"
+        f"{get_backend_warning()}"
+        f"⏳ Ожидание обработки...",
+        reply_markup=get_generation_keyboard(task.id),
+        parse_mode="HTML"
+    )
+    
+    queue_manager.attach_status_message(task.id, status_msg.chat.id, status_msg.message_id)
+    
+    # Обработку запустит диспетчер очереди, здесь только мониторинг прогресса
+    asyncio.create_task(monitor_task_progress(task, subscriber))
+    return task
+
+async def send_cached_result(message: types.Message, prompt: str, parameters: dict | None) -> bool:
+    """Отправляет результат из кэша, если он есть. Возвращает True при попадании"""
+    if result_cache is None:
+        return False
+    seed = int((parameters or {}).get('seed', -1))
+    # Случайный seed по умолчанию означает новое изображение
+    if seed == -1 and not config.RESULT_CACHE_RANDOM_SEED_HITS:
+        return False
+    
+    model = await get_cache_model(parameters)
+    cached = await result_cache.get(get_cache_key(prompt, parameters, model, seed))
+    if cached is None:
+        return False
+    try:
+        await prepare_result(cached)
+        await deliver_image(message.chat.id, prompt, parameters, cached)
+    finally:
+        release_result_image(cached)
+    return True
 
-async def monitor_task_progress(task, status_msg):
-    """Мониторинг прогресса задачи в фоне"""
+def get_backend_warning() -> str:
+    """Предупреждение для сообщений статуса, пока WebUI недоступен"""
+    if backend_health.state == BackendState.DOWN:
+        return "⚠️ WebUI сейчас недоступен — задача дождется его восстановления\n"
+    return ""
+
+def format_queue_position(queue_position: int) -> str:
+    """Позиция в очереди; кроме fifo политика переставляет задачи, и число задач впереди примерное"""
+    if queue_manager.policy.arrival_order:
+        return f"Позиция в очереди: {queue_position}"
+    return f"Задач впереди: ~{queue_position - 1}"
+
+async def monitor_task_progress(task, subscriber):
+    """Мониторинг прогресса задачи в фоне (по сообщению статуса подписчика)"""
+    if subscriber.status_message_id is None:
+        return
     try:
-        # Обновляем сообщение каждые 2 секунды во время ожидания в очереди
-        while task.status == GenerationStatus.QUEUED:
-            await asyncio.sleep(2)
-            queue_position = queue_manager.get_queue_position(task.id)
-            if queue_position > 0:
-                await status_msg.edit_text(
-                    f"📋 <b>Ожидание в очереди</b>\n\n"
-                    f"📝 Промпт: <code>{task.prompt}</code>\n\n"
-                    f"📊 Позиция в очереди: {queue_position}\n"
-                    f"⏳ Ожидание обработки...",
-                    reply_markup=get_generation_keyboard(task.id),
-                    parse_mode="HTML"
-                )
-            else:
-                break
-        
-        # Обновляем прогресс во время обработки
-        while task.status == GenerationStatus.PROCESSING:
-            await update_progress_message(task, status_msg)
-            await asyncio.sleep(1)
+        # Задача возвращается в очередь, если WebUI отказал во время ее генерации
+        while task.status in (GenerationStatus.QUEUED, GenerationStatus.PROCESSING):
+            # Обновляем сообщение каждые 2 секунды во время ожидания в очереди
+            while task.status == GenerationStatus.QUEUED:
+                await asyncio.sleep(2)
+                if subscriber not in task.subscribers:
+                    return
+                queue_position = queue_manager.get_queue_position(task.id)
+                if queue_position > 0:
+                    # Одинаковый текст не отправляется повторно, частые правки схлопываются
+                    message_updater.edit_text(
+                        subscriber.chat_id,
+                        subscriber.status_message_id,
+                        (
+                            f"📋 <b>Ожидание в очереди</b>\n\n"
+                            f"📝 Промпт: <code>{task.prompt}</code>\n\n"
+                            f"📊 {format_queue_position(queue_position)}\n"
+                            f"{get_backend_warning()}"
+                            f"⏳ Ожидание обработки..."
+                        ),
+                        reply_markup=get_generation_keyboard(task.id),
+                        priority=Priority.STATUS
+                    )
+                else:
+                    break
             
-        # Удаляем сообщение о прогрессе
-        await status_msg.delete()
+            # Обновляем прогресс во время обработки
+            while task.status == GenerationStatus.PROCESSING:
+                if subscriber not in task.subscribers:
+                    return
+                await update_progress_message(task, subscriber)
+                await asyncio.sleep(1)
         
+        # Удаляем сообщение о прогрессе
+        message_updater.delete_message(subscriber.chat_id, subscriber.status_message_id)
+    
     except Exception as e:
         logging.error(f"Ошибка при мониторинге прогресса: {e}")
 
-async def update_progress_message(task, message):
+async def update_progress_message(task, subscriber):
     """Обновляет сообщение с прогрессом"""
     try:
         stage_desc = get_stage_description(task.stage)
@@ -426,25 +687,50 @@ async def update_progress_message(task, message):
         queue_position = queue_manager.get_queue_position(task.id)
         queue_info = ""
         if queue_position > 0:
-            queue_info = f"\n📋 Позиция в очереди: {queue_position}"
+            queue_info = f"\n📋 {format_queue_position(queue_position)}"
+        
+        eta_info = ""
+        if task.eta:
+            eta_info = f"\n⏱ Осталось: ~{int(task.eta)} сек."
         
         status_text = f"""
 🎨 <b>Генерация изображения...</b>
 
 📝 Промпт: <code>{task.prompt}</code>
 {stage_desc}
-⏳ Прогресс: {progress_percent}%
+⏳ Прогресс: {progress_percent}%{eta_info}
 {queue_info}
         """
         
-        await message.edit_text(
+        message_updater.edit_text(
+            subscriber.chat_id,
+            subscriber.status_message_id,
             status_text,
-            reply_markup=get_generation_keyboard(task.id),
-            parse_mode="HTML"
+            reply_markup=get_generation_keyboard(task.id)
         )
     except Exception as e:
         logging.error(f"Ошибка при обновлении прогресса: {e}")
 
+def get_backend_status_text() -> str:
+    """Строка с задержкой и долей ошибок WebUI для /status"""
+    stats = backend_health.stats()
+    latency = f"{stats['latency'] * 1000:.0f} мс" if stats['latency'] is not None else "нет данных"
+    return f"📡 Отклик: <code>{latency}</code>, ошибки: <code>{stats['error_rate']:.0%}</code>"
+
+def get_cache_status_text() -> str:
+    """Блок статистики кэша результатов и file_id для /status"""
+    file_ids = file_id_cache.stats()
+    file_id_text = f"• Отправлено без загрузки (file_id): <code>{file_ids['hits']}</code>, записей: <code>{file_ids['entries']}</code>\n"
+    if result_cache is None:
+        return f"\n💾 <b>Кэш:</b>\n{file_id_text}"
+    stats = result_cache.stats()
+    return (
+        f"\n💾 <b>Кэш результатов:</b>\n"
+        f"• Попадания / промахи: <code>{stats['hits']} / {stats['misses']}</code> ({stats['hit_rate']:.0%})\n"
+        f"• Записей: <code>{stats['entries']}</code>, размер: <code>{stats['size_mb']:.1f} МБ</code>\n"
+        f"{file_id_text}"
+    )
+
 # Команды
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
@@ -465,7 +751,7 @@ async def cmd_start(message: types.Message):
 • 📊 Статус SD - проверить состояние WebUI
 • 📋 Модели - список доступных моделей
 • 🎲 Сэмплеры - выбор алгоритма генерации
-• 🔄 Сменить модель - переключение между моделями
+• 🔄 Сменить модель - выбор модели для ваших генераций
 • 📋 Мои задачи - просмотр ваших задач
 • 📊 Очередь - информация о очереди
 • ⚙️ Настройки - настройка параметров по умолчанию
@@ -513,7 +799,7 @@ async def cmd_help(message: types.Message):
 
 🔄 <b>Управление моделями:</b>
 • 📋 Модели - список доступных моделей
-• 🔄 Сменить модель - переключение между моделями
+• 🔄 Сменить модель - выбор модели для ваших генераций
 • 🎲 Сэмплеры - список доступных алгоритмов
     """
     await message.answer(help_text, reply_markup=get_main_keyboard(), parse_mode="HTML")
@@ -524,34 +810,38 @@ async def cmd_status(message: types.Message):
     log_user_message(message)
     status_msg = await message.answer("🔍 Проверяю статус Stable Diffusion WebUI...")
     
-    if sd_client.is_available():
-        models = sd_client.get_models()
+    # Состояние берется из фонового монитора, без запроса к WebUI
+    if backend_health.state != BackendState.DOWN:
+        models = await model_catalog.get_models()
         if models:
-            current_model = next((m for m in models if m.get('title')), None)
-            model_name = current_model.get('title', 'Неизвестно') if current_model else 'Неизвестно'
+            model_name = await model_catalog.get_current_model() or 'Неизвестно'
             
             # Получаем информацию о очереди
             queue_info = queue_manager.get_queue_info()
             
             status_text = f"""
-✅ <b>Stable Diffusion WebUI доступен!</b>
+{'✅ <b>Stable Diffusion WebUI доступен!</b>' if backend_health.state == BackendState.UP else '⚠️ <b>Stable Diffusion WebUI отвечает с перебоями</b>'}
 
 🌐 URL: <code>{sd_client.base_url}</code>
-🤖 Текущая модель: <code>{model_name}</code>
+{get_backend_status_text()}
+🤖 Загруженная модель: <code>{model_name}</code>
 📊 Всего моделей: <code>{len(models)}</code>
+🧩 LoRA: <code>{len(model_catalog.loras)}</code>
 
 📋 <b>Статистика очереди:</b>
 • Задач в очереди: <code>{queue_info['queue_length']}</code>
 • Обрабатывается: <code>{'Да' if queue_info['processing'] else 'Нет'}</code>
 • Всего задач: <code>{queue_info['total_tasks']}</code>
 • Завершено: <code>{queue_info['completed_tasks']}</code>
-            """
+{get_cache_status_text()}            """
         else:
             status_text = "✅ Stable Diffusion WebUI доступен, но не удалось получить список моделей"
     else:
-        status_text = """
+        status_text = f"""
 ❌ <b>Stable Diffusion WebUI недоступен!</b>
 
+📋 Задачи в очереди (<code>{queue_manager.get_queue_info()['queue_length']}</code>) дождутся его восстановления.
+
 Убедитесь, что:
 1. SD WebUI запущен
 2. API включен (--api флаг)
@@ -652,25 +942,17 @@ async def handle_samplers(message: types.Message):
 async def handle_switch_model(message: types.Message):
     """Обработка кнопки смены модели"""
     log_user_message(message)
-    # Получаем текущую модель
-    current_model = "Неизвестно"
-    try:
-        models = sd_client.get_models()
-        if models:
-            current_model_obj = next((m for m in models if m.get('title')), None)
-            if current_model_obj:
-                current_model = current_model_obj.get('title', 'Неизвестно')
-    except:
-        pass
+    # Модель выбирается для задач пользователя и не влияет на задачи других
+    current_model = user_settings.get_model(message.from_user.id) or "по умолчанию"
     
     await message.answer(
         f"🔄 <b>Выбор модели</b>\n\n"
-        f"Выберите модель для переключения:\n\n"
+        f"Выберите модель для ваших генераций:\n\n"
         f"💡 <b>Советы:</b>\n"
         f"• ⭐ отмечена стандартная модель\n"
-        f"• Переключение может занять несколько секунд\n"
-        f"• Текущая модель: <code>{current_model}</code>",
-        reply_markup=get_models_keyboard(),
+        f"• Модель загружается между задачами, первая генерация может занять больше времени\n"
+        f"• Ваша модель: <code>{current_model}</code>",
+        reply_markup=await get_models_keyboard(),
         parse_mode="HTML"
     )
 
@@ -718,9 +1000,10 @@ async def handle_queue_info(message: types.Message):
 🔄 Обрабатывается: <code>{'Да' if queue_info['processing'] else 'Нет'}</code>
 📈 Всего задач: <code>{queue_info['total_tasks']}</code>
 ✅ Завершено: <code>{queue_info['completed_tasks']}</code>
+⚖️ Планировщик: <code>{queue_info['policy']}</code>
 
 💡 <b>Советы:</b>
-• Задачи обрабатываются по очереди
+• Задачи разных пользователей чередуются согласно планировщику
 • Можно отменить задачу во время генерации
 • Используйте "Мои задачи" для просмотра статуса
     """
@@ -749,57 +1032,63 @@ async def back_to_main(callback: types.CallbackQuery):
         await callback.message.answer("Выберите действие:", reply_markup=get_main_keyboard())
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("switch_model_"))
+@dp.callback_query(F.data.startswith("models_page:"))
+async def handle_models_page(callback: types.CallbackQuery):
+    """Переход между страницами клавиатуры моделей"""
+    log_user_callback(callback)
+    page = callback.data.split(":", 1)[1]
+    if callback.message and page.isdigit():
+        await callback.message.edit_reply_markup(reply_markup=await get_models_keyboard(int(page)))
+    await callback.answer()
+
+@dp.callback_query(F.data.startswith("model:") | F.data.startswith("switch_model_"))
 async def handle_model_switch(callback: types.CallbackQuery):
     """Обработка смены модели"""
     log_user_callback(callback)
     if callback.data and callback.message:
-        model_name = callback.data.replace("switch_model_", "")
+        # model:<id> — кнопки каталога, switch_model_<имя> — стандартная модель и старые клавиатуры
+        if callback.data.startswith("model:"):
+            model = await model_catalog.find(callback.data.split(":", 1)[1])
+            model_name = model.get('model_name', model.get('title')) if model else "Неизвестно"
+        else:
+            model_name = callback.data.replace("switch_model_", "")
+            model = await model_catalog.find_by_name(model_name)
         
         try:
-            # Показываем сообщение о переключении
-            await callback.message.edit_text(
-                f"🔄 <b>Переключение модели...</b>\n\n"
-                f"Модель: <code>{model_name}</code>\n"
-                f"⏳ Пожалуйста, подождите...",
-                parse_mode="HTML"
-            )
+            # Логируем выбор модели
+            logging.info(f"Пользователь {callback.from_user.id} выбирает модель: {model_name}")
             
-            # Логируем попытку смены модели
-            logging.info(f"Попытка смены модели на: {model_name}")
-            
-            # Переключаем модель
-            success = sd_client.switch_model(model_name)
+            # Модель не переключается глобально: она станет параметром задач пользователя
+            success = model is not None
             
             if success:
-                logging.info(f"Модель успешно переключена на: {model_name}")
+                user_settings.set_model(callback.from_user.id, model_name)
                 await callback.message.edit_text(
-                    f"✅ <b>Модель успешно переключена!</b>\n\n"
+                    f"✅ <b>Модель выбрана!</b>\n\n"
                     f"Новая модель: <code>{model_name}</code>\n\n"
-                    f"Теперь можно создавать изображения с новой моделью.",
+                    f"Ваши следующие изображения будут созданы с этой моделью.",
                     parse_mode="HTML"
                 )
                 # Отправляем новое сообщение с главной клавиатурой
                 await callback.message.answer("Выберите действие:", reply_markup=get_main_keyboard())
             else:
-                logging.error(f"Не удалось переключить модель на: {model_name}")
+                logging.error(f"Не удалось выбрать модель: {model_name}")
                 await callback.message.edit_text(
-                    f"❌ <b>Ошибка переключения модели</b>\n\n"
+                    f"❌ <b>Ошибка выбора модели</b>\n\n"
                     f"Модель: <code>{model_name}</code>\n"
-                    f"Не удалось переключить модель. Попробуйте еще раз.\n\n"
+                    f"Не удалось выбрать модель. Попробуйте еще раз.\n\n"
                     f"💡 <b>Возможные причины:</b>\n"
                     f"• Модель не найдена в списке\n"
-                    f"• WebUI не отвечает\n"
-                    f"• Недостаточно памяти",
+                    f"• WebUI не отвечает",
                     parse_mode="HTML"
                 )
                 # Отправляем новое сообщение с главной клавиатурой
                 await callback.message.answer("Выберите действие:", reply_markup=get_main_keyboard())
-                
+        
         except Exception as e:
-            logging.error(f"Исключение при переключении модели {model_name}: {e}")
+            logging.error(f"Исключение при выборе модели {model_name}: {e}")
             await callback.message.edit_text(
-                f"❌ <b>Ошибка при переключении модели</b>\n\n"
+                f"❌ <b>Ошибка при выборе модели</b>\n\n"
                 f"Модель: <code>{model_name}</code>\n"
                 f"Ошибка: <code>{str(e)}</code>\n\n"
                 f"Попробуйте еще раз или обратитесь к администратору.",
@@ -824,10 +1113,13 @@ async def cancel_generation(callback: types.CallbackQuery, state: FSMContext):
                 await callback.message.edit_text("❌ Простая генерация отменена")
                 await callback.message.answer("Выберите действие:", reply_markup=get_main_keyboard())
         else:
-            # Отмена задачи в очереди
-            if queue_manager.cancel_task(task_id):
+            # Отмена задачи в очереди: генерация отменяется, только если больше никто ее не ждет
+            chat_id = callback.message.chat.id if callback.message else None
+            if queue_manager.cancel_task(task_id, chat_id=chat_id):
                 if callback.message:
-                    await callback.message.edit_text("❌ Генерация отменена")
+                    # Через планировщик: отложенная правка прогресса не перезапишет отмену
+                    message_updater.edit_text(chat_id, callback.message.message_id, "❌ Генерация отменена",
+                                              parse_mode=None, priority=Priority.STATUS)
             else:
                 if callback.message:
                     await callback.message.edit_text("❌ Не удалось отменить задачу")
@@ -849,56 +1141,9 @@ async def handle_prompt(message: types.Message, state: FSMContext):
     # Сохраняем промпт
     await state.update_data(prompt=prompt)
     
-    # Проверяем доступность SD
-    if not sd_client.is_available():
-        await message.answer("❌ Stable Diffusion WebUI недоступен. Проверьте, что он запущен.", reply_markup=get_main_keyboard())
-        await state.clear()
-        return
-    
     try:
-        # Добавляем задачу в очередь
-        task = queue_manager.add_task(message.from_user.id, prompt)
-        queue_position = queue_manager.get_queue_position(task.id)
-        
-        # Отправляем сообщение о добавлении в очередь
-        status_msg = await message.answer(
-            f"📋 <b>Задача добавлена в очередь</b>\n\n"
-            f"📝 Промпт: <code>{prompt}</code>\n\n"
-            f"📊 Позиция в очереди: {queue_position}\n"
-            f"⏳ Ожидание обработки...",
-            reply_markup=get_generation_keyboard(task.id),
-            parse_mode="HTML"
-        )
-        
-        # Если это первая задача, начинаем обработку
-        if queue_position == 1:
-            # Запускаем обработку очереди в фоне
-            asyncio.create_task(process_generation_queue())
-        
-        # Обновляем сообщение каждые 2 секунды
-        while task.status == GenerationStatus.QUEUED:
-            await asyncio.sleep(2)
-            queue_position = queue_manager.get_queue_position(task.id)
-            if queue_position > 0:
-                await status_msg.edit_text(
-                    f"📋 <b>Ожидание в очереди</b>\n\n"
-                    f"📝 Промпт: <code>{prompt}</code>\n\n"
-                    f"📊 Позиция в очереди: {queue_position}\n"
-                    f"⏳ Ожидание обработки...",
-                    reply_markup=get_generation_keyboard(task.id),
-                    parse_mode="HTML"
-                )
-            else:
-                break
-        
-        # Обновляем прогресс во время обработки
-        while task.status == GenerationStatus.PROCESSING:
-            await update_progress_message(task, status_msg)
-            await asyncio.sleep(1)
-            
-        # Удаляем сообщение о прогрессе
-        await status_msg.delete()
-        
+        await enqueue_generation(message, prompt)
+    
     except Exception as e:
         await message.answer(f"❌ Произошла ошибка: {str(e)}", reply_markup=get_main_keyboard())
     
@@ -1169,20 +1414,8 @@ async def handle_priority(message: types.Message, state: FSMContext):
     
     prompt = ", ".join(prompt_parts)
     
-    # Проверяем доступность SD
-    if not sd_client.is_available():
-        await message.answer("❌ Stable Diffusion WebUI недоступен. Проверьте, что он запущен.", reply_markup=get_main_keyboard())
-        await state.clear()
-        return
-    
     try:
-        # Добавляем задачу в очередь
-        task = queue_manager.add_task(message.from_user.id, prompt)
-        queue_position = queue_manager.get_queue_position(task.id)
-        
-        # Отправляем сообщение о добавлении в очередь
-        status_msg = await message.answer(
-            f"📋 <b>Задача добавлена в очередь</b>\n\n"
+        details = (
             f"🎨 <b>Созданный персонаж:</b>\n"
             f"• Вид: {animal_type}\n"
             f"• Пол: {gender}\n"
@@ -1193,19 +1426,9 @@ async def handle_priority(message: types.Message, state: FSMContext):
             f"• Местность: {location}\n"
             f"• Действие: {activity}\n"
             f"• Приоритет: {priority} ({weight:.1f})\n\n"
-            f"📝 <b>Промпт:</b> <code>{prompt}</code>\n\n"
-            f"📊 Позиция в очереди: {queue_position}\n"
-            f"⏳ Ожидание обработки...",
-            reply_markup=get_generation_keyboard(task.id),
-            parse_mode="HTML"
         )
-        
-        # Запускаем обработку очереди в фоне (если еще не запущена)
-        asyncio.create_task(process_generation_queue())
-        
-        # Запускаем мониторинг прогресса в фоне
-        asyncio.create_task(monitor_task_progress(task, status_msg))
-        
+        await enqueue_generation(message, prompt, details=details)
+    
     except Exception as e:
         await message.answer(f"❌ Произошла ошибка: {str(e)}", reply_markup=get_main_keyboard())
     
@@ -1241,7 +1464,13 @@ async def handle_cfg_scale(message: types.Message, state: FSMContext):
 async def handle_size(message: types.Message, state: FSMContext):
     """Обработка размера изображения"""
     log_user_message(message)
-    await advanced_features.handle_size(message, state)
+    parameters = await advanced_features.handle_size(message, state)
+    if parameters:
+        try:
+            prompt = parameters.pop('prompt')
+            await enqueue_generation(message, prompt, parameters)
+        except Exception as e:
+            await message.answer(f"❌ Произошла ошибка: {str(e)}", reply_markup=get_main_keyboard())
 
 # Обработка обычных текстовых сообщений (автогенерация)
 @dp.message(F.text)
@@ -1250,57 +1479,93 @@ async def handle_text_message(message: types.Message):
     log_user_message(message)
     prompt = message.text
     
-    # Проверяем доступность SD
-    if not sd_client.is_available():
-        await message.answer("❌ Stable Diffusion WebUI недоступен. Проверьте, что он запущен.", reply_markup=get_main_keyboard())
-        return
-    
     try:
-        # Добавляем задачу в очередь
-        task = queue_manager.add_task(message.from_user.id, prompt)
-        queue_position = queue_manager.get_queue_position(task.id)
-        
-        # Отправляем сообщение о добавлении в очередь
-        status_msg = await message.answer(
-            f"📋 <b>Задача добавлена в очередь</b>\n\n"
-            f"📝 Промпт: <code>{prompt}</code>\n\n"
-            f"📊 Позиция в очереди: {queue_position}\n"
-            f"⏳ Ожидание обработки...",
-            reply_markup=get_generation_keyboard(task.id),
-            parse_mode="HTML"
-        )
-        
-        # Запускаем обработку очереди в фоне (если еще не запущена)
-        asyncio.create_task(process_generation_queue())
-        
-        # Запускаем мониторинг прогресса в фоне
-        asyncio.create_task(monitor_task_progress(task, status_msg))
-        
+        await enqueue_generation(message, prompt)
+    
     except Exception as e:
         await message.answer(f"❌ Произошла ошибка: {str(e)}", reply_markup=get_main_keyboard())
 
 # Обработка ошибок
 @dp.errors()
-async def errors_handler(update: types.Update, exception: Exception):
+async def errors_handler(event: types.ErrorEvent):
     """Обработчик ошибок"""
-    logging.error(f"Ошибка при обработке {update}: {exception}")
+    logging.error(f"Ошибка при обработке обновления {event.update.update_id}: {event.exception!r}")
     return True
 
+@dp.startup()
+async def on_startup():
+    """Запуск фоновых сервисов"""
+    if result_cache is not None:
+        await asyncio.to_thread(result_cache.load)
+    await asyncio.to_thread(file_id_cache.load)
+    await asyncio.to_thread(storage.load)
+    await message_updater.start()
+    if metrics_server is not None:
+        await metrics_server.start()
+    await image_postprocessor.start()
+    await model_catalog.start()
+    await backend_health.start()
+    if config.QUEUE_DB_PATH:
+        # Пакеты, отправленные в брокер до перезапуска, продолжают выполняться на worker
+        restored = queue_manager.open_store(SQLiteTaskStore(config.QUEUE_DB_PATH), resume_jobs=broker_client is not None)
+        if restored:
+            logging.info(f"Восстановлено задач из хранилища очереди: {len(restored)}")
+        # Возвращаем пользователям сообщения со статусом восстановленных задач
+        for task in restored:
+            for subscriber in task.subscribers:
+                asyncio.create_task(monitor_task_progress(task, subscriber))
+    resumed = queue_manager.processing_batches()
+    if broker_client is not None:
+        await broker_client.start(resume_jobs=[batch[0].job_id for batch in resumed.values()])
+    await generation_dispatcher.start()
+    for batch in resumed.values():
+        generation_dispatcher.resume(batch)
+
+@dp.shutdown()
+async def on_shutdown():
+    """Остановка фоновых сервисов"""
+    if broker_client is not None:
+        # Пакеты остаются в брокере и выполняются на worker, бот дождется их после перезапуска
+        broker_client.detach()
+    await generation_dispatcher.stop()
+    if broker_client is not None:
+        await broker_client.stop()
+    # Досылаем уже готовые результаты до закрытия сессии бота
+    await message_updater.stop()
+    await image_postprocessor.stop()
+    file_id_cache.close()
+    await model_catalog.stop()
+    await backend_health.stop()
+    if metrics_server is not None:
+        await metrics_server.stop()
+    await sd_client.close()
+    # Поллинг уже остановлен: дописываем отложенные состояния FSM
+    await storage.close()
+    if queue_manager.store is not None:
+        queue_manager.store.close()
+
 async def main():
     """Главная функция"""
     logging.info("🚀 Запуск расширенного бота с клавиатурой и очередью...")
     
     # Проверяем доступность SD WebUI
-    if sd_client.is_available():
+    if await sd_client.is_available():
         logging.info("✅ Stable Diffusion WebUI доступен")
     else:
         logging.warning("⚠️ Stable Diffusion WebUI недоступен")
     
-    # Запускаем обработку очереди в фоне
-    asyncio.create_task(process_generation_queue())
-    
-    # Запускаем бота
-    await dp.start_polling(bot)
+    # Запускаем бота (диспетчер очереди стартует в on_startup)
+    if config.BOT_MODE == "webhook":
+        await WebhookServer(dp, bot).run()
+    else:
+        # Оставшийся webhook не дает получать обновления через getUpdates
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
 
 if __name__ == "__main__":
-    asyncio.run(main()) 
\ No newline at end of file
+    # Логи и журнал событий пишет фоновый поток, а не event loop
+    events.start()
+    try:
+        asyncio.run(main())
+    finally:
+        events.stop() 
\ No newline at end of file
@@ -0,0 +1,430 @@
+"""
+Брокер пакетов генерации между ботом и процессами worker.py
+
+С GENERATION_BACKEND=broker бот только ставит пакеты в брокер и доставляет
+результаты, а генерацию на SD WebUI выполняют отдельные процессы worker.py.
+Бот можно перезапускать, не прерывая генерации: пакет задачи хранится в
+хранилище очереди (GenerationTask.job_id), после перезапуска бот дожидается
+тех же пакетов, а события, пришедшие без него, получает из брокера — они
+удаляются только после подтверждения. Тяжелая работа с изображениями не
+делит event loop с обработкой обновлений Telegram.
+
+Worker берет пакет в аренду (visibility timeout) и продлевает ее, пока
+работает. Если процесс упал, аренда истекает и пакет получает другой worker
+(не больше BROKER_MAX_ATTEMPTS раз). Прогресс и результат возвращаются
+событиями; изображения передаются путями к файлам в BROKER_FILES_DIR,
+а не внутри сообщений.
+
+Реализация выбирается по BROKER_URL (create_broker); встроенная —
+SQLiteBroker (sqlite:///путь), она не требует внешних сервисов.
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from config import (BROKER_FILES_DIR, BROKER_FILES_RETENTION_HOURS, BROKER_LEASE_SECONDS, BROKER_MAX_ATTEMPTS,
+                    BROKER_POLL_INTERVAL, BROKER_URL)
+from queue_manager import GenerationStage
+from sqlite_store import connect_sqlite
+
+@dataclass
+class Job:
+    """Пакет генерации, выданный worker в аренду"""
+    id: str
+    payload: Dict[str, Any]
+    attempts: int
+
+@dataclass
+class JobEvent:
+    """Событие пакета для бота: 'progress', 'result' или 'error'"""
+    seq: int
+    job_id: str
+    kind: str
+    payload: Dict[str, Any]
+
+class Broker(ABC):
+    """Очередь пакетов с арендой и обратным каналом событий.
+    
+    Новые реализации (например, сетевые) достаточно зарегистрировать в create_broker.
+    """
+    
+    @abstractmethod
+    async def submit(self, job_id: str, payload: Dict[str, Any]):
+        """Ставит пакет в очередь (сторона бота)"""
+    
+    @abstractmethod
+    async def cancel(self, job_id: str):
+        """Снимает пакет: результат его worker будет отброшен"""
+    
+    @abstractmethod
+    async def resume(self, job_ids: Iterable[str]) -> Set[str]:
+        """Снимает пакеты прошлого запуска бота, кроме job_ids; возвращает те из job_ids, что еще не завершены"""
+    
+    @abstractmethod
+    async def fetch_events(self, after_seq: int, limit: int = 100) -> List[JobEvent]:
+        """События с номером больше after_seq в порядке поступления"""
+    
+    @abstractmethod
+    async def ack_events(self, up_to_seq: int):
+        """Удаляет обработанные события"""
+    
+    @abstractmethod
+    async def lease(self, worker_id: str, lease_seconds: float) -> Optional[Job]:
+        """Выдает worker следующий пакет: новый или с истекшей арендой"""
+    
+    @abstractmethod
+    async def reap(self):
+        """Завершает ошибкой пакеты с истекшей арендой, исчерпавшие попытки (вызывают и worker, и бот)"""
+    
+    @abstractmethod
+    async def renew(self, job_id: str, worker_id: str, lease_seconds: float,
+                    progress: Optional[Dict[str, Any]] = None) -> bool:
+        """Продлевает аренду и публикует прогресс; False — пакет снят или передан другому worker"""
+    
+    @abstractmethod
+    async def finish(self, job_id: str, worker_id: str, kind: str, payload: Dict[str, Any]) -> bool:
+        """Завершает пакет событием 'result' или 'error'; False — аренда потеряна, результат не принят"""
+    
+    def close(self):
+        """Освобождает ресурсы брокера"""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    worker_id TEXT,
+    lease_expires_at REAL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_status_seq ON jobs (status, seq);
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL
+);
+"""
+
+class SQLiteBroker(Broker):
+    """Брокер на общей базе SQLite (WAL): бот и worker открывают один файл.
+    
+    Выдача в аренду идет в транзакции BEGIN IMMEDIATE, поэтому один пакет не
+    достанется двум процессам. Вызовы выполняются в потоках и не блокируют event loop.
+    """
+    
+    def __init__(self, path: str, max_attempts: int = BROKER_MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._conn = connect_sqlite(path)
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+    
+    async def _run(self, method: Callable, *args):
+        return await asyncio.to_thread(self._locked, method, *args)
+    
+    def _locked(self, method: Callable, *args):
+        with self._lock:
+            return method(*args)
+    
+    def _transaction(self, method: Callable, *args):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = method(*args)
+            self._conn.execute("COMMIT")
+            return result
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+    
+    def _add_event(self, job_id: str, kind: str, payload: Dict[str, Any]):
+        self._conn.execute("INSERT INTO events (job_id, kind, payload) VALUES (?, ?, ?)",
+                           (job_id, kind, json.dumps(payload, ensure_ascii=False)))
+    
+    async def submit(self, job_id: str, payload: Dict[str, Any]):
+        await self._run(self._submit, job_id, json.dumps(payload, ensure_ascii=False))
+    
+    def _submit(self, job_id: str, payload: str):
+        self._conn.execute(
+            "INSERT INTO jobs (id, seq, payload, status) VALUES (?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM jobs), ?, 'queued')",
+            (job_id, payload)
+        )
+    
+    async def cancel(self, job_id: str):
+        await self._run(self._conn.execute, "DELETE FROM jobs WHERE id = ?", (job_id,))
+    
+    async def resume(self, job_ids: Iterable[str]) -> Set[str]:
+        return await self._run(self._transaction, self._resume, set(job_ids))
+    
+    def _resume(self, job_ids: Set[str]) -> Set[str]:
+        existing = {job_id for (job_id,) in self._conn.execute("SELECT id FROM jobs")}
+        self._conn.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in existing - job_ids])
+        return existing & job_ids
+    
+    async def fetch_events(self, after_seq: int, limit: int = 100) -> List[JobEvent]:
+        rows = await self._run(self._fetch_events, after_seq, limit)
+        return [JobEvent(seq, job_id, kind, json.loads(payload)) for seq, job_id, kind, payload in rows]
+    
+    def _fetch_events(self, after_seq: int, limit: int) -> list:
+        return self._conn.execute(
+            "SELECT seq, job_id, kind, payload FROM events WHERE seq > ? ORDER BY seq LIMIT ?", (after_seq, limit)
+        ).fetchall()
+    
+    async def ack_events(self, up_to_seq: int):
+        await self._run(self._conn.execute, "DELETE FROM events WHERE seq <= ?", (up_to_seq,))
+    
+    async def lease(self, worker_id: str, lease_seconds: float) -> Optional[Job]:
+        row = await self._run(self._transaction, self._lease, worker_id, lease_seconds)
+        if row is None:
+            return None
+        job_id, payload, attempts = row
+        return Job(job_id, json.loads(payload), attempts)
+    
+    async def reap(self):
+        await self._run(self._transaction, self._reap, time.time())
+    
+    def _reap(self, now: float):
+        # Пакеты, чьи worker падали max_attempts раз, больше не выдаются
+        for (job_id,) in self._conn.execute(
+            "SELECT id FROM jobs WHERE status = 'leased' AND lease_expires_at < ? AND attempts >= ?",
+            (now, self.max_attempts)
+        ).fetchall():
+            self._conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            self._add_event(job_id, "error", {"error": "Обработчик генерации аварийно завершился", "backend_failed": False})
+    
+    def _lease(self, worker_id: str, lease_seconds: float) -> Optional[Tuple[str, str, int]]:
+        now = time.time()
+        self._reap(now)
+        
+        row = self._conn.execute(
+            "SELECT id, payload, attempts FROM jobs "
+            "WHERE status = 'queued' OR (status = 'leased' AND lease_expires_at < ?) ORDER BY seq LIMIT 1",
+            (now,)
+        ).fetchone()
+        if row is None:
+            return None
+        self._conn.execute(
+            "UPDATE jobs SET status = 'leased', worker_id = ?, lease_expires_at = ?, attempts = attempts + 1 WHERE id = ?",
+            (worker_id, now + lease_seconds, row[0])
+        )
+        return row[0], row[1], row[2] + 1
+    
+    async def renew(self, job_id: str, worker_id: str, lease_seconds: float,
+                    progress: Optional[Dict[str, Any]] = None) -> bool:
+        return await self._run(self._transaction, self._renew, job_id, worker_id, lease_seconds, progress)
+    
+    def _renew(self, job_id: str, worker_id: str, lease_seconds: float, progress: Optional[Dict[str, Any]]) -> bool:
+        cursor = self._conn.execute(
+            "UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND worker_id = ? AND status = 'leased'",
+            (time.time() + lease_seconds, job_id, worker_id)
+        )
+        if not cursor.rowcount:
+            return False
+        if progress is not None:
+            self._add_event(job_id, "progress", progress)
+        return True
+    
+    async def finish(self, job_id: str, worker_id: str, kind: str, payload: Dict[str, Any]) -> bool:
+        return await self._run(self._transaction, self._finish, job_id, worker_id, kind, payload)
+    
+    def _finish(self, job_id: str, worker_id: str, kind: str, payload: Dict[str, Any]) -> bool:
+        cursor = self._conn.execute("DELETE FROM jobs WHERE id = ? AND worker_id = ?", (job_id, worker_id))
+        if not cursor.rowcount:
+            return False
+        self._add_event(job_id, kind, payload)
+        return True
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def create_broker(url: str = BROKER_URL) -> Broker:
+    """Создает брокер по BROKER_URL (sqlite:///путь/к/базе.db)"""
+    if url.startswith("sqlite:///"):
+        return SQLiteBroker(url[len("sqlite:///"):])
+    raise ValueError(f"Неподдерживаемый BROKER_URL: {url}. Доступно: sqlite:///путь")
+
+def remove_result_files(payload: Dict[str, Any]):
+    """Удаляет файлы изображений результата, который не будет доставлен"""
+    for result in payload.get("results") or []:
+        try:
+            os.remove(result["image_path"])
+        except OSError:
+            pass
+
+def remove_stale_files(directory: str = BROKER_FILES_DIR, max_age: float = BROKER_FILES_RETENTION_HOURS * 3600):
+    """Удаляет файлы результатов, оставшиеся после аварийного завершения бота"""
+    if not os.path.isdir(directory):
+        return
+    deadline = time.time() - max_age
+    for entry in os.scandir(directory):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < deadline:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+class BrokerClient:
+    """Сторона бота: отправляет пакеты в брокер и ждет их события"""
+    
+    def __init__(self, broker: Broker, poll_interval: float = BROKER_POLL_INTERVAL,
+                 reap_interval: float = BROKER_LEASE_SECONDS):
+        self.broker = broker
+        self.poll_interval = poll_interval
+        # Как часто бот сам снимает брошенные пакеты: worker может не остаться ни одного
+        self.reap_interval = reap_interval
+        self._jobs: Dict[str, Tuple[asyncio.Future, Callable]] = {}
+        # Пакеты прошлого запуска, которые еще не забрал generate (None в результате — пакет потерян)
+        self._resumed: Dict[str, asyncio.Future] = {}
+        self._detached = False
+        self._last_seq = 0
+        self._runner: Optional[asyncio.Task] = None
+    
+    async def start(self, resume_jobs: Iterable[str] = ()):
+        """Запускает прием событий.
+        
+        resume_jobs — пакеты задач, восстановленных из хранилища очереди: они
+        продолжают выполняться на worker, generate с их job_id дожидается их
+        результата. Остальные пакеты прошлого запуска снимаются.
+        """
+        if self._runner is not None:
+            return
+        self._detached = False
+        loop = asyncio.get_running_loop()
+        resume_jobs = set(resume_jobs)
+        self._resumed = {job_id: loop.create_future() for job_id in resume_jobs}
+        alive = await self.broker.resume(resume_jobs)
+        # События пакетов, завершенных без бота, еще не подтверждены
+        await self._drain()
+        for job_id in resume_jobs - alive:
+            future = self._resumed[job_id]
+            if not future.done():
+                # Нет ни пакета, ни его события: задачи будут отправлены заново
+                future.set_result(None)
+        await asyncio.to_thread(remove_stale_files)
+        self._runner = asyncio.create_task(self._pump(), name="broker-events")
+        logging.info("Генерация выполняется процессами worker.py через брокер")
+    
+    def detach(self):
+        """Бот останавливается: ожидание пакетов прерывается, сами пакеты продолжают выполняться на worker"""
+        self._detached = True
+        for future, _ in self._jobs.values():
+            future.cancel()
+        for future in self._resumed.values():
+            future.cancel()
+        self._resumed.clear()
+    
+    async def stop(self):
+        """Останавливает прием событий"""
+        self.detach()
+        if self._runner is not None:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+        self.broker.close()
+    
+    async def generate(self, prompt, generation_params: Dict, count: int,
+                       on_progress: Callable[[GenerationStage, float, Optional[float]], None],
+                       job_id: Optional[str] = None) -> Tuple[Optional[List[Dict]], bool]:
+        """Выполняет пакет на worker; результат в формате generation.generate_batch (изображения — открытые файлы).
+        
+        job_id — пакет, отправленный до перезапуска бота (см. start): его результат
+        ожидается без повторной отправки.
+        """
+        if self._detached:
+            raise asyncio.CancelledError()
+        job_id = job_id or uuid.uuid4().hex
+        future = self._resumed.pop(job_id, None)
+        if future is not None and future.done() and future.result() is None:
+            future = None
+        submit = future is None
+        if submit:
+            future = asyncio.get_running_loop().create_future()
+        self._jobs[job_id] = (future, on_progress)
+        try:
+            if submit:
+                await self.broker.submit(job_id, {"prompt": prompt, "params": generation_params, "count": count})
+            payload = await future
+        except asyncio.CancelledError:
+            # Задачи отменены: пакет снимается, worker прерывает генерацию. При остановке
+            # бота (detach) пакет продолжает выполняться, задачи дождутся его после перезапуска
+            if not self._detached:
+                await asyncio.shield(self.broker.cancel(job_id))
+            raise
+        finally:
+            self._jobs.pop(job_id, None)
+        
+        results = payload.get("results")
+        if results is None:
+            logging.error(f"Пакет {job_id} не выполнен: {payload.get('error')}")
+            return None, bool(payload.get("backend_failed"))
+        try:
+            for result in results:
+                result["image"] = await asyncio.to_thread(open, result["image_path"], "rb")
+        except OSError as e:
+            logging.error(f"Файл результата пакета {job_id} недоступен: {e}")
+            for result in results:
+                if result.get("image") is not None:
+                    result["image"].close()
+            remove_result_files(payload)
+            return None, False
+        return results, False
+    
+    async def _poll(self) -> bool:
+        """Раздает новые события и подтверждает их; False — событий нет"""
+        events = await self.broker.fetch_events(self._last_seq)
+        for event in events:
+            self._dispatch(event)
+            self._last_seq = event.seq
+        if events:
+            await self.broker.ack_events(self._last_seq)
+        return bool(events)
+    
+    async def _drain(self):
+        while await self._poll():
+            pass
+    
+    async def _pump(self):
+        loop = asyncio.get_running_loop()
+        reap_at = loop.time()
+        while True:
+            try:
+                if loop.time() >= reap_at:
+                    reap_at = loop.time() + self.reap_interval
+                    await self.broker.reap()
+                polled = await self._poll()
+            except Exception as e:
+                logging.error(f"Ошибка чтения событий брокера: {e}")
+                polled = False
+            if not polled:
+                await asyncio.sleep(self.poll_interval)
+    
+    def _dispatch(self, event: JobEvent):
+        job = self._jobs.get(event.job_id)
+        if job is None:
+            resumed = self._resumed.get(event.job_id)
+            if resumed is not None:
+                # Пакет прошлого запуска: результат ждет, пока его заберет generate
+                if event.kind != "progress" and not resumed.done():
+                    resumed.set_result(event.payload)
+                return
+            # Пакет снят (отмена) — файлы его результата никому не нужны
+            if event.kind == "result":
+                remove_result_files(event.payload)
+            return
+        future, on_progress = job
+        if event.kind == "progress":
+            on_progress(GenerationStage(event.payload["stage"]), event.payload["progress"], event.payload.get("eta"))
+        elif not future.done():
+            future.set_result(event.payload)
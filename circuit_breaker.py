@@ -0,0 +1,87 @@
+"""
+Автоматический выключатель (circuit breaker) для запросов к SD WebUI
+
+После failure_threshold сбоев подряд выключатель размыкается: запросы сразу
+отклоняются без похода в сеть. Через reset_timeout секунд пропускается один
+пробный запрос; успех замыкает выключатель, сбой снова размыкает его.
+"""
+import time
+from enum import Enum
+from typing import Callable, List
+
+from config import SD_BREAKER_FAILURE_THRESHOLD, SD_BREAKER_RESET_TIMEOUT
+
+class BreakerState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+class CircuitBreaker:
+    """Выключатель с одним пробным запросом в полуоткрытом состоянии"""
+    
+    def __init__(self, failure_threshold: int = SD_BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = SD_BREAKER_RESET_TIMEOUT,
+                 clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = BreakerState.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        # Время последнего сбоя: по нему видно, что конкретный запрос упал из-за бэкенда
+        self.last_failure_at = float("-inf")
+        self._trial_in_flight = False
+        self._listeners: List[Callable[[BreakerState], None]] = []
+    
+    def add_listener(self, callback: Callable[[BreakerState], None]):
+        """Подписывает callback на смену состояния"""
+        if callback not in self._listeners:
+            self._listeners.append(callback)
+    
+    def _set_state(self, state: BreakerState):
+        if state is self.state:
+            return
+        self.state = state
+        for callback in self._listeners:
+            callback(state)
+    
+    @property
+    def is_closed(self) -> bool:
+        return self.state is BreakerState.CLOSED
+    
+    def retry_after(self) -> float:
+        """Сколько секунд осталось до пробного запроса (0 — запросы разрешены)"""
+        if self.state is not BreakerState.OPEN:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - self.clock())
+    
+    def allow_request(self) -> bool:
+        """Разрешает запрос или отклоняет его без обращения к сети"""
+        if self.state is BreakerState.CLOSED:
+            return True
+        if self.state is BreakerState.OPEN:
+            if self.retry_after() > 0:
+                return False
+            self._set_state(BreakerState.HALF_OPEN)
+        # Полуоткрытое состояние: только один пробный запрос одновременно
+        if self._trial_in_flight:
+            return False
+        self._trial_in_flight = True
+        return True
+    
+    def record_success(self):
+        self.failures = 0
+        self._trial_in_flight = False
+        self._set_state(BreakerState.CLOSED)
+    
+    def record_failure(self):
+        self.failures += 1
+        self.last_failure_at = self.clock()
+        self._trial_in_flight = False
+        if self.state is BreakerState.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = self.clock()
+            self._set_state(BreakerState.OPEN)
+    
+    def release(self):
+        """Завершает запрос, который не говорит о здоровье бэкенда (например, ответ 4xx)"""
+        self._trial_in_flight = False
@@ -1,11 +1,51 @@
+import json
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
+def _parse_user_map(value: str, cast=float) -> dict:
+    """Parses "user_id:value,user_id:value" into {user_id: value}"""
+    result = {}
+    for item in value.split(','):
+        if item.strip():
+            user_id, item_value = item.split(':', 1)
+            result[int(user_id)] = cast(item_value.strip())
+    return result
+
+def _parse_rate_map(value: str) -> dict:
+    """Parses "event:rate,event:rate" into {event: rate}"""
+    result = {}
+    for item in value.split(','):
+        if item.strip():
+            name, rate = item.split(':', 1)
+            result[name.strip()] = float(rate)
+    return result
+
+def _parse_tiers(defaults: dict, value: str) -> dict:
+    """Merges JSON {"tier": {"limit": value}} over the default tier limits"""
+    tiers = {name: dict(limits) for name, limits in defaults.items()}
+    for name, limits in json.loads(value or '{}').items():
+        tiers.setdefault(name, {}).update(limits)
+    return tiers
+
 # Telegram Bot settings
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 
+# Update delivery: "polling" (development) or "webhook" (embedded aiohttp server, replicas behind a load balancer)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Public HTTPS base URL Telegram posts updates to (WEBHOOK_PATH is appended).
+# Empty — the webhook is registered externally, e.g. by the deployment
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+# Sent by Telegram in X-Telegram-Bot-Api-Secret-Token; required in webhook mode (1-256 chars: A-Z, a-z, 0-9, _ and -)
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+# Updates processed concurrently; above WEBHOOK_MAX_PENDING_UPDATES accepted updates Telegram gets 503 and redelivers later
+WEBHOOK_MAX_CONCURRENT_UPDATES = int(os.getenv('WEBHOOK_MAX_CONCURRENT_UPDATES', '64'))
+WEBHOOK_MAX_PENDING_UPDATES = int(os.getenv('WEBHOOK_MAX_PENDING_UPDATES', '1000'))
+
 # Stable Diffusion settings
 SD_WEBUI_URL = os.getenv('SD_WEBUI_URL', 'http://127.0.0.1:7860')
 SD_MODEL_PATH = r"C:\Users\allga\stable-diffusion-webui\models\Stable-diffusion\novaFurryXL_illustriousV9b.safetensors"
@@ -23,5 +63,159 @@ DEFAULT_PARAMS = {
     "cfg_scale": 7,
     "width": 512,
     "height": 512,
-    "batch_size": 1
-} 
\ No newline at end of file
+    "batch_size": 1,
+    "seed": -1
+}
+
+# Stable Diffusion HTTP client settings
+SD_POOL_SIZE = int(os.getenv('SD_POOL_SIZE', '8'))
+SD_KEEPALIVE_TIMEOUT = float(os.getenv('SD_KEEPALIVE_TIMEOUT', '60'))
+SD_REQUEST_TIMEOUT = float(os.getenv('SD_REQUEST_TIMEOUT', '300'))
+# Decoded images up to this size (MB) stay in memory, larger ones are spooled to a temp file
+SD_IMAGE_SPOOL_MB = float(os.getenv('SD_IMAGE_SPOOL_MB', '16'))
+# Read size for streaming txt2img responses, bytes
+SD_STREAM_CHUNK_SIZE = int(os.getenv('SD_STREAM_CHUNK_SIZE', '262144'))
+
+# Image post-processing before delivery (image_postprocess.py)
+# Photo encoding: jpeg | webp | png (png only strips metadata, oversized images fall back to jpeg)
+IMAGE_PHOTO_FORMAT = os.getenv('IMAGE_PHOTO_FORMAT', 'jpeg').lower()
+IMAGE_PHOTO_QUALITY = int(os.getenv('IMAGE_PHOTO_QUALITY', '92'))
+# Also send the lossless PNG (without text chunks) as a document
+IMAGE_SEND_ORIGINAL = os.getenv('IMAGE_SEND_ORIGINAL', 'false').lower() == 'true'
+# Encoder processes; 0 encodes in a thread of the bot process
+IMAGE_POSTPROCESS_WORKERS = int(os.getenv('IMAGE_POSTPROCESS_WORKERS', '2'))
+
+# Generation progress polling (/sdapi/v1/progress)
+SD_PROGRESS_POLL_INTERVAL = float(os.getenv('SD_PROGRESS_POLL_INTERVAL', '0.5'))
+SD_PROGRESS_TIMEOUT = float(os.getenv('SD_PROGRESS_TIMEOUT', '2'))
+# How long a cancelled generation waits for WebUI to stop (/sdapi/v1/interrupt)
+# before the request is dropped and the slot is freed anyway
+SD_INTERRUPT_TIMEOUT = float(os.getenv('SD_INTERRUPT_TIMEOUT', '10'))
+
+# Generation queue settings
+QUEUE_MAX_SIZE = int(os.getenv('QUEUE_MAX_SIZE', '20000'))
+
+# Identical queued/processing requests share one generation and fan out to every chat
+QUEUE_DEDUP = os.getenv('QUEUE_DEDUP', 'true').lower() == 'true'
+# Also merge identical requests with a random seed (-1). Off by default: otherwise different
+# users (and repeated requests) asking for a random seed all get the same image
+QUEUE_DEDUP_RANDOM_SEED = os.getenv('QUEUE_DEDUP_RANDOM_SEED', 'false').lower() == 'true'
+
+# Admission control at enqueue time (admission.py). Off by default — only QUEUE_MAX_SIZE is enforced;
+# enable with ADMISSION_CONTROL=true after sizing ADMISSION_TIERS for the deployment's GPUs
+ADMISSION_CONTROL = os.getenv('ADMISSION_CONTROL', 'false').lower() == 'true'
+# Tier per user, e.g. "12345:premium,67890:admin"; everyone else is "default"
+USER_TIERS = _parse_user_map(os.getenv('USER_TIERS', ''), str)
+# Limits per tier; ADMISSION_TIERS (JSON) is merged over these, 0 disables a limit.
+# Costs are in units of a DEFAULT_PARAMS generation (scheduling.estimate_task_cost):
+#   rate, burst — token bucket refill per second and capacity
+#   max_queued, max_inflight — waiting tasks, waiting plus generating tasks
+#   max_pending_cost — total cost of waiting and generating tasks
+#   max_drain_seconds — shed load while the predicted queue drain time is above this
+ADMISSION_TIERS = _parse_tiers({
+    'default': {'rate': 0.05, 'burst': 6, 'max_queued': 5, 'max_inflight': 6, 'max_pending_cost': 24,
+                'max_drain_seconds': 300},
+    'premium': {'rate': 0.2, 'burst': 20, 'max_queued': 20, 'max_inflight': 24, 'max_pending_cost': 100,
+                'max_drain_seconds': 1200},
+    'admin': {},
+}, os.getenv('ADMISSION_TIERS', ''))
+# Initial estimate of generation seconds per cost unit, refined from finished batches
+ADMISSION_SECONDS_PER_COST = float(os.getenv('ADMISSION_SECONDS_PER_COST', '5'))
+
+# Persistent queue (SQLite, WAL). Empty QUEUE_DB_PATH keeps the queue in memory only
+QUEUE_DB_PATH = os.getenv('QUEUE_DB_PATH', 'data/queue.db')
+QUEUE_FLUSH_INTERVAL = float(os.getenv('QUEUE_FLUSH_INTERVAL', '0.5'))
+QUEUE_DB_RETENTION_HOURS = float(os.getenv('QUEUE_DB_RETENTION_HOURS', '24'))
+
+# Scheduling policy: fifo, round_robin, weighted_fair, shortest_job_first
+SCHEDULING_POLICY = os.getenv('SCHEDULING_POLICY', 'round_robin')
+
+# Per-user weights for weighted_fair, e.g. "12345:4,67890:2" (admin/premium users)
+USER_WEIGHTS = _parse_user_map(os.getenv('USER_WEIGHTS', ''))
+DEFAULT_USER_WEIGHT = float(os.getenv('DEFAULT_USER_WEIGHT', '1'))
+
+# Group queued tasks by checkpoint to avoid model reloads between jobs
+MODEL_AFFINITY = os.getenv('MODEL_AFFINITY', 'true').lower() == 'true'
+# A task waiting for another checkpoint longer than this forces a model switch, seconds
+MODEL_SWITCH_STARVATION_SECONDS = float(os.getenv('MODEL_SWITCH_STARVATION_SECONDS', '120'))
+
+# Batching of compatible queued tasks into one txt2img call (BATCH_MAX_SIZE=1 disables it)
+BATCH_MAX_SIZE = int(os.getenv('BATCH_MAX_SIZE', '4'))
+# How long the oldest task of a batch may wait for compatible tasks, seconds
+BATCH_MAX_WAIT = float(os.getenv('BATCH_MAX_WAIT', '0'))
+# Send different prompts of one batch as a prompt list (needs WebUI/extension support).
+# Otherwise only tasks with identical prompts are batched
+SD_BATCH_PROMPT_LIST = os.getenv('SD_BATCH_PROMPT_LIST', 'false').lower() == 'true'
+
+# Where generation runs: "local" (in the bot process) or "broker" (separate worker.py processes)
+GENERATION_BACKEND = os.getenv('GENERATION_BACKEND', 'local')
+# Broker shared by the bot and the workers; sqlite:///path needs no external service
+BROKER_URL = os.getenv('BROKER_URL', 'sqlite:///data/broker.db')
+# Generated images are handed to the bot as files in this directory (shared by the bot and the workers)
+BROKER_FILES_DIR = os.getenv('BROKER_FILES_DIR', 'data/broker_files')
+# Result files left behind by a crashed bot are removed at startup after this many hours
+BROKER_FILES_RETENTION_HOURS = float(os.getenv('BROKER_FILES_RETENTION_HOURS', '24'))
+# A batch whose worker stopped renewing its lease for this long goes to another worker, seconds
+BROKER_LEASE_SECONDS = float(os.getenv('BROKER_LEASE_SECONDS', '30'))
+# A batch is failed after this many workers crashed on it
+BROKER_MAX_ATTEMPTS = int(os.getenv('BROKER_MAX_ATTEMPTS', '3'))
+BROKER_POLL_INTERVAL = float(os.getenv('BROKER_POLL_INTERVAL', '0.2'))
+# Batches handed to the workers at once, usually the number of workers. The rest wait in the bot queue
+BROKER_MAX_ACTIVE_JOBS = int(os.getenv('BROKER_MAX_ACTIVE_JOBS', '1'))
+
+# Generation result cache (empty RESULT_CACHE_DIR disables it)
+RESULT_CACHE_DIR = os.getenv('RESULT_CACHE_DIR', 'data/result_cache')
+RESULT_CACHE_MAX_MB = float(os.getenv('RESULT_CACHE_MAX_MB', '1024'))
+# Serve repeated random-seed (-1) requests from the cache too. Explicit seeds are always cached
+RESULT_CACHE_RANDOM_SEED_HITS = os.getenv('RESULT_CACHE_RANDOM_SEED_HITS', 'false').lower() == 'true'
+
+# Telegram file_id of already uploaded images, reused instead of re-uploading (empty FILE_ID_DB_PATH keeps it in memory)
+FILE_ID_DB_PATH = os.getenv('FILE_ID_DB_PATH', 'data/file_ids.db')
+FILE_ID_CACHE_MAX_ENTRIES = int(os.getenv('FILE_ID_CACHE_MAX_ENTRIES', '50000'))
+
+# FSM states of the wizards survive restarts (empty FSM_DB_PATH keeps them in memory)
+FSM_DB_PATH = os.getenv('FSM_DB_PATH', 'data/fsm.db')
+# Wizard sessions without any step for this long are dropped, hours
+FSM_SESSION_TTL_HOURS = float(os.getenv('FSM_SESSION_TTL_HOURS', '24'))
+
+# Prometheus metrics at http://METRICS_HOST:METRICS_PORT/metrics (METRICS_PORT=0 disables).
+# Served separately from the webhook so it is not exposed to the internet
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9464'))
+
+# Structured JSON event log (user messages, task lifecycle), written by a background thread.
+# Empty EVENT_LOG_PATH writes events to stderr
+EVENT_LOG_PATH = os.getenv('EVENT_LOG_PATH', 'logs/events.jsonl')
+EVENT_LOG_MAX_MB = float(os.getenv('EVENT_LOG_MAX_MB', '50'))
+EVENT_LOG_BACKUP_COUNT = int(os.getenv('EVENT_LOG_BACKUP_COUNT', '5'))
+# Records waiting for the writer thread; above this they are dropped instead of blocking the event loop
+EVENT_LOG_QUEUE_SIZE = int(os.getenv('EVENT_LOG_QUEUE_SIZE', '10000'))
+# Share of events kept, e.g. "task_stage:0.1,user_callback:0.5". Events of one task are sampled together
+EVENT_LOG_SAMPLE_RATES = _parse_rate_map(os.getenv('EVENT_LOG_SAMPLE_RATES', ''))
+
+# Model catalog (models, samplers, LoRAs, current checkpoint) refresh interval, seconds
+MODEL_CATALOG_TTL = float(os.getenv('MODEL_CATALOG_TTL', '300'))
+# Models per page of the model selection keyboard
+MODEL_KEYBOARD_PAGE_SIZE = int(os.getenv('MODEL_KEYBOARD_PAGE_SIZE', '8'))
+
+# Circuit breaker around WebUI calls: opens after N consecutive failures, probes again after the timeout
+SD_BREAKER_FAILURE_THRESHOLD = int(os.getenv('SD_BREAKER_FAILURE_THRESHOLD', '3'))
+SD_BREAKER_RESET_TIMEOUT = float(os.getenv('SD_BREAKER_RESET_TIMEOUT', '15'))
+# Background health monitor: probe interval and the sliding window for latency/error rate, seconds
+SD_HEALTH_CHECK_INTERVAL = float(os.getenv('SD_HEALTH_CHECK_INTERVAL', '5'))
+SD_HEALTH_WINDOW = float(os.getenv('SD_HEALTH_WINDOW', '60'))
+# Backend is "degraded" above this probe latency (seconds) or error rate
+SD_HEALTH_DEGRADED_LATENCY = float(os.getenv('SD_HEALTH_DEGRADED_LATENCY', '1.5'))
+SD_HEALTH_DEGRADED_ERROR_RATE = float(os.getenv('SD_HEALTH_DEGRADED_ERROR_RATE', '0.2'))
+# How many times a task is put back in the queue after the backend failed during its generation
+SD_MAX_RETRIES = int(os.getenv('SD_MAX_RETRIES', '5'))
+
+# Bot API server base URL, e.g. a local telegram-bot-api server or the benchmark stub (empty — api.telegram.org)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', '')
+
+# Telegram send budgets for status/progress edits and results (message_updater.py)
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '25'))
+# Minimum interval between calls to one chat: private chats and groups, seconds
+TELEGRAM_CHAT_INTERVAL = float(os.getenv('TELEGRAM_CHAT_INTERVAL', '1'))
+TELEGRAM_GROUP_CHAT_INTERVAL = float(os.getenv('TELEGRAM_GROUP_CHAT_INTERVAL', '3'))
+TELEGRAM_MAX_IN_FLIGHT = int(os.getenv('TELEGRAM_MAX_IN_FLIGHT', '8'))
@@ -0,0 +1,174 @@
+"""
+Структурированный журнал событий (JSON Lines) с записью в фоновом потоке
+
+События пользователей (сообщения, нажатия кнопок) и переходы задач
+(поставлена, начата, этап, завершена / ошибка / отменена) пишутся по одной
+JSON записи в строке. На event loop остается только кортеж из времени,
+события и полей в очереди: создание LogRecord, форматирование и запись в
+файл (с ротацией по размеру) выполняет поток QueueListener. Если поток записи
+не успевает, записи отбрасываются и считаются в dropped — обработка
+обновлений не ждет диск.
+
+Частые события можно прореживать (EVENT_LOG_SAMPLE_RATES). События одной
+задачи прореживаются согласованно по task_id: ее жизненный цикл в журнале
+либо целиком, либо отсутствует.
+
+Обычные сообщения logging после start() идут через ту же очередь на консоль.
+"""
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import time
+import zlib
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, Optional
+
+from config import (EVENT_LOG_BACKUP_COUNT, EVENT_LOG_MAX_MB, EVENT_LOG_PATH, EVENT_LOG_QUEUE_SIZE,
+                    EVENT_LOG_SAMPLE_RATES)
+
+EVENTS_LOGGER = "sdbot.events"
+
+class JsonFormatter(logging.Formatter):
+    """Запись журнала событий в одну строку JSON"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "event": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class _EventsOnly(logging.Filter):
+    def __init__(self, events: bool):
+        super().__init__()
+        self.events = events
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        return (record.name == EVENTS_LOGGER) == self.events
+
+class _DroppingQueueHandler(QueueHandler):
+    """QueueHandler без форматирования в вызывающем потоке и без ожидания при заполненной очереди"""
+    
+    def __init__(self, log_queue: queue.SimpleQueue, maxsize: int):
+        super().__init__(log_queue)
+        self.maxsize = maxsize
+        self.dropped = 0
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Записи не покидают процесс: форматирует поток записи
+        return record
+    
+    def enqueue(self, record):
+        # SimpleQueue без блокировок и Condition заметно дешевле queue.Queue; граница проверяется по qsize
+        if self.queue.qsize() >= self.maxsize:
+            self.dropped += 1
+        else:
+            self.queue.put(record)
+
+class _EventListener(QueueListener):
+    """Поток записи: превращает события из emit (кортежи) в LogRecord"""
+    
+    def prepare(self, record):
+        if not isinstance(record, tuple):
+            return record
+        created, level, event, fields = record
+        record = logging.LogRecord(EVENTS_LOGGER, level, "", 0, event, None, None)
+        record.created = created
+        record.fields = fields
+        return record
+
+class EventLog:
+    """Журнал событий; до start() emit ничего не делает"""
+    
+    def __init__(self, path: str = EVENT_LOG_PATH, max_mb: float = EVENT_LOG_MAX_MB,
+                 backup_count: int = EVENT_LOG_BACKUP_COUNT, sample_rates: Optional[Dict[str, float]] = None,
+                 queue_size: int = EVENT_LOG_QUEUE_SIZE):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.backup_count = backup_count
+        self.sample_rates = EVENT_LOG_SAMPLE_RATES if sample_rates is None else sample_rates
+        self.sampled_out = 0
+        self._queue = queue.SimpleQueue()
+        self._handler = _DroppingQueueHandler(self._queue, queue_size)
+        self._listener: Optional[_EventListener] = None
+        self._console: Optional[logging.Handler] = None
+    
+    @property
+    def dropped(self) -> int:
+        """Записи, отброшенные из-за заполненной очереди"""
+        return self._handler.dropped
+    
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+    
+    def start(self, level: int = logging.INFO):
+        """Запускает поток записи и переводит корневой логгер на очередь (вместо basicConfig)"""
+        if self._listener is not None:
+            return
+        if self.path:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            events_handler = RotatingFileHandler(self.path, maxBytes=self.max_bytes, backupCount=self.backup_count,
+                                                 encoding="utf-8", delay=True)
+        else:
+            events_handler = logging.StreamHandler(sys.stderr)
+        events_handler.setFormatter(JsonFormatter())
+        events_handler.addFilter(_EventsOnly(True))
+        self._console = logging.StreamHandler(sys.stderr)
+        self._console.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        self._console.addFilter(_EventsOnly(False))
+        self._listener = _EventListener(self._queue, events_handler, self._console, respect_handler_level=True)
+        self._listener.start()
+        
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        root.addHandler(self._handler)
+        root.setLevel(level)
+        # События не дублируются в консоль через корневой логгер
+        events_logger = logging.getLogger(EVENTS_LOGGER)
+        events_logger.propagate = False
+        events_logger.addHandler(self._handler)
+    
+    def stop(self):
+        """Дописывает очередь и возвращает консольный вывод без потока записи"""
+        if self._listener is None:
+            return
+        listener, self._listener = self._listener, None
+        root = logging.getLogger()
+        root.removeHandler(self._handler)
+        logging.getLogger(EVENTS_LOGGER).removeHandler(self._handler)
+        listener.stop()
+        for handler in listener.handlers:
+            if handler is not self._console:
+                handler.close()
+        # Сообщения после остановки (завершение asyncio) пишутся синхронно
+        root.addHandler(self._console)
+    
+    def _sampled(self, event: str, fields: dict) -> bool:
+        rate = self.sample_rates.get(event)
+        if rate is None or rate >= 1.0:
+            return True
+        task_id = fields.get("task_id")
+        # crc32, а не hash(): решение для задачи не меняется после перезапуска
+        value = zlib.crc32(task_id.encode()) / 0x100000000 if task_id is not None else random.random()
+        if value < rate:
+            return True
+        self.sampled_out += 1
+        return False
+    
+    def emit(self, event: str, level: int = logging.INFO, **fields):
+        """Ставит событие в очередь записи; не блокирует и не форматирует"""
+        if self._listener is None or not self._sampled(event, fields):
+            return
+        self._handler.enqueue((time.time(), level, event, fields))
+
+events = EventLog()
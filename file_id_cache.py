@@ -0,0 +1,124 @@
+"""
+Кэш file_id уже загруженных в Telegram изображений
+
+После первой отправки Telegram возвращает file_id, по которому тот же файл
+можно отправить повторно без загрузки байтов. Ключ — SHA-256 содержимого
+PNG результата и вид отправки (фото с форматом/качеством перекодирования или
+документ), поэтому file_id переиспользуется для попаданий в кэш результатов,
+нескольких подписчиков задачи и повторного показа.
+
+Индекс хранится в памяти с LRU вытеснением по числу записей и сохраняется
+в SQLite фоновой записью пакетами.
+"""
+import hashlib
+import time
+from collections import OrderedDict
+from typing import BinaryIO, Dict, Optional
+
+from config import FILE_ID_CACHE_MAX_ENTRIES, FILE_ID_DB_PATH, QUEUE_FLUSH_INTERVAL
+from sqlite_store import DELETE, WriteBehindWriter, connect_sqlite
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS file_ids (
+    key TEXT PRIMARY KEY,
+    file_id TEXT NOT NULL,
+    used_at REAL NOT NULL
+);
+"""
+
+_CHUNK_SIZE = 256 * 1024
+
+def file_digest(image: BinaryIO) -> str:
+    """SHA-256 содержимого файла в hex (файл читается частями, позиция сбрасывается в начало)"""
+    image.seek(0)
+    # hashlib.file_digest появился только в Python 3.11
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: image.read(_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    image.seek(0)
+    return digest.hexdigest()
+
+def make_file_key(digest: str, kind: str) -> str:
+    """Ключ кэша: хэш изображения и вид отправки ('photo:jpeg:92', 'document')"""
+    return f"{digest}:{kind}"
+
+def _flush_batch(conn, batch: Dict[str, object]):
+    upserts = [(key, *row) for key, row in batch.items() if row is not DELETE]
+    deletes = [(key,) for key, row in batch.items() if row is DELETE]
+    if upserts:
+        conn.executemany("INSERT OR REPLACE INTO file_ids (key, file_id, used_at) VALUES (?, ?, ?)", upserts)
+    if deletes:
+        conn.executemany("DELETE FROM file_ids WHERE key = ?", deletes)
+
+class FileIdCache:
+    """file_id загруженных файлов с LRU вытеснением; path=None — только в памяти"""
+    
+    def __init__(self, path: Optional[str] = FILE_ID_DB_PATH, max_entries: int = FILE_ID_CACHE_MAX_ENTRIES,
+                 flush_interval: float = QUEUE_FLUSH_INTERVAL):
+        self.path = path
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._writer: Optional[WriteBehindWriter] = None
+    
+    def load(self):
+        """Открывает базу и восстанавливает индекс (давно не использованные — первыми на вытеснение)"""
+        if not self.path or self._writer is not None:
+            return
+        conn = connect_sqlite(self.path)
+        conn.executescript(_SCHEMA)
+        rows = conn.execute("SELECT key, file_id FROM file_ids ORDER BY used_at").fetchall()
+        self._writer = WriteBehindWriter(conn, _flush_batch, self.flush_interval, name="file-id-cache-writer")
+        self._entries.clear()
+        for key, file_id in rows:
+            self._entries[key] = file_id
+        self._evict()
+    
+    def stats(self) -> Dict[str, int]:
+        """Статистика кэша для /status"""
+        return {"hits": self.hits, "misses": self.misses, "rejected": self.rejected, "entries": len(self._entries)}
+    
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+    
+    def get(self, key: str) -> Optional[str]:
+        """Возвращает file_id или None, если файл еще не загружался"""
+        file_id = self._entries.get(key)
+        if file_id is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        if self._writer is not None:
+            self._writer.put(key, (file_id, time.time()))
+        return file_id
+    
+    def put(self, key: str, file_id: str):
+        """Запоминает file_id, полученный после загрузки файла"""
+        self._entries[key] = file_id
+        self._entries.move_to_end(key)
+        if self._writer is not None:
+            self._writer.put(key, (file_id, time.time()))
+        self._evict()
+    
+    def discard(self, key: str):
+        """Удаляет file_id, отклоненный Telegram (файл будет загружен заново)"""
+        if self._entries.pop(key, None) is not None:
+            self.rejected += 1
+            if self._writer is not None:
+                self._writer.delete(key)
+    
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            key, _ = self._entries.popitem(last=False)
+            if self._writer is not None:
+                self._writer.delete(key)
+    
+    def close(self):
+        """Записывает остаток изменений и закрывает базу"""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
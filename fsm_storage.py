@@ -0,0 +1,160 @@
+"""
+Постоянное хранилище состояний FSM (aiogram) на SQLite
+
+Замена MemoryStorage: шаги мастеров (GenerationStates, AdvancedGenerationStates)
+переживают перезапуск бота. Состояния хранятся в памяти, а изменения
+записываются в SQLite фоновой записью пакетами, поэтому set_state/update_data
+занимают микросекунды. Сессии без изменений дольше FSM_SESSION_TTL_HOURS
+считаются брошенными и удаляются из памяти и базы.
+"""
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from config import FSM_DB_PATH, FSM_SESSION_TTL_HOURS, QUEUE_FLUSH_INTERVAL
+from sqlite_store import DELETE, WriteBehindWriter, connect_sqlite
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS fsm_sessions (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fsm_sessions_updated_at ON fsm_sessions (updated_at);
+"""
+
+_encoder = json.JSONEncoder(ensure_ascii=False)
+
+class _Session:
+    """Состояние и данные одного ключа FSM"""
+    __slots__ = ("state", "data", "payload", "updated_at")
+    
+    def __init__(self, state: Optional[str], data: Dict[str, Any], payload: str, updated_at: float):
+        self.state = state
+        self.data = data
+        # data в JSON: при смене только состояния повторно не сериализуется
+        self.payload = payload
+        self.updated_at = updated_at
+
+def _db_key(key: StorageKey) -> str:
+    """Строковый ключ: хэш и сравнение строк дешевле, чем у StorageKey (dataclass)"""
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+def _flush_batch(conn, batch: Dict[str, object]):
+    upserts = [row for row in batch.values() if row is not DELETE]
+    deletes = [(key,) for key, row in batch.items() if row is DELETE]
+    if upserts:
+        conn.executemany("INSERT OR REPLACE INTO fsm_sessions (key, state, data, updated_at) VALUES (?, ?, ?, ?)", upserts)
+    if deletes:
+        conn.executemany("DELETE FROM fsm_sessions WHERE key = ?", deletes)
+
+class SQLiteStorage(BaseStorage):
+    """Хранилище FSM в памяти с фоновой записью в SQLite; path=None — только в памяти (с истечением сессий)"""
+    
+    def __init__(self, path: Optional[str] = FSM_DB_PATH, ttl_hours: float = FSM_SESSION_TTL_HOURS,
+                 flush_interval: float = QUEUE_FLUSH_INTERVAL):
+        self.path = path
+        self.ttl = ttl_hours * 3600
+        self.flush_interval = flush_interval
+        # Порядок — по времени последнего изменения: истекшие сессии всегда в начале
+        self._sessions: "OrderedDict[str, _Session]" = OrderedDict()
+        self._writer: Optional[WriteBehindWriter] = None
+        self._last_prune = 0.0
+        self._next_expire = 0.0
+    
+    def load(self):
+        """Открывает базу и восстанавливает незавершенные сессии"""
+        if not self.path or self._writer is not None:
+            return
+        conn = connect_sqlite(self.path)
+        conn.executescript(_SCHEMA)
+        conn.execute("DELETE FROM fsm_sessions WHERE updated_at < ?", (time.time() - self.ttl,))
+        rows = conn.execute("SELECT key, state, data, updated_at FROM fsm_sessions ORDER BY updated_at").fetchall()
+        self._writer = WriteBehindWriter(conn, _flush_batch, self.flush_interval, name="fsm-storage-writer",
+                                         on_idle=self._prune)
+        self._sessions.clear()
+        for db_key, state, data, updated_at in rows:
+            self._sessions[db_key] = _Session(state, json.loads(data), data, updated_at)
+    
+    def _get(self, db_key: str) -> Optional[_Session]:
+        session = self._sessions.get(db_key)
+        if session is not None and session.updated_at < time.time() - self.ttl:
+            self._expire()
+            return None
+        return session
+    
+    def _save(self, db_key: str, state: Optional[str], data: Dict[str, Any], payload: Optional[str] = None):
+        now = time.time()
+        if state is None and not data:
+            # Пустая сессия (state.clear()) не занимает ни памяти, ни места в базе
+            if self._sessions.pop(db_key, None) is not None and self._writer is not None:
+                self._writer.delete(db_key)
+        else:
+            if payload is None:
+                # Данные сериализуются сразу: несериализуемое значение — ошибка вызывающего, а не потока записи
+                payload = _encoder.encode(data)
+            session = self._sessions.get(db_key)
+            if session is None:
+                self._sessions[db_key] = _Session(state, data, payload, now)
+            else:
+                session.state, session.data, session.payload, session.updated_at = state, data, payload, now
+                self._sessions.move_to_end(db_key)
+            if self._writer is not None:
+                self._writer.put(db_key, (db_key, state, payload, now))
+        if now >= self._next_expire:
+            self._expire()
+    
+    def _expire(self):
+        """Удаляет сессии без изменений дольше TTL (они в начале словаря)"""
+        now = time.time()
+        # Чаще раза в минуту не проверяем: истекшую сессию при обращении отсекает _get
+        self._next_expire = now + min(60.0, self.ttl)
+        deadline = now - self.ttl
+        while self._sessions:
+            db_key, session = next(iter(self._sessions.items()))
+            if session.updated_at >= deadline:
+                break
+            del self._sessions[db_key]
+            if self._writer is not None:
+                self._writer.delete(db_key)
+    
+    def _prune(self, conn):
+        """Удаляет из базы истекшие сессии (вызывается в потоке записи при простое)"""
+        now = time.time()
+        if now - self._last_prune < 600:
+            return
+        self._last_prune = now
+        conn.execute("DELETE FROM fsm_sessions WHERE updated_at < ?", (now - self.ttl,))
+    
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        db_key = _db_key(key)
+        session = self._get(db_key)
+        state = state.state if isinstance(state, State) else state
+        if session is None:
+            self._save(db_key, state, {})
+        else:
+            self._save(db_key, state, session.data, session.payload)
+    
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        session = self._get(_db_key(key))
+        return session.state if session else None
+    
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        db_key = _db_key(key)
+        session = self._get(db_key)
+        self._save(db_key, session.state if session else None, data.copy())
+    
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        session = self._get(_db_key(key))
+        return session.data.copy() if session else {}
+    
+    async def close(self) -> None:
+        """Записывает остаток изменений и закрывает базу"""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
@@ -0,0 +1,135 @@
+"""
+Выполнение пакета генерации на SD WebUI
+
+Общий код бота (GENERATION_BACKEND=local) и процессов worker.py: запрос
+txt2img, перенос прогресса WebUI на этапы задач и раздача изображений
+задачам пакета. О задачах очереди модуль не знает — прогресс сообщается
+через callback(stage, percent, eta). Отмена generate_batch прерывает
+генерацию на WebUI (/sdapi/v1/interrupt).
+"""
+import asyncio
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import config
+from queue_manager import GenerationStage
+from sd_client import StableDiffusionClient
+
+ProgressCallback = Callable[[GenerationStage, float, Optional[float]], None]
+
+def get_stage_progress_range(stage: GenerationStage) -> tuple:
+    """Получает диапазон прогресса для этапа"""
+    ranges = {
+        GenerationStage.INITIALIZING: (0, 10),
+        GenerationStage.LOADING_MODEL: (10, 25),
+        GenerationStage.PROCESSING_PROMPT: (25, 35),
+        GenerationStage.GENERATING_IMAGE: (35, 85),
+        GenerationStage.ENCODING_RESULT: (85, 95),
+        GenerationStage.FINALIZING: (95, 100)
+    }
+    return ranges.get(stage, (0, 100))
+
+def close_images(images):
+    """Закрывает файлы изображений, которые не будут отправлены"""
+    for image in images:
+        image.close()
+
+async def track_backend_progress(sd_client: StableDiffusionClient, on_progress: ProgressCallback):
+    """Опрашивает /sdapi/v1/progress и переносит прогресс WebUI на этапы задач"""
+    start, end = get_stage_progress_range(GenerationStage.GENERATING_IMAGE)
+    while True:
+        await asyncio.sleep(config.SD_PROGRESS_POLL_INTERVAL)
+        progress = await sd_client.get_progress()
+        if not progress:
+            continue
+        
+        state = progress.get('state') or {}
+        fraction = progress.get('progress') or 0.0
+        eta = progress.get('eta_relative')
+        
+        if fraction > 0 or state.get('sampling_step', 0) > 0:
+            on_progress(GenerationStage.GENERATING_IMAGE, start + (end - start) * fraction, eta)
+        elif state.get('job'):
+            # WebUI принял задачу, но еще не начал шаги сэмплинга (загрузка модели, промпт)
+            on_progress(GenerationStage.PROCESSING_PROMPT, 30, eta)
+
+async def interrupt_generation(sd_client: StableDiffusionClient, request: asyncio.Future,
+                               timeout: float = config.SD_INTERRUPT_TIMEOUT) -> bool:
+    """Прерывает генерацию WebUI и ждет ответа на ее запрос txt2img — после него GPU свободен.
+    
+    Returns:
+        bool: False, если WebUI не остановился за timeout (запрос брошен)
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not request.done():
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            request.cancel()
+            logging.warning(f"SD WebUI не остановил генерацию за {timeout:g} с после прерывания")
+            return False
+        # Повторяем: прерывание, пришедшее до начала генерации, WebUI сбрасывает при ее запуске
+        await sd_client.interrupt()
+        await asyncio.wait({request}, timeout=min(remaining, config.SD_PROGRESS_POLL_INTERVAL))
+    if not request.cancelled() and request.exception() is None:
+        # Частичный результат прерванной генерации не нужен
+        close_images((request.result() or {}).get('images') or [])
+    return True
+
+async def generate_batch(sd_client: StableDiffusionClient, prompt: Union[str, List[str]], generation_params: Dict,
+                         count: int, on_progress: ProgressCallback) -> Tuple[Optional[List[Dict]], bool]:
+    """
+    Генерирует пакет из count изображений одним запросом txt2img
+    
+    Args:
+        sd_client (StableDiffusionClient): Клиент WebUI
+        prompt (Union[str, List[str]]): Промпт или список промптов (по одному на изображение)
+        generation_params (Dict): Параметры txt2img, в том числе model и batch_size
+        count (int): Число задач пакета
+        on_progress (ProgressCallback): Получатель этапов и прогресса
+    
+    Returns:
+        Tuple[Optional[List[Dict]], bool]: Результаты задач ({'image', 'seed', 'parameters', 'info'})
+        или None, и признак сбоя WebUI во время генерации (задачи стоит вернуть в очередь)
+    """
+    model = generation_params.get('model') or config.DEFAULT_MODEL
+    if model != sd_client.current_model:
+        # Чекпоинт сменится перед этим запросом, между задачами, а не во время генерации
+        on_progress(GenerationStage.LOADING_MODEL, 15, None)
+    
+    # Прогресс опрашивается параллельно с генерацией и не задерживает ее
+    progress_tracker = asyncio.create_task(track_backend_progress(sd_client, on_progress))
+    started = time.monotonic()
+    request = asyncio.ensure_future(sd_client.txt2img(prompt, **generation_params))
+    try:
+        result = await asyncio.shield(request)
+    except asyncio.CancelledError:
+        # Задачи пакета отменены: WebUI прерывается, иначе он дорисует пакет, занимая GPU
+        await asyncio.shield(interrupt_generation(sd_client, request))
+        raise
+    finally:
+        progress_tracker.cancel()
+    
+    images = (result or {}).get('images') or []
+    if len(images) < count:
+        close_images(images)
+        # Отказ WebUI (сеть, 5xx, таймаут) отличаем от ошибки самого запроса; незакрытый
+        # выключатель отклоняет запрос без обращения к сети и без записи сбоя
+        backend_failed = sd_client.breaker.last_failure_at >= started or not sd_client.breaker.is_closed
+        return None, backend_failed
+    
+    # При batch_size > 1 WebUI может вернуть первым изображением общую сетку
+    close_images(images[:-count])
+    images = images[-count:]
+    seeds = result.get('all_seeds') or []
+    task_results = []
+    for i, image in enumerate(images):
+        seed = seeds[i] if i < len(seeds) else result.get('seed', -1)
+        task_results.append({
+            'image': image,
+            'seed': seed,
+            'parameters': {**result.get('effective_params', {}), 'seed': seed},
+            'info': result.get('info')
+        })
+    return task_results, False
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from config import BATCH_MAX_SIZE, BATCH_MAX_WAIT
+from queue_manager import QueueManager, GenerationTask
+
+class GenerationDispatcher:
+    """Единственный диспетчер очереди генерации на процесс.
+    
+    Просыпается сразу, когда задача добавлена в очередь или освободился обработчик,
+    и простаивает все остальное время. Совместимые задачи из очереди отдаются
+    обработчику пакетом до max_batch_size задач. Пока backend не принимает
+    запросы (см. backend_health), задачи остаются в очереди. Обработка пакета,
+    все задачи которого отменены, прерывается отменой ее asyncio задачи.
+    """
+    
+    def __init__(self, queue_manager: QueueManager,
+                 process_batch: Callable[[List[GenerationTask]], Awaitable[None]],
+                 restart_delay: float = 5.0,
+                 max_batch_size: int = BATCH_MAX_SIZE,
+                 max_wait: float = BATCH_MAX_WAIT,
+                 backend=None):
+        self.queue_manager = queue_manager
+        self.backend = backend
+        self.process_batch = process_batch
+        self.restart_delay = restart_delay
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self._wakeup: Optional[asyncio.Event] = None
+        self._arrival: Optional[asyncio.Event] = None
+        self._runner: Optional[asyncio.Task] = None
+        self._running: Set[asyncio.Task] = set()
+        # Обработка пакетов по id пакета (id его первой задачи, см. QueueManager.start_batch)
+        self._batches: Dict[str, asyncio.Task] = {}
+    
+    @property
+    def is_running(self) -> bool:
+        return self._runner is not None and not self._runner.done()
+    
+    def notify(self):
+        """Будит диспетчер (вызывается менеджером очереди при изменениях)"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+            self._arrival.set()
+    
+    def interrupt(self, batch_id: str):
+        """Прерывает обработку отмененного пакета (вызывается менеджером очереди)"""
+        worker = self._batches.get(batch_id)
+        if worker is not None:
+            worker.cancel()
+        else:
+            self.queue_manager.release_batch(batch_id)
+    
+    async def start(self):
+        """Запускает диспетчер, повторный вызов ничего не делает"""
+        if self.is_running:
+            return
+        self._wakeup = asyncio.Event()
+        self._arrival = asyncio.Event()
+        self.queue_manager.add_listener(self.notify)
+        self.queue_manager.add_cancel_listener(self.interrupt)
+        if self.backend is not None:
+            self.backend.add_listener(self.notify)
+        self._runner = asyncio.create_task(self._supervise(), name="generation-dispatcher")
+        logging.info("Диспетчер очереди генерации запущен")
+    
+    async def stop(self, timeout: float = 10.0):
+        """Останавливает диспетчер и дожидается текущих задач не дольше timeout"""
+        if self._runner is None:
+            return
+        self.queue_manager.remove_listener(self.notify)
+        self.queue_manager.remove_cancel_listener(self.interrupt)
+        if self.backend is not None:
+            self.backend.remove_listener(self.notify)
+        self._runner.cancel()
+        try:
+            await self._runner
+        except asyncio.CancelledError:
+            pass
+        self._runner = None
+        
+        if self._running:
+            done, pending = await asyncio.wait(self._running, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        logging.info("Диспетчер очереди генерации остановлен")
+    
+    async def _supervise(self):
+        """Перезапускает цикл диспетчера после непредвиденных ошибок"""
+        while True:
+            try:
+                await self._dispatch_loop()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Ошибка в диспетчере очереди: {e}")
+                await asyncio.sleep(self.restart_delay)
+    
+    async def _dispatch_loop(self):
+        while True:
+            # Сбрасываем событие до проверки очереди, чтобы не потерять пробуждение
+            self._wakeup.clear()
+            # Недоступный бэкенд: ждем смены его состояния, задачи не проваливаются
+            if self.backend is None or self.backend.is_accepting():
+                batch = self.queue_manager.start_batch(self.max_batch_size)
+                while batch:
+                    self._spawn(batch)
+                    batch = self.queue_manager.start_batch(self.max_batch_size)
+            await self._wakeup.wait()
+    
+    def resume(self, batch: List[GenerationTask]):
+        """Запускает обработку пакета, уже числящегося генерируемым (пакет брокера после перезапуска бота)"""
+        self._spawn(batch, fill=False)
+    
+    def _spawn(self, batch: List[GenerationTask], fill: bool = True):
+        batch_id = batch[0].id
+        worker = asyncio.create_task(self._execute(batch, fill), name=f"generation-{batch_id}")
+        self._running.add(worker)
+        self._batches[batch_id] = worker
+        worker.add_done_callback(lambda worker: self._finished(batch_id, worker))
+    
+    def _finished(self, batch_id: str, worker: asyncio.Task):
+        self._running.discard(worker)
+        self._batches.pop(batch_id, None)
+        # Место отмененного пакета освобождается только после прерывания генерации;
+        # done callback срабатывает и для задачи, отмененной до первого шага
+        self.queue_manager.release_batch(batch_id)
+    
+    async def _fill_batch(self, batch: List[GenerationTask]):
+        """Ждет совместимые задачи, пока самая старая задача пакета ждет меньше max_wait"""
+        deadline = batch[0].created_at + self.max_wait
+        while len(batch) < self.max_batch_size:
+            # created_at задачи записан по часам менеджера очереди
+            remaining = deadline - self.queue_manager.clock()
+            if remaining <= 0:
+                break
+            self._arrival.clear()
+            try:
+                await asyncio.wait_for(self._arrival.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+            batch.extend(self.queue_manager.extend_batch(batch, self.max_batch_size - len(batch)))
+    
+    async def _execute(self, batch: List[GenerationTask], fill: bool = True):
+        try:
+            if fill and self.max_wait > 0 and len(batch) < self.max_batch_size:
+                await self._fill_batch(batch)
+            await self.process_batch(batch)
+        except Exception as e:
+            logging.error(f"Ошибка при обработке пакета {[task.id for task in batch]}: {e}")
+        finally:
+            # Обработчик освободился — можно брать следующую задачу
+            self.notify()
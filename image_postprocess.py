@@ -0,0 +1,192 @@
+"""
+Постобработка изображений перед отправкой в Telegram
+
+PNG от WebUI весит мегабайты, а Telegram все равно пережимает фото. Перед
+доставкой изображение перекодируется в JPEG/WebP высокого качества с учетом
+лимитов sendPhoto (размер файла, сумма сторон, соотношение сторон); текстовые
+чанки PNG с промптом и параметрами отбрасываются. Оригинал без метаданных
+можно дополнительно отправить документом (IMAGE_SEND_ORIGINAL).
+
+Кодирование выполняется в пуле процессов: не блокирует event loop и не
+конкурирует за GIL с ботом.
+"""
+import asyncio
+import functools
+import io
+import logging
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import BinaryIO, Optional, Tuple
+
+from PIL import Image
+
+from config import IMAGE_PHOTO_FORMAT, IMAGE_PHOTO_QUALITY, IMAGE_SEND_ORIGINAL, IMAGE_POSTPROCESS_WORKERS
+
+# Лимиты Bot API для sendPhoto и sendDocument
+TELEGRAM_PHOTO_MAX_BYTES = 10 * 1024 * 1024
+TELEGRAM_PHOTO_MAX_DIMENSIONS = 10000
+TELEGRAM_PHOTO_MAX_RATIO = 20
+TELEGRAM_DOCUMENT_MAX_BYTES = 50 * 1024 * 1024
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_PNG_TEXT_CHUNKS = {b"tEXt", b"zTXt", b"iTXt"}
+_EXTENSIONS = {"jpeg": "jpg", "webp": "webp"}
+# Качество, ниже которого не опускаемся при подгонке под лимит размера
+_MIN_QUALITY = 60
+
+@dataclass
+class PreparedImage:
+    """Готовые к отправке файлы: фото (None — только документом) и оригинал без метаданных"""
+    photo: Optional[bytes]
+    photo_filename: str
+    document: Optional[bytes]
+    width: int
+    height: int
+
+def strip_png_text(data: bytes) -> bytes:
+    """Удаляет текстовые чанки PNG (промпт и параметры WebUI) без перекодирования"""
+    if not data.startswith(_PNG_SIGNATURE):
+        return data
+    chunks = [_PNG_SIGNATURE]
+    pos = len(_PNG_SIGNATURE)
+    while pos + 8 <= len(data):
+        length, kind = struct.unpack(">I4s", data[pos:pos + 8])
+        end = pos + 12 + length
+        if kind not in _PNG_TEXT_CHUNKS:
+            chunks.append(data[pos:end])
+        pos = end
+        if kind == b"IEND":
+            break
+    return b"".join(chunks)
+
+def fit_photo_size(width: int, height: int, max_dimensions: int = TELEGRAM_PHOTO_MAX_DIMENSIONS) -> Tuple[int, int]:
+    """Размер с сохранением пропорций, при котором сумма сторон не превышает лимит"""
+    if width + height <= max_dimensions:
+        return width, height
+    scale = max_dimensions / (width + height)
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+def _encode(image: Image.Image, photo_format: str, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    if photo_format == "webp":
+        image.save(buffer, "WEBP", quality=quality, method=4)
+    else:
+        subsampling = 0 if quality >= 90 else 2
+        try:
+            image.save(buffer, "JPEG", quality=quality, optimize=True, subsampling=subsampling)
+        except OSError:
+            # Оптимизация таблиц Хаффмана не справляется с шумными изображениями
+            buffer = io.BytesIO()
+            image.save(buffer, "JPEG", quality=quality, subsampling=subsampling)
+    return buffer.getvalue()
+
+def _to_rgb(image: Image.Image) -> Image.Image:
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        # Прозрачность на белом фоне, как ее покажет Telegram
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.convert("RGBA").getchannel("A"))
+        return background
+    return image.convert("RGB") if image.mode != "RGB" else image
+
+def encode_photo(image: Image.Image, photo_format: str, quality: int,
+                 max_bytes: int = TELEGRAM_PHOTO_MAX_BYTES) -> bytes:
+    """Кодирует фото, снижая качество, а затем размер, пока файл не уложится в max_bytes"""
+    while True:
+        data = _encode(image, photo_format, quality)
+        if len(data) <= max_bytes:
+            return data
+        if quality > _MIN_QUALITY:
+            quality = max(_MIN_QUALITY, quality - 10)
+        else:
+            image = image.resize((max(1, image.width * 3 // 4), max(1, image.height * 3 // 4)), Image.LANCZOS)
+
+def prepare_image(data: bytes, photo_format: str = IMAGE_PHOTO_FORMAT, quality: int = IMAGE_PHOTO_QUALITY,
+                  send_original: bool = IMAGE_SEND_ORIGINAL) -> PreparedImage:
+    """Готовит PNG к отправке (выполняется в процессе пула)"""
+    original = strip_png_text(data)
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+        width, height = image.size
+        photo = None
+        if max(width, height) <= TELEGRAM_PHOTO_MAX_RATIO * max(1, min(width, height)):
+            fits = len(original) <= TELEGRAM_PHOTO_MAX_BYTES and width + height <= TELEGRAM_PHOTO_MAX_DIMENSIONS
+            if photo_format == "png" and fits:
+                photo, extension = original, "png"
+            else:
+                size = fit_photo_size(width, height)
+                photo_image = _to_rgb(image)
+                if size != photo_image.size:
+                    photo_image = photo_image.resize(size, Image.LANCZOS)
+                # PNG, не влезающий в лимиты, тоже перекодируется в JPEG
+                encoding = "webp" if photo_format == "webp" else "jpeg"
+                photo, extension = encode_photo(photo_image, encoding, quality), _EXTENSIONS[encoding]
+                width, height = photo_image.size
+    
+    # Фото с недопустимым соотношением сторон уходит только документом
+    document = original if (send_original or photo is None) and len(original) <= TELEGRAM_DOCUMENT_MAX_BYTES else None
+    return PreparedImage(
+        photo=photo,
+        photo_filename=f"generated.{extension}" if photo is not None else "generated.png",
+        document=document,
+        width=width,
+        height=height
+    )
+
+def _warm_up() -> bool:
+    return True
+
+def _read_all(image: BinaryIO) -> bytes:
+    image.seek(0)
+    return image.read()
+
+class ImagePostprocessor:
+    """Пул процессов для подготовки изображений; workers=0 — кодирование в потоке"""
+    
+    def __init__(self, workers: int = IMAGE_POSTPROCESS_WORKERS, photo_format: str = IMAGE_PHOTO_FORMAT,
+                 quality: int = IMAGE_PHOTO_QUALITY, send_original: bool = IMAGE_SEND_ORIGINAL):
+        self.workers = workers
+        self.photo_format = photo_format
+        self.quality = quality
+        self.send_original = send_original
+        # Изображения в работе: больше workers — пул не успевает, задачи ждут в его очереди
+        self.in_flight = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+    
+    @property
+    def photo_variant(self) -> str:
+        """Формат и качество фото: от них зависит загружаемый файл (ключ кэша file_id)"""
+        return f"{self.photo_format}:{self.quality}"
+    
+    async def start(self):
+        """Создает пул; процессы запускаются сразу, пока в боте мало активных потоков"""
+        if self.workers <= 0 or self._executor is not None:
+            return
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        await asyncio.get_running_loop().run_in_executor(self._executor, _warm_up)
+        logging.info(f"Пул постобработки изображений запущен ({self.workers} процесс.)")
+    
+    async def stop(self):
+        """Дожидается текущих задач и завершает процессы пула"""
+        if self._executor is not None:
+            executor, self._executor = self._executor, None
+            await asyncio.to_thread(executor.shutdown, wait=True, cancel_futures=True)
+    
+    async def prepare(self, image: BinaryIO) -> PreparedImage:
+        """Готовит изображение из файла результата к отправке"""
+        data = await asyncio.to_thread(_read_all, image)
+        job = functools.partial(prepare_image, data, self.photo_format, self.quality, self.send_original)
+        self.in_flight += 1
+        try:
+            if self._executor is None:
+                return await asyncio.to_thread(job)
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self._executor, job)
+            except BrokenProcessPool:
+                # Процесс пула упал (например, OOM) — пересоздаем пул, текущее изображение кодируем в потоке
+                logging.error("Пул постобработки изображений аварийно завершился, перезапуск")
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                return await asyncio.to_thread(job)
+        finally:
+            self.in_flight -= 1
@@ -0,0 +1,288 @@
+"""
+Потоковый разбор ответов SD WebUI с изображениями
+
+Ответ txt2img — JSON, в котором изображения лежат base64-строками. Парсер
+получает тело частями по мере чтения из сети и сразу декодирует base64 каждого
+изображения во временный файл (в памяти до SD_IMAGE_SPOOL_MB, дальше на диске),
+поэтому ни полный JSON, ни base64-строки целиком в памяти не собираются.
+Остальные поля ответа небольшие и разбираются обычным json.loads.
+"""
+import binascii
+import json
+import re
+from tempfile import SpooledTemporaryFile
+from typing import Any, AsyncGenerator, BinaryIO, Dict, List, Optional
+
+from aiogram.types.input_file import DEFAULT_CHUNK_SIZE, InputFile
+
+from config import SD_IMAGE_SPOOL_MB
+
+_WHITESPACE = b" \t\r\n"
+# Символы, на которых меняется вложенность обычного JSON-значения
+_VALUE_SPECIAL = re.compile(rb'["\[\]{},]')
+_STRING_SPECIAL = re.compile(rb'["\\]')
+# Экранирование внутри base64: "\/" допустим в JSON, переводы строк игнорируются
+_BASE64_ESCAPES = {ord("/"): b"/", ord("n"): b"", ord("r"): b""}
+
+class ImageResponseParser:
+    """Инкрементальный разбор JSON-объекта верхнего уровня с полями-массивами изображений.
+    
+    feed() принимает очередную часть тела, finish() возвращает словарь ответа,
+    где в image_fields вместо строк base64 — файлы с декодированными байтами.
+    """
+    
+    def __init__(self, spool_limit: int = int(SD_IMAGE_SPOOL_MB * 1024 * 1024), image_fields=("images",)):
+        self.spool_limit = spool_limit
+        self.image_fields = set(image_fields)
+        self.result: Dict[str, Any] = {}
+        self._buffer = b""
+        self._state = "start"
+        self._key: Optional[str] = None
+        # Текущее изображение и необработанный хвост base64 (меньше 4 символов)
+        self._images: List[BinaryIO] = []
+        self._image: Optional[BinaryIO] = None
+        self._base64_tail = b""
+        # Обычное значение: накопленные байты, вложенность, внутри ли строки
+        self._value = bytearray()
+        self._depth = 0
+        self._in_string = False
+    
+    def feed(self, data: bytes):
+        """Обрабатывает очередную часть тела ответа"""
+        buffer = self._buffer + data if self._buffer else data
+        pos = 0
+        while pos < len(buffer):
+            new_pos = getattr(self, f"_parse_{self._state}")(buffer, pos)
+            if new_pos is None:
+                # Нужны следующие байты (ключ или экранирование на границе частей)
+                break
+            pos = new_pos
+        self._buffer = buffer[pos:]
+    
+    def finish(self) -> Dict[str, Any]:
+        """Завершает разбор; неполный ответ — ValueError"""
+        if self._state != "done" or self._buffer.strip(_WHITESPACE):
+            raise ValueError("Неполный или некорректный JSON ответа SD WebUI")
+        return self.result
+    
+    def close(self):
+        """Закрывает файлы изображений, если ответ не будет использован"""
+        files = list(self._images)
+        if self._image is not None:
+            files.append(self._image)
+        for field in self.image_fields:
+            value = self.result.get(field)
+            if isinstance(value, list):
+                files.extend(value)
+        for file in files:
+            file.close()
+    
+    @staticmethod
+    def _skip_whitespace(buffer: bytes, pos: int) -> int:
+        while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+            pos += 1
+        return pos
+    
+    def _expect(self, buffer: bytes, pos: int, allowed: bytes) -> Optional[int]:
+        pos = self._skip_whitespace(buffer, pos)
+        if pos < len(buffer) and buffer[pos] not in allowed:
+            raise ValueError(f"Неожиданный символ {chr(buffer[pos])!r} в ответе SD WebUI")
+        return pos
+    
+    def _parse_start(self, buffer: bytes, pos: int) -> Optional[int]:
+        pos = self._expect(buffer, pos, b"{")
+        if pos < len(buffer):
+            self._state = "key"
+            return pos + 1
+        return pos
+    
+    def _parse_key(self, buffer: bytes, pos: int) -> Optional[int]:
+        pos = self._expect(buffer, pos, b'"},')
+        if pos >= len(buffer):
+            return pos
+        if buffer[pos] == ord(","):
+            return pos + 1
+        if buffer[pos] == ord("}"):
+            self._state = "done"
+            return pos + 1
+        end = self._string_end(buffer, pos + 1)
+        if end is None:
+            return None
+        self._key = json.loads(buffer[pos:end])
+        self._state = "colon"
+        return end
+    
+    def _parse_colon(self, buffer: bytes, pos: int) -> Optional[int]:
+        pos = self._expect(buffer, pos, b":")
+        if pos < len(buffer):
+            self._state = "value"
+            return pos + 1
+        return pos
+    
+    def _parse_value(self, buffer: bytes, pos: int) -> Optional[int]:
+        pos = self._skip_whitespace(buffer, pos)
+        if pos >= len(buffer):
+            return pos
+        if self._key in self.image_fields and buffer[pos] == ord("["):
+            self._state = "images"
+            return pos + 1
+        self._value.clear()
+        self._depth = 0
+        self._in_string = False
+        self._state = "generic"
+        return pos
+    
+    def _parse_after_value(self, buffer: bytes, pos: int) -> Optional[int]:
+        pos = self._expect(buffer, pos, b",}")
+        if pos >= len(buffer):
+            return pos
+        self._state = "key" if buffer[pos] == ord(",") else "done"
+        return pos + 1
+    
+    def _parse_done(self, buffer: bytes, pos: int) -> Optional[int]:
+        pos = self._skip_whitespace(buffer, pos)
+        if pos < len(buffer):
+            raise ValueError("Лишние данные после JSON ответа SD WebUI")
+        return pos
+    
+    @staticmethod
+    def _string_end(buffer: bytes, pos: int) -> Optional[int]:
+        """Позиция за закрывающей кавычкой строки, None — строка еще не пришла целиком"""
+        while True:
+            match = _STRING_SPECIAL.search(buffer, pos)
+            if match is None:
+                return None
+            if match.group() == b'"':
+                return match.end()
+            pos = match.end() + 1
+            if pos > len(buffer):
+                return None
+    
+    # --- Массив изображений ---
+    
+    def _parse_images(self, buffer: bytes, pos: int) -> Optional[int]:
+        pos = self._expect(buffer, pos, b'",]')
+        if pos >= len(buffer):
+            return pos
+        char = buffer[pos]
+        if char == ord(","):
+            return pos + 1
+        if char == ord("]"):
+            self.result[self._key] = self._images
+            self._images = []
+            self._state = "after_value"
+            return pos + 1
+        self._image = SpooledTemporaryFile(max_size=self.spool_limit)
+        self._base64_tail = b""
+        self._state = "image"
+        return pos + 1
+    
+    def _parse_image(self, buffer: bytes, pos: int) -> Optional[int]:
+        start = pos
+        view = memoryview(buffer)
+        while True:
+            match = _STRING_SPECIAL.search(buffer, pos)
+            end = match.start() if match is not None else len(buffer)
+            self._write_base64(view[pos:end])
+            if match is None:
+                return len(buffer)
+            if match.group() == b'"':
+                self._finish_image()
+                return match.end()
+            # Экранирование: ждем символ после обратной косой черты
+            if match.end() >= len(buffer):
+                return None if match.start() == start else match.start()
+            escaped = _BASE64_ESCAPES.get(buffer[match.end()])
+            if escaped is None:
+                raise ValueError("Недопустимое экранирование в base64 изображения")
+            self._write_base64(escaped)
+            pos = match.end() + 1
+    
+    def _write_base64(self, data):
+        """Декодирует base64 группами по 4 символа, остаток ждет следующей части"""
+        if not data:
+            return
+        if self._base64_tail:
+            need = 4 - len(self._base64_tail)
+            self._base64_tail += bytes(data[:need])
+            data = data[need:]
+            if len(self._base64_tail) < 4:
+                return
+            self._image.write(binascii.a2b_base64(self._base64_tail))
+            self._base64_tail = b""
+        usable = len(data) - len(data) % 4
+        if usable:
+            self._image.write(binascii.a2b_base64(data[:usable]))
+        self._base64_tail = bytes(data[usable:])
+    
+    def _finish_image(self):
+        if self._base64_tail:
+            raise ValueError("Обрезанная base64-строка изображения")
+        self._image.seek(0)
+        self._images.append(self._image)
+        self._image = None
+        self._state = "images"
+    
+    # --- Обычные значения (parameters, info и т.д.) ---
+    
+    def _parse_generic(self, buffer: bytes, pos: int) -> Optional[int]:
+        start = pos
+        while pos < len(buffer):
+            if self._in_string:
+                match = _STRING_SPECIAL.search(buffer, pos)
+                if match is None:
+                    self._value += buffer[pos:]
+                    return len(buffer)
+                if match.group() == b"\\":
+                    if match.end() >= len(buffer):
+                        self._value += buffer[pos:match.start()]
+                        return None if match.start() == start else match.start()
+                    self._value += buffer[pos:match.end() + 1]
+                    pos = match.end() + 1
+                    continue
+                self._value += buffer[pos:match.end()]
+                pos = match.end()
+                self._in_string = False
+                if self._depth == 0:
+                    return self._finish_value(pos)
+                continue
+            
+            match = _VALUE_SPECIAL.search(buffer, pos)
+            if match is None:
+                self._value += buffer[pos:]
+                return len(buffer)
+            char = match.group()
+            if char in b",}" and self._depth == 0:
+                # Конец числа, true/false/null — разделитель остается следующему состоянию
+                self._value += buffer[pos:match.start()]
+                return self._finish_value(match.start())
+            self._value += buffer[pos:match.end()]
+            pos = match.end()
+            if char == b'"':
+                self._in_string = True
+            elif char in b"[{":
+                self._depth += 1
+            elif char in b"]}":
+                self._depth -= 1
+                if self._depth == 0:
+                    return self._finish_value(pos)
+        return pos
+    
+    def _finish_value(self, pos: int) -> int:
+        self.result[self._key] = json.loads(bytes(self._value))
+        self._value.clear()
+        self._state = "after_value"
+        return pos
+
+class SpooledInputFile(InputFile):
+    """Загрузка в Telegram из файла частями, без сборки всего изображения в bytes"""
+    
+    def __init__(self, file: BinaryIO, filename: Optional[str] = None, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.file = file
+    
+    async def read(self, bot) -> AsyncGenerator[bytes, None]:
+        # Один файл может отправляться в несколько чатов подряд
+        self.file.seek(0)
+        while chunk := self.file.read(self.chunk_size):
+            yield chunk
@@ -0,0 +1,281 @@
+"""
+Планировщик обновлений сообщений Telegram
+
+Правки одного сообщения схлопываются до последней версии, правки с тем же
+текстом не отправляются. Вызовы Bot API идут в пределах общего бюджета и
+бюджета на чат: результаты раньше статусов, статусы раньше прогресса.
+При 429 (retry_after) чат ставится на паузу, а общая частота снижается
+и затем постепенно восстанавливается.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from config import (TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_INTERVAL, TELEGRAM_GROUP_CHAT_INTERVAL,
+                    TELEGRAM_MAX_IN_FLIGHT)
+from rate_limit import TokenBucket
+
+class Priority(IntEnum):
+    RESULT = 0
+    STATUS = 1
+    PROGRESS = 2
+
+@dataclass
+class _Operation:
+    key: Hashable
+    chat_id: int
+    priority: Priority
+    kind: str
+    message_id: Optional[int] = None
+    content: Optional[Tuple] = None
+    kwargs: Dict[str, Any] = field(default_factory=dict)
+    factory: Optional[Callable[[], Awaitable[Any]]] = None
+    future: Optional[asyncio.Future] = None
+
+class MessageUpdater:
+    """Единая очередь вызовов Bot API для статусов, прогресса и результатов"""
+    
+    # Сколько последних отправленных текстов помнить для отбрасывания повторов
+    MAX_REMEMBERED = 10000
+    
+    def __init__(self, bot: Bot, global_rate: float = TELEGRAM_GLOBAL_RATE,
+                 chat_interval: float = TELEGRAM_CHAT_INTERVAL,
+                 group_chat_interval: float = TELEGRAM_GROUP_CHAT_INTERVAL,
+                 max_in_flight: int = TELEGRAM_MAX_IN_FLIGHT):
+        self.bot = bot
+        self.base_rate = global_rate
+        self.chat_interval = chat_interval
+        self.group_chat_interval = group_chat_interval
+        self.max_in_flight = max(1, max_in_flight)
+        self._bucket = TokenBucket(global_rate, capacity=max(1.0, global_rate))
+        self._queues: List["OrderedDict[Hashable, _Operation]"] = [OrderedDict() for _ in Priority]
+        self._pending: Dict[Hashable, _Operation] = {}
+        # Когда чату можно отправить следующую операцию; в начале — давно не менявшиеся
+        self._chat_ready_at: "OrderedDict[int, float]" = OrderedDict()
+        self._busy_chats: Set[int] = set()
+        self._last_sent: "OrderedDict[Hashable, Tuple]" = OrderedDict()
+        self._call_ids = itertools.count()
+        self._backoff_until = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._runner: Optional[asyncio.Task] = None
+        self._in_flight: Set[asyncio.Task] = set()
+        self.stats = {"sent": 0, "coalesced": 0, "unchanged": 0, "retry_after": 0, "errors": 0}
+    
+    @property
+    def is_running(self) -> bool:
+        return self._runner is not None and not self._runner.done()
+    
+    @property
+    def pending(self) -> int:
+        """Операции, ожидающие отправки"""
+        return len(self._pending)
+    
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+    
+    def _enqueue(self, op: _Operation):
+        self._pending[op.key] = op
+        self._queues[op.priority][op.key] = op
+        self._wake()
+    
+    def _discard(self, op: _Operation):
+        self._pending.pop(op.key, None)
+        self._queues[op.priority].pop(op.key, None)
+    
+    def edit_text(self, chat_id: int, message_id: int, text: str, reply_markup=None,
+                  parse_mode: Optional[str] = "HTML", priority: Priority = Priority.PROGRESS):
+        """Ставит правку сообщения; более новая правка того же сообщения заменяет ожидающую"""
+        key = (chat_id, message_id)
+        markup = json.dumps(reply_markup.model_dump(), sort_keys=True) if reply_markup is not None else None
+        content = (text, markup, parse_mode)
+        kwargs = {"text": text, "reply_markup": reply_markup, "parse_mode": parse_mode}
+        
+        pending = self._pending.get(key)
+        if pending is not None:
+            if pending.kind == "delete":
+                # Сообщение все равно будет удалено
+                return
+            self.stats["coalesced"] += 1
+            pending.content = content
+            pending.kwargs = kwargs
+            if priority < pending.priority:
+                self._discard(pending)
+                pending.priority = priority
+                self._enqueue(pending)
+            return
+        
+        if self._last_sent.get(key) == content:
+            self.stats["unchanged"] += 1
+            return
+        self._enqueue(_Operation(key, chat_id, priority, "edit", message_id=message_id, content=content, kwargs=kwargs))
+    
+    def delete_message(self, chat_id: int, message_id: int, priority: Priority = Priority.STATUS):
+        """Ставит удаление сообщения; ожидающие правки этого сообщения отменяются"""
+        key = (chat_id, message_id)
+        pending = self._pending.get(key)
+        if pending is not None:
+            self.stats["coalesced"] += 1
+            self._discard(pending)
+        self._enqueue(_Operation(key, chat_id, priority, "delete", message_id=message_id))
+    
+    async def call(self, chat_id: int, factory: Callable[[], Awaitable[Any]], priority: Priority = Priority.RESULT) -> Any:
+        """Выполняет произвольный вызов Bot API (отправка результата) в общих лимитах и возвращает его результат"""
+        if not self.is_running:
+            return await factory()
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(_Operation(("call", next(self._call_ids)), chat_id, priority, "call", factory=factory, future=future))
+        return await future
+    
+    def _interval(self, chat_id: int) -> float:
+        # Отрицательные id — группы и каналы, для них лимит Telegram строже
+        return self.group_chat_interval if chat_id < 0 else self.chat_interval
+    
+    def _set_ready_at(self, chat_id: int, ready_at: float, now: float):
+        self._chat_ready_at[chat_id] = ready_at
+        self._chat_ready_at.move_to_end(chat_id)
+        # Прошедшее время готовности ничего не ограничивает: удаляем до двух таких записей
+        for _ in range(2):
+            if not self._chat_ready_at:
+                return
+            oldest_chat, oldest_ready_at = next(iter(self._chat_ready_at.items()))
+            if oldest_ready_at > now:
+                self._chat_ready_at.move_to_end(oldest_chat)
+                return
+            del self._chat_ready_at[oldest_chat]
+    
+    def _next_operation(self, now: float) -> Tuple[Optional[_Operation], Optional[float]]:
+        """Первая готовая операция по приоритету и времени постановки, иначе — через сколько проверить снова"""
+        earliest = None
+        for queue in self._queues:
+            for op in queue.values():
+                if op.chat_id in self._busy_chats:
+                    continue
+                ready_at = self._chat_ready_at.get(op.chat_id, 0.0)
+                if ready_at <= now:
+                    return op, None
+                earliest = ready_at if earliest is None else min(earliest, ready_at)
+        return None, (earliest - now if earliest is not None else None)
+    
+    async def start(self):
+        """Запускает отправку очереди обновлений"""
+        if self.is_running:
+            return
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self._runner = asyncio.create_task(self._run(), name="message-updater")
+    
+    async def stop(self, timeout: float = 5.0):
+        """Досылает результаты (не дольше timeout) и останавливает планировщик"""
+        if self._runner is None:
+            return
+        deadline = time.monotonic() + timeout
+        while any(op.kind == "call" for op in self._pending.values()) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        
+        self._runner.cancel()
+        for worker in list(self._in_flight):
+            worker.cancel()
+        await asyncio.gather(self._runner, *self._in_flight, return_exceptions=True)
+        self._runner = None
+        for op in list(self._pending.values()):
+            if op.future is not None and not op.future.done():
+                op.future.cancel()
+            self._discard(op)
+    
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            op, delay = self._next_operation(time.monotonic())
+            if op is None:
+                # Будильник вместо wait_for: тот может поглотить отмену при остановке
+                timer = asyncio.get_running_loop().call_later(delay, self._wakeup.set) if delay is not None else None
+                try:
+                    await self._wakeup.wait()
+                finally:
+                    if timer is not None:
+                        timer.cancel()
+                continue
+            
+            wait = self._bucket.time_until()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            await self._slots.acquire()
+            # Пока ждали слот, операцию могли заменить или отменить
+            if self._pending.get(op.key) is not op or op.chat_id in self._busy_chats:
+                self._slots.release()
+                continue
+            self._bucket.try_acquire()
+            self._discard(op)
+            self._busy_chats.add(op.chat_id)
+            worker = asyncio.create_task(self._execute(op))
+            self._in_flight.add(worker)
+            worker.add_done_callback(self._in_flight.discard)
+    
+    def _remember(self, key: Hashable, content: Tuple):
+        self._last_sent[key] = content
+        self._last_sent.move_to_end(key)
+        if len(self._last_sent) > self.MAX_REMEMBERED:
+            self._last_sent.popitem(last=False)
+    
+    async def _execute(self, op: _Operation):
+        try:
+            if op.kind == "edit":
+                await self.bot.edit_message_text(chat_id=op.chat_id, message_id=op.message_id, **op.kwargs)
+                self._remember(op.key, op.content)
+            elif op.kind == "delete":
+                await self.bot.delete_message(chat_id=op.chat_id, message_id=op.message_id)
+                self._last_sent.pop(op.key, None)
+            else:
+                op.future.set_result(await op.factory())
+            self.stats["sent"] += 1
+            # Аддитивное восстановление частоты после снижения из-за 429
+            self._bucket.rate = min(self.base_rate, self._bucket.rate + self.base_rate * 0.05)
+        except TelegramRetryAfter as e:
+            self.stats["retry_after"] += 1
+            now = time.monotonic()
+            self._set_ready_at(op.chat_id, now + e.retry_after, now)
+            # Серия 429 за одно окно снижает общую частоту один раз
+            if now >= self._backoff_until:
+                self._bucket.rate = max(1.0, self._bucket.rate / 2)
+                self._backoff_until = now + e.retry_after
+            logging.warning(f"Telegram просит подождать {e.retry_after} с (чат {op.chat_id})")
+            # Повторяем, если за это время не появилась более новая версия
+            if op.key not in self._pending:
+                self._enqueue(op)
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                self._remember(op.key, op.content)
+            elif op.future is not None:
+                op.future.set_exception(e)
+            else:
+                # Сообщение удалено пользователем или слишком старое — правка больше не нужна
+                self.stats["errors"] += 1
+                logging.debug(f"Не удалось обновить сообщение {op.key}: {e}")
+        except asyncio.CancelledError:
+            if op.future is not None and not op.future.done():
+                op.future.cancel()
+            raise
+        except Exception as e:
+            self.stats["errors"] += 1
+            if op.future is not None:
+                op.future.set_exception(e)
+            else:
+                logging.error(f"Ошибка при обновлении сообщения {op.key}: {e}")
+        finally:
+            now = time.monotonic()
+            self._busy_chats.discard(op.chat_id)
+            self._set_ready_at(op.chat_id, max(self._chat_ready_at.get(op.chat_id, 0.0), now + self._interval(op.chat_id)), now)
+            self._slots.release()
+            self._wake()
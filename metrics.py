@@ -0,0 +1,266 @@
+"""
+Метрики бота в текстовом формате Prometheus (/metrics)
+
+Счетчики и гистограммы обновляются на горячих путях без блокировок: все
+обновления идут из потока event loop, а запись — это сложение в словаре по
+кортежу меток. Величины, которые компоненты и так хранят (длина очереди,
+статистика кэшей, загрузка пулов), не дублируются: они снимаются функциями
+в момент запроса /metrics.
+
+Метрики отдает отдельный MetricsServer на METRICS_HOST:METRICS_PORT, а не
+сервер webhook, чтобы они не были доступны из интернета.
+"""
+import logging
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import InputFile
+from aiohttp import web
+
+from config import METRICS_HOST, METRICS_PORT
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Границы корзин гистограмм, секунды
+FAST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SLOW_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 1800, 3600)
+
+LabelValues = Tuple[str, ...]
+Sample = Union[float, Dict[LabelValues, float]]
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Iterable[str], values: Iterable) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """Монотонный счетчик с метками"""
+    
+    kind = "counter"
+    
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: Dict[LabelValues, float] = {}
+    
+    def inc(self, *label_values: str, amount: float = 1.0):
+        self._values[label_values] = self._values.get(label_values, 0.0) + amount
+    
+    def value(self, *label_values: str) -> float:
+        return self._values.get(label_values, 0.0)
+    
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labels, values)} {_format_value(value)}"
+                for values, value in self._values.items()]
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами; observe — поиск корзины и два сложения"""
+    
+    kind = "histogram"
+    
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = FAST_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        # По меткам: [счетчики корзин (последняя — +Inf), сумма]
+        self._values: Dict[LabelValues, list] = {}
+    
+    def observe(self, value: float, *label_values: str):
+        entry = self._values.get(label_values)
+        if entry is None:
+            entry = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+    
+    def count(self, *label_values: str) -> int:
+        entry = self._values.get(label_values)
+        return sum(entry[0]) if entry else 0
+    
+    def samples(self) -> List[str]:
+        lines = []
+        for values, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                labels = _format_labels((*self.labels, "le"), (*values, _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class CallbackMetric:
+    """Значение, снимаемое функцией при запросе метрик: число или {значения меток: число}"""
+    
+    def __init__(self, name: str, help: str, func: Callable[[], Sample], labels: Tuple[str, ...] = (),
+                 kind: str = "gauge"):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.kind = kind
+        self.func = func
+    
+    def samples(self) -> List[str]:
+        value = self.func()
+        if not isinstance(value, dict):
+            return [f"{self.name} {_format_value(value)}"]
+        return [f"{self.name}{_format_labels(self.labels, values)} {_format_value(sample)}"
+                for values, sample in value.items()]
+
+class Registry:
+    """Набор метрик процесса"""
+    
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+    
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+        self._metrics[metric.name] = metric
+        return metric
+    
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, help, labels))
+    
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = FAST_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))
+    
+    def gauge(self, name: str, help: str, func: Callable[[], Sample], labels: Tuple[str, ...] = ()) -> CallbackMetric:
+        return self._register(CallbackMetric(name, help, func, labels))
+    
+    def callback_counter(self, name: str, help: str, func: Callable[[], Sample],
+                         labels: Tuple[str, ...] = ()) -> CallbackMetric:
+        """Счетчик, который уже ведет компонент (например, попадания в кэш)"""
+        return self._register(CallbackMetric(name, help, func, labels, kind="counter"))
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                # Ошибка одного источника не должна ломать выдачу остальных метрик
+                logging.error(f"Ошибка при сборе метрики {metric.name}: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+# Очередь и генерация
+queue_wait_seconds = registry.histogram(
+    "sdbot_queue_wait_seconds", "Ожидание задачи в очереди до начала генерации", buckets=SLOW_BUCKETS)
+generation_seconds = registry.histogram(
+    "sdbot_generation_seconds", "Время от начала генерации задачи до ее завершения", ("outcome",), SLOW_BUCKETS)
+stage_seconds = registry.histogram(
+    "sdbot_generation_stage_seconds", "Длительность этапов генерации (GenerationStage)", ("stage",),
+    (*FAST_BUCKETS, 60, 120, 300))
+delivery_seconds = registry.histogram(
+    "sdbot_delivery_seconds", "Отправка результата одному чату", ("outcome",))
+admission_rejected = registry.counter(
+    "sdbot_admission_rejected_total", "Задачи, не принятые в очередь (admission.AdmissionRejected)", ("reason",))
+
+# SD WebUI
+sd_request_seconds = registry.histogram(
+    "sdbot_sd_request_seconds", "Задержка запросов к SD WebUI", ("endpoint",), (*FAST_BUCKETS, 60, 120, 300))
+sd_request_errors = registry.counter(
+    "sdbot_sd_request_errors_total", "Неудачные запросы к SD WebUI (сеть, 5xx, таймаут)", ("endpoint",))
+
+# Telegram Bot API
+telegram_request_seconds = registry.histogram(
+    "sdbot_telegram_request_seconds", "Задержка вызовов Telegram Bot API", ("method",))
+telegram_retry_after = registry.counter(
+    "sdbot_telegram_retry_after_total", "Ответы 429 (Too Many Requests) от Telegram", ("method",))
+telegram_errors = registry.counter(
+    "sdbot_telegram_errors_total", "Прочие ошибки вызовов Telegram Bot API", ("method",))
+telegram_upload_bytes = registry.counter(
+    "sdbot_telegram_upload_bytes_total", "Байты файлов, загруженных в Telegram", ("method",))
+
+def observe_sd_request(endpoint: str, latency: float, ok: bool):
+    """Listener StableDiffusionClient.add_listener"""
+    sd_request_seconds.observe(latency, endpoint)
+    if not ok:
+        sd_request_errors.inc(endpoint)
+
+def input_file_size(file: InputFile) -> int:
+    """Размер загружаемого файла без чтения содержимого"""
+    data = getattr(file, "data", None)
+    if data is not None:
+        return len(data)
+    stream = getattr(file, "file", None)
+    if stream is not None:
+        position = stream.tell()
+        size = stream.seek(0, 2)
+        stream.seek(position)
+        return size
+    return 0
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: задержка, 429 и загруженные байты каждого вызова Bot API"""
+    
+    async def __call__(self, make_request, bot: Bot, method):
+        name = method.__api_method__
+        # Файл уходит в запросе и при ответе 429 или ошибке
+        uploaded = sum(input_file_size(value) for value in method.__dict__.values() if isinstance(value, InputFile))
+        if uploaded:
+            telegram_upload_bytes.inc(name, amount=uploaded)
+        started = time.monotonic()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            telegram_retry_after.inc(name)
+            raise
+        except Exception:
+            telegram_errors.inc(name)
+            raise
+        finally:
+            telegram_request_seconds.observe(time.monotonic() - started, name)
+
+class MetricsServer:
+    """HTTP сервер с GET /metrics"""
+    
+    def __init__(self, registry: Registry = registry, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+    
+    async def _metrics(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.registry.render().encode(), headers={"Content-Type": CONTENT_TYPE})
+    
+    async def start(self):
+        """Запускает сервер; ошибка запуска (порт занят) не останавливает бота"""
+        app = web.Application()
+        app.router.add_get("/metrics", self._metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        try:
+            await site.start()
+        except OSError as e:
+            logging.error(f"Не удалось запустить сервер метрик на {self.host}:{self.port}: {e}")
+            await self.stop()
+            return
+        self.port = site._server.sockets[0].getsockname()[1]
+        logging.info(f"Метрики доступны на http://{self.host}:{self.port}/metrics")
+    
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,128 @@
+"""
+Каталог моделей, сэмплеров и LoRA Stable Diffusion WebUI
+
+Списки обновляются в фоне раз в MODEL_CATALOG_TTL секунд и отдаются из памяти,
+поэтому клавиатуры, /status и проверки имен не ходят в WebUI.
+Каждой модели присваивается короткий стабильный ID для callback_data
+(лимит Telegram — 64 байта).
+"""
+import asyncio
+import hashlib
+import logging
+import time
+from typing import Dict, List, Optional
+
+from config import MODEL_CATALOG_TTL
+from sd_client import StableDiffusionClient
+
+def make_model_id(model: Dict) -> str:
+    """Короткий ID модели: одинаковый для одного чекпоинта между обновлениями и перезапусками"""
+    name = model.get('title') or model.get('model_name') or ''
+    return hashlib.sha1(name.encode('utf-8')).hexdigest()[:10]
+
+class ModelCatalog:
+    """Кэш списков WebUI с фоновым обновлением по TTL"""
+    
+    def __init__(self, sd_client: StableDiffusionClient, ttl: float = MODEL_CATALOG_TTL):
+        self.sd_client = sd_client
+        self.ttl = ttl
+        self.models: List[Dict] = []
+        self.samplers: List[str] = []
+        self.loras: List[Dict] = []
+        # Текущий чекпоинт WebUI по данным /sdapi/v1/options
+        self.current_model: Optional[str] = None
+        self.refreshed_at: Optional[float] = None
+        self._by_id: Dict[str, Dict] = {}
+        self._lock = asyncio.Lock()
+        self._refresher: Optional[asyncio.Task] = None
+    
+    async def refresh(self):
+        """Перечитывает списки из WebUI; при ошибке сохраняются предыдущие данные"""
+        async with self._lock:
+            await self._refresh()
+    
+    async def _refresh(self):
+        models, samplers, loras, options = await asyncio.gather(
+            self.sd_client.get_models(),
+            self.sd_client.get_samplers(),
+            self.sd_client.get_loras(),
+            self.sd_client.get_options()
+        )
+        if models is not None:
+            self.models = models
+            self._by_id = {make_model_id(model): model for model in models}
+        if samplers is not None:
+            self.samplers = [sampler.get('name') for sampler in samplers if sampler.get('name')]
+        if loras is not None:
+            self.loras = loras
+        if options:
+            self.current_model = options.get('sd_model_checkpoint')
+        # Неудачная попытка тоже сдвигает срок, чтобы недоступный WebUI не опрашивался на каждый запрос
+        self.refreshed_at = time.monotonic()
+    
+    async def _ensure_loaded(self):
+        if self.refreshed_at is not None:
+            return
+        async with self._lock:
+            # Пока ждали блокировку, каталог мог загрузить фоновый цикл
+            if self.refreshed_at is None:
+                await self._refresh()
+    
+    async def start(self):
+        """Запускает фоновое обновление каталога"""
+        if self._refresher is None or self._refresher.done():
+            self._refresher = asyncio.create_task(self._refresh_loop(), name="model-catalog")
+    
+    async def stop(self):
+        """Останавливает фоновое обновление"""
+        if self._refresher is not None:
+            self._refresher.cancel()
+            try:
+                await self._refresher
+            except asyncio.CancelledError:
+                pass
+            self._refresher = None
+    
+    async def _refresh_loop(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logging.error(f"Ошибка при обновлении каталога моделей: {e}")
+            await asyncio.sleep(self.ttl)
+    
+    async def get_models(self) -> List[Dict]:
+        """Список моделей из памяти (при первом обращении — загрузка)"""
+        await self._ensure_loaded()
+        return self.models
+    
+    async def get_samplers(self) -> List[str]:
+        """Список имен сэмплеров из памяти"""
+        await self._ensure_loaded()
+        return self.samplers
+    
+    async def get_current_model(self) -> Optional[str]:
+        """Текущий чекпоинт WebUI из памяти"""
+        await self._ensure_loaded()
+        return self.current_model
+    
+    async def find(self, model_id: str) -> Optional[Dict]:
+        """Ищет модель по короткому ID; неизвестный ID может означать новую модель — каталог обновляется один раз"""
+        await self._ensure_loaded()
+        model = self._by_id.get(model_id)
+        if model is None and not self._lock.locked():
+            await self.refresh()
+            model = self._by_id.get(model_id)
+        return model
+    
+    async def find_by_name(self, name: str) -> Optional[Dict]:
+        """Ищет модель по имени файла (model_name) или заголовку (title)"""
+        await self._ensure_loaded()
+        return next((model for model in self.models if name in (model.get('model_name'), model.get('title'))), None)
+    
+    async def get_page(self, page: int, page_size: int) -> tuple:
+        """Возвращает (модели страницы, номер страницы, число страниц)"""
+        models = await self.get_models()
+        pages = max(1, (len(models) + page_size - 1) // page_size)
+        page = min(max(page, 0), pages - 1)
+        return models[page * page_size:(page + 1) * page_size], page, pages
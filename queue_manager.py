@@ -1,9 +1,22 @@
 import asyncio
 import time
-from typing import Dict, List, Optional, Callable
-from dataclasses import dataclass
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Hashable, List, Optional, Set, Callable
+from dataclasses import dataclass, field
 from enum import Enum
 
+from config import QUEUE_MAX_SIZE, QUEUE_DEDUP
+from scheduling import SchedulingPolicy, create_policy
+from batching import get_batch_key, get_dedup_key
+from admission import AdmissionController, AdmissionRejected, create_admission
+import metrics
+from event_log import events
+
+# Параметры задачи в записи task_enqueued журнала событий
+TRACE_PARAMETERS = ("steps", "width", "height", "batch_size", "model", "seed")
+
 class GenerationStatus(Enum):
     QUEUED = "queued"
     PROCESSING = "processing"
@@ -19,6 +32,13 @@ class GenerationStage(Enum):
     ENCODING_RESULT = "encoding_result"
     FINALIZING = "finalizing"
 
+@dataclass
+class TaskSubscriber:
+    """Получатель результата задачи: один на чат"""
+    user_id: int
+    chat_id: int
+    status_message_id: Optional[int] = None
+
 @dataclass
 class GenerationTask:
     id: str
@@ -30,143 +50,616 @@ class GenerationTask:
     started_at: Optional[float] = None
     completed_at: Optional[float] = None
     progress: float = 0.0
+    eta: Optional[float] = None
     result: Optional[Dict] = None
     error: Optional[str] = None
     parameters: Optional[Dict] = None
+    seq: int = 0
+    chat_id: Optional[int] = None
+    status_message_id: Optional[int] = None
+    # Сколько раз задача возвращалась в очередь из-за сбоя WebUI
+    attempts: int = 0
+    # Все чаты, ожидающие результат (одинаковые запросы обслуживает одна генерация)
+    subscribers: List[TaskSubscriber] = field(default_factory=list)
+    # Начало текущего этапа (метрика длительности этапов)
+    stage_started_at: Optional[float] = None
+    # Пакет брокера, в котором генерируется задача, и ее место в пакете (GENERATION_BACKEND=broker)
+    job_id: Optional[str] = None
+    job_index: int = 0
+    
+    def get_subscriber(self, chat_id: int) -> Optional[TaskSubscriber]:
+        """Возвращает подписчика задачи в чате или None"""
+        return next((subscriber for subscriber in self.subscribers if subscriber.chat_id == chat_id), None)
+
+class _FenwickTree:
+    """Дерево Фенвика над порядковыми номерами задач: O(log n) вычисление позиции в очереди"""
+    
+    MIN_CAPACITY = 1024
+    
+    def __init__(self, capacity: int = MIN_CAPACITY):
+        self._values = bytearray(capacity)
+        self._tree = [0] * (capacity + 1)
+    
+    @property
+    def capacity(self) -> int:
+        return len(self._values)
+    
+    def _rebuild(self, values: bytearray):
+        """Строит дерево за O(n) по массиву значений"""
+        self._values = values
+        tree = [0] * (len(values) + 1)
+        tree[1:] = values
+        size = len(values)
+        for i in range(1, size + 1):
+            parent = i + (i & -i)
+            if parent <= size:
+                tree[parent] += tree[i]
+        self._tree = tree
+    
+    def set(self, index: int, value: int):
+        """Устанавливает значение 0/1 в позиции index"""
+        if index >= self.capacity:
+            capacity = self.capacity
+            while capacity <= index:
+                capacity *= 2
+            self._rebuild(self._values + bytearray(capacity - self.capacity))
+        
+        delta = value - self._values[index]
+        if not delta:
+            return
+        self._values[index] = value
+        i = index + 1
+        tree = self._tree
+        size = len(tree)
+        while i < size:
+            tree[i] += delta
+            i += i & -i
+    
+    def prefix_sum(self, index: int) -> int:
+        """Сумма значений в позициях [0, index]"""
+        total = 0
+        i = min(index, self.capacity - 1) + 1
+        tree = self._tree
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+    
+    def shift(self, offset: int):
+        """Сдвигает начало дерева на offset позиций, отбрасывая префикс"""
+        values = self._values[offset:]
+        capacity = max(self.MIN_CAPACITY, len(values))
+        self._rebuild(values + bytearray(capacity - len(values)))
+    
+    def clear(self):
+        self._values = bytearray(self.MIN_CAPACITY)
+        self._tree = [0] * (self.MIN_CAPACITY + 1)
 
 class QueueManager:
-    def __init__(self):
-        self.queue: List[GenerationTask] = []
-        self.processing: Optional[GenerationTask] = None
-        self.completed_tasks: List[GenerationTask] = []
+    def __init__(self, max_queue_size: int = QUEUE_MAX_SIZE, policy: Optional[SchedulingPolicy] = None,
+                 batch_key: Callable[[GenerationTask], Optional[Hashable]] = get_batch_key,
+                 dedup_key: Optional[Callable[[str, Optional[Dict]], Optional[Hashable]]] = get_dedup_key if QUEUE_DEDUP else None,
+                 clock: Callable[[], float] = time.time, admission: Optional[AdmissionController] = None):
+        # Источник времени задач (виртуальное время в симуляторе очереди)
+        self.clock = clock
+        # Допуск задач в очередь; по умолчанию только предел max_queue_size
+        self.admission = admission if admission is not None else AdmissionController(clock=clock)
+        # Очередь в порядке поступления: O(1) добавление, извлечение и удаление по id
+        self.queue: "OrderedDict[str, GenerationTask]" = OrderedDict()
+        # Порядок запуска задач определяет политика планирования
+        self.policy = policy if policy is not None else create_policy(clock=clock)
+        # Задачи, которые сейчас генерируются (одна задача или пакеты)
+        self.processing: Dict[str, GenerationTask] = {}
+        # Сколько пакетов генерируется одновременно (больше одного — несколько worker.py)
+        self.max_active_batches = 1
+        # Число незавершенных задач каждого пакета по id его первой задачи
+        self._batch_remaining: Dict[str, int] = {}
+        self._task_batch: Dict[str, str] = {}
+        # Отмененные пакеты, генерацию которых еще прерывают: их место занято до release_batch
+        self._interrupting: Set[str] = set()
+        self.completed_tasks: Deque[GenerationTask] = deque()
         self.task_counter = 0
-        self.max_queue_size = 50
+        self.max_queue_size = max_queue_size
         self.max_completed_tasks = 100
+        self._listeners: List[Callable[[], None]] = []
+        self._cancel_listeners: List[Callable[[str], None]] = []
+        
+        # Индексы: задача по id и задачи пользователя (в порядке создания)
+        self._tasks: Dict[str, GenerationTask] = {}
+        self._user_tasks: Dict[int, Dict[str, GenerationTask]] = {}
+        
+        # Позиции в очереди: дерево Фенвика над seq - _position_base
+        self._positions = _FenwickTree()
+        self._position_base = 0
+        
+        # Совместимые для пакетной генерации задачи; порядок выбора в пакет задает политика
+        self._batch_key = batch_key
+        self._batch_groups: Dict[Hashable, SchedulingPolicy] = {}
+        
+        # Ожидающие и генерируемые задачи по ключу одинаковых запросов (None — без объединения)
+        self._dedup_key = dedup_key
+        self._inflight: Dict[Hashable, GenerationTask] = {}
+        
+        # Постоянное хранилище (см. task_store.SQLiteTaskStore), подключается при старте бота
+        self.store = None
+    
+    def add_listener(self, callback: Callable[[], None]):
+        """Подписывает callback на изменения очереди (новая задача, освобождение обработчика)"""
+        if callback not in self._listeners:
+            self._listeners.append(callback)
+    
+    def remove_listener(self, callback: Callable[[], None]):
+        """Отписывает callback от изменений очереди"""
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+    
+    def add_cancel_listener(self, callback: Callable[[str], None]):
+        """Подписывает callback(batch_id) на отмену всех задач генерируемого пакета.
+        
+        Место пакета остается занятым, пока подписчик не прервет генерацию и не вызовет release_batch.
+        """
+        if callback not in self._cancel_listeners:
+            self._cancel_listeners.append(callback)
+    
+    def remove_cancel_listener(self, callback: Callable[[str], None]):
+        if callback in self._cancel_listeners:
+            self._cancel_listeners.remove(callback)
+    
+    def release_batch(self, batch_id: str):
+        """Освобождает место отмененного пакета, когда его генерация прервана"""
+        if batch_id in self._interrupting:
+            self._interrupting.discard(batch_id)
+            del self._batch_remaining[batch_id]
+            self._notify()
+    
+    def _notify(self):
+        for callback in self._listeners:
+            callback()
+    
+    def _persist(self, task: GenerationTask):
+        if self.store is not None:
+            self.store.save(task)
+    
+    def open_store(self, store, resume_jobs: bool = False) -> List[GenerationTask]:
+        """Подключает постоянное хранилище и восстанавливает из него незавершенные задачи.
+        
+        С resume_jobs задачи, чьи пакеты уже отправлены в брокер, остаются генерируемыми:
+        их пакеты (processing_batches) продолжают выполняться на worker.
+        """
+        self.store = store
+        pending = store.load_pending()
+        if pending:
+            self.task_counter = max(self.task_counter, max(task.seq for task in pending))
+        
+        restored = []
+        jobs: Dict[str, List[GenerationTask]] = {}
+        for task in pending:
+            if task.id in self._tasks:
+                continue
+            if not task.subscribers:
+                task.subscribers = [TaskSubscriber(task.user_id, task.chat_id, task.status_message_id)]
+            if resume_jobs and task.status == GenerationStatus.PROCESSING and task.job_id:
+                jobs.setdefault(task.job_id, []).append(task)
+                restored.append(task)
+                continue
+            # Генерация, прерванная перезапуском, выполняется заново
+            task.job_id = None
+            task.status = GenerationStatus.QUEUED
+            task.stage = GenerationStage.INITIALIZING
+            task.progress = 0.0
+            task.eta = None
+            task.started_at = None
+            self.task_counter += 1
+            task.seq = self.task_counter
+            if not self.queue:
+                self._position_base = task.seq
+            self._enqueue(task)
+            self._index(task)
+            self._register_inflight(task)
+            self._persist(task)
+            restored.append(task)
         
-    def add_task(self, user_id: int, prompt: str, parameters: Optional[Dict] = None) -> GenerationTask:
-        """Добавляет задачу в очередь"""
-        if len(self.queue) >= self.max_queue_size:
-            raise Exception("Очередь переполнена. Попробуйте позже.")
+        for batch in jobs.values():
+            batch.sort(key=lambda task: task.job_index)
+            for task in batch:
+                self._index(task)
+                self._register_inflight(task)
+                self._mark_processing(task, batch[0].id)
+        
+        if restored:
+            self._notify()
+        return restored
+    
+    def _index(self, task: GenerationTask):
+        self._tasks[task.id] = task
+        self._index_user(task, task.user_id)
+        for subscriber in task.subscribers:
+            self._index_user(task, subscriber.user_id)
+    
+    def _index_user(self, task: GenerationTask, user_id: int):
+        self._user_tasks.setdefault(user_id, {})[task.id] = task
+    
+    def _unindex_user(self, task: GenerationTask, user_id: int):
+        user_tasks = self._user_tasks.get(user_id)
+        if user_tasks is not None:
+            user_tasks.pop(task.id, None)
+            if not user_tasks:
+                del self._user_tasks[user_id]
+    
+    def _unindex(self, task: GenerationTask):
+        self._tasks.pop(task.id, None)
+        self._unindex_user(task, task.user_id)
+        for subscriber in task.subscribers:
+            self._unindex_user(task, subscriber.user_id)
+    
+    def _inflight_key(self, prompt: str, parameters: Optional[Dict]) -> Optional[Hashable]:
+        return self._dedup_key(prompt, parameters) if self._dedup_key is not None else None
+    
+    def _register_inflight(self, task: GenerationTask):
+        key = self._inflight_key(task.prompt, task.parameters)
+        if key is not None:
+            self._inflight.setdefault(key, task)
+    
+    def _release_inflight(self, task: GenerationTask):
+        key = self._inflight_key(task.prompt, task.parameters)
+        if key is not None and self._inflight.get(key) is task:
+            del self._inflight[key]
+    
+    def _enqueue(self, task: GenerationTask):
+        self.queue[task.id] = task
+        self.admission.track(task, queued=1)
+        self._positions.set(task.seq - self._position_base, 1)
+        self.policy.push(task)
+        key = self._batch_key(task)
+        if key is not None:
+            group = self._batch_groups.get(key)
+            if group is None:
+                group = self._batch_groups[key] = self.policy.spawn()
+            group.push(task)
+    
+    def _dequeue(self, task_id: str, scheduled: bool = False) -> Optional[GenerationTask]:
+        task = self.queue.pop(task_id, None)
+        if task is None:
+            return None
+        self.admission.track(task, queued=-1)
+        if not scheduled:
+            self.policy.remove(task)
+        key = self._batch_key(task)
+        group = self._batch_groups.get(key) if key is not None else None
+        if group is not None:
+            group.remove(task)
+            if not group:
+                del self._batch_groups[key]
+        self._positions.set(task.seq - self._position_base, 0)
+        self._compact_positions()
+        return task
+    
+    def _compact_positions(self):
+        """Не дает дереву позиций расти бесконечно при непустой очереди"""
+        if not self.queue:
+            self._positions.clear()
+            self._position_base = self.task_counter + 1
+            return
+        head = next(iter(self.queue.values()))
+        offset = head.seq - self._position_base
+        if offset > self._positions.capacity // 2:
+            self._positions.shift(offset)
+            self._position_base = head.seq
+    
+    def _retain_completed(self, task: GenerationTask):
+        self.completed_tasks.append(task)
+        
+        # Ограничиваем количество сохраненных задач
+        if len(self.completed_tasks) > self.max_completed_tasks:
+            self._unindex(self.completed_tasks.popleft())
+    
+    def add_task(self, user_id: int, prompt: str, parameters: Optional[Dict] = None, chat_id: Optional[int] = None) -> GenerationTask:
+        """Добавляет задачу в очередь.
+        
+        Если такой же запрос уже ждет в очереди или генерируется, новая задача не создается:
+        чат подписывается на существующую и получит тот же результат.
+        """
+        chat_id = chat_id if chat_id is not None else user_id
+        existing = self._inflight.get(self._inflight_key(prompt, parameters)) if self._dedup_key is not None else None
+        if existing is not None:
+            if existing.get_subscriber(chat_id) is None:
+                existing.subscribers.append(TaskSubscriber(user_id, chat_id))
+                self._index_user(existing, user_id)
+                self._persist(existing)
+                events.emit("task_subscribed", task_id=existing.id, user_id=user_id, chat_id=chat_id,
+                            subscribers=len(existing.subscribers))
+            return existing
+        
+        try:
+            self.admission.admit(user_id, parameters, len(self.queue), self.max_queue_size, self.max_active_batches)
+        except AdmissionRejected as e:
+            metrics.admission_rejected.inc(e.reason)
+            events.emit("task_rejected", user_id=user_id, chat_id=chat_id, reason=e.reason,
+                        retry_after=round(e.retry_after, 1))
+            raise
         
         self.task_counter += 1
         task = GenerationTask(
-            id=f"task_{self.task_counter}_{int(time.time())}",
+            id=f"task_{self.task_counter}_{int(self.clock())}",
             user_id=user_id,
             prompt=prompt,
             status=GenerationStatus.QUEUED,
             stage=GenerationStage.INITIALIZING,
-            created_at=time.time(),
-            parameters=parameters or {}
+            created_at=self.clock(),
+            parameters=parameters or {},
+            seq=self.task_counter,
+            chat_id=chat_id,
+            subscribers=[TaskSubscriber(user_id, chat_id)]
         )
         
-        self.queue.append(task)
+        if not self.queue:
+            self._position_base = task.seq
+        self._enqueue(task)
+        self._index(task)
+        self._register_inflight(task)
+        self._persist(task)
+        # Параметры, влияющие на стоимость и объединение в пакеты: журнал служит трассой для симулятора очереди
+        events.emit("task_enqueued", task_id=task.id, user_id=user_id, chat_id=chat_id, queue_length=len(self.queue),
+                    prompt_crc=zlib.crc32(prompt.encode()),
+                    **{name: task.parameters[name] for name in TRACE_PARAMETERS if name in task.parameters})
+        self._notify()
         return task
     
+    def attach_status_message(self, task_id: str, chat_id: int, message_id: int):
+        """Запоминает сообщение со статусом задачи, чтобы восстановить его после перезапуска"""
+        task = self._tasks.get(task_id)
+        if task is None:
+            return
+        subscriber = task.get_subscriber(chat_id)
+        if subscriber is not None:
+            subscriber.status_message_id = message_id
+        if chat_id == task.chat_id:
+            task.status_message_id = message_id
+        self._persist(task)
+    
+    def get_task(self, task_id: str) -> Optional[GenerationTask]:
+        """Получает задачу по id"""
+        return self._tasks.get(task_id)
+    
     def get_queue_position(self, task_id: str) -> int:
-        """Получает позицию задачи в очереди"""
-        for i, task in enumerate(self.queue):
-            if task.id == task_id:
-                return i + 1
-        return -1
+        """Получает позицию задачи в очереди в порядке поступления (точную, если policy.arrival_order)"""
+        task = self.queue.get(task_id)
+        if task is None:
+            return -1
+        return self._positions.prefix_sum(task.seq - self._position_base)
     
     def get_queue_info(self) -> Dict:
         """Получает информацию о очереди"""
         return {
             "queue_length": len(self.queue),
-            "processing": self.processing is not None,
+            "processing": bool(self.processing),
             "total_tasks": self.task_counter,
-            "completed_tasks": len(self.completed_tasks)
+            "completed_tasks": len(self.completed_tasks),
+            "policy": self.policy.name
         }
     
+    def _mark_processing(self, task: GenerationTask, batch_id: str):
+        task.status = GenerationStatus.PROCESSING
+        task.started_at = task.stage_started_at = self.clock()
+        metrics.queue_wait_seconds.observe(task.started_at - task.created_at)
+        events.emit("task_started", task_id=task.id, batch_id=batch_id, attempt=task.attempts,
+                    wait_s=round(task.started_at - task.created_at, 3))
+        self.processing[task.id] = task
+        self._task_batch[task.id] = batch_id
+        self.admission.track(task, processing=1)
+        self.admission.batch_started(batch_id, task)
+        self._batch_remaining[batch_id] = self._batch_remaining.get(batch_id, 0) + 1
+        self._persist(task)
+    
+    def processing_batches(self) -> Dict[str, List[GenerationTask]]:
+        """Генерируемые пакеты: id пакета -> задачи в порядке пакета"""
+        batches: Dict[str, List[GenerationTask]] = {}
+        for task in self.processing.values():
+            batches.setdefault(self._task_batch[task.id], []).append(task)
+        return batches
+    
+    def attach_job(self, tasks: List[GenerationTask]) -> str:
+        """Запоминает пакет брокера задач, чтобы после перезапуска бота дождаться его, а не отправлять заново"""
+        job_id = tasks[0].job_id or uuid.uuid4().hex
+        for index, task in enumerate(tasks):
+            task.job_id = job_id
+            task.job_index = index
+            self._persist(task)
+        return job_id
+    
     def start_processing(self) -> Optional[GenerationTask]:
         """Начинает обработку следующей задачи"""
-        if self.processing is not None:
-            return None
-        
-        if not self.queue:
-            return None
-        
-        task = self.queue.pop(0)
-        task.status = GenerationStatus.PROCESSING
-        task.started_at = time.time()
-        self.processing = task
+        batch = self.start_batch(max_size=1)
+        return batch[0] if batch else None
+    
+    def start_batch(self, max_size: int) -> List[GenerationTask]:
+        """Начинает обработку следующей задачи вместе с совместимыми задачами из очереди"""
+        if len(self._batch_remaining) >= self.max_active_batches or not self.queue:
+            return []
         
-        return task
+        task = self.policy.pop()
+        self._dequeue(task.id, scheduled=True)
+        self._mark_processing(task, task.id)
+        batch = [task]
+        return batch + self.extend_batch(batch, max_size - 1)
     
-    def update_task_progress(self, task_id: str, stage: GenerationStage, progress: float):
+    def extend_batch(self, batch: List[GenerationTask], limit: int) -> List[GenerationTask]:
+        """Добавляет в уже запущенный пакет до limit совместимых задач из очереди в порядке политики"""
+        key = self._batch_key(batch[0]) if batch else None
+        group = self._batch_groups.get(key) if key is not None else None
+        added = []
+        while group and len(added) < limit:
+            task = group.pop()
+            self._dequeue(task.id)
+            self._mark_processing(task, self._task_batch.get(batch[0].id, batch[0].id))
+            added.append(task)
+        return added
+    
+    def update_task_progress(self, task_id: str, stage: GenerationStage, progress: float, eta: Optional[float] = None):
         """Обновляет прогресс задачи"""
-        if self.processing and self.processing.id == task_id:
-            self.processing.stage = stage
-            self.processing.progress = progress
+        task = self.processing.get(task_id)
+        if task is not None:
+            if stage is not task.stage:
+                now = self.clock()
+                metrics.stage_seconds.observe(now - task.stage_started_at, task.stage.value)
+                events.emit("task_stage", task_id=task_id, stage=stage.value, previous=task.stage.value,
+                            previous_s=round(now - task.stage_started_at, 3))
+                task.stage_started_at = now
+            task.stage = stage
+            task.progress = progress
+            task.eta = eta
+            # Хранилище схлопывает частые обновления прогресса до одной записи за сброс
+            self._persist(task)
+    
+    def _observe_finished(self, task: GenerationTask, outcome: str, **fields):
+        now = self.clock()
+        metrics.stage_seconds.observe(now - task.stage_started_at, task.stage.value)
+        metrics.generation_seconds.observe(now - task.started_at, outcome)
+        events.emit(f"task_{outcome}", task_id=task.id, stage=task.stage.value, attempt=task.attempts,
+                    generation_s=round(now - task.started_at, 3), total_s=round(now - task.created_at, 3), **fields)
+    
+    def _finish_processing(self, task: GenerationTask, cancelled: bool = False):
+        del self.processing[task.id]
+        batch_id = self._task_batch.pop(task.id)
+        self.admission.track(task, processing=-1)
+        self._batch_remaining[batch_id] -= 1
+        # Обработчик свободен, когда завершены все задачи пакета
+        if not self._batch_remaining[batch_id]:
+            self.admission.batch_finished(batch_id, task.status == GenerationStatus.COMPLETED)
+            if cancelled and self._cancel_listeners:
+                # Пакет больше никому не нужен: генерацию прерывают, иначе GPU занят до ее конца
+                self._interrupting.add(batch_id)
+                for callback in self._cancel_listeners:
+                    callback(batch_id)
+                return
+            del self._batch_remaining[batch_id]
+            self._notify()
+    
+    def requeue_task(self, task_id: str) -> bool:
+        """Возвращает генерируемую задачу в конец очереди (WebUI отказал во время генерации)"""
+        task = self.processing.get(task_id)
+        if task is None:
+            return False
+        self._observe_finished(task, "requeued")
+        task.status = GenerationStatus.QUEUED
+        task.stage = GenerationStage.INITIALIZING
+        task.progress = 0.0
+        task.eta = None
+        task.started_at = None
+        task.job_id = None
+        task.attempts += 1
+        # Новый порядковый номер: позиции в очереди считаются по seq
+        self.task_counter += 1
+        task.seq = self.task_counter
+        if not self.queue:
+            self._position_base = task.seq
+        self._enqueue(task)
+        self._persist(task)
+        self._finish_processing(task)
+        return True
     
     def complete_task(self, task_id: str, result: Dict):
         """Завершает задачу успешно"""
-        if self.processing and self.processing.id == task_id:
-            self.processing.status = GenerationStatus.COMPLETED
-            self.processing.completed_at = time.time()
-            self.processing.result = result
-            self.completed_tasks.append(self.processing)
-            
-            # Ограничиваем количество сохраненных задач
-            if len(self.completed_tasks) > self.max_completed_tasks:
-                self.completed_tasks.pop(0)
-            
-            self.processing = None
+        task = self.processing.get(task_id)
+        if task is not None:
+            self._observe_finished(task, GenerationStatus.COMPLETED.value, subscribers=len(task.subscribers))
+            task.status = GenerationStatus.COMPLETED
+            task.completed_at = self.clock()
+            task.result = result
+            self._release_inflight(task)
+            self._retain_completed(task)
+            self._persist(task)
+            self._finish_processing(task)
     
     def fail_task(self, task_id: str, error: str):
         """Завершает задачу с ошибкой"""
-        if self.processing and self.processing.id == task_id:
-            self.processing.status = GenerationStatus.FAILED
-            self.processing.completed_at = time.time()
-            self.processing.error = error
-            self.processing = None
-    
-    def cancel_task(self, task_id: str) -> bool:
-        """Отменяет задачу"""
+        task = self.processing.get(task_id)
+        if task is not None:
+            self._observe_finished(task, GenerationStatus.FAILED.value, error=error)
+            task.status = GenerationStatus.FAILED
+            task.completed_at = self.clock()
+            task.error = error
+            self._release_inflight(task)
+            self._unindex(task)
+            self._persist(task)
+            self._finish_processing(task)
+    
+    def unsubscribe(self, task_id: str, chat_id: int) -> bool:
+        """Отписывает чат от задачи, у которой есть и другие подписчики"""
+        task = self._tasks.get(task_id)
+        if task is None or task.status not in (GenerationStatus.QUEUED, GenerationStatus.PROCESSING):
+            return False
+        subscriber = task.get_subscriber(chat_id)
+        if subscriber is None or len(task.subscribers) < 2:
+            return False
+        
+        task.subscribers.remove(subscriber)
+        if not any(other.user_id == subscriber.user_id for other in task.subscribers) and subscriber.user_id != task.user_id:
+            self._unindex_user(task, subscriber.user_id)
+        self._persist(task)
+        events.emit("task_unsubscribed", task_id=task_id, chat_id=chat_id, subscribers=len(task.subscribers))
+        return True
+    
+    def cancel_task(self, task_id: str, chat_id: Optional[int] = None) -> bool:
+        """Отменяет задачу.
+        
+        С chat_id отменяется только подписка этого чата: сама генерация
+        отменяется, когда от нее отказался последний подписчик. Генерацию
+        пакета, все задачи которого отменены, прерывают подписчики
+        add_cancel_listener.
+        """
+        if chat_id is not None and self.unsubscribe(task_id, chat_id):
+            return True
+        
         # Отменяем из очереди
-        for i, task in enumerate(self.queue):
-            if task.id == task_id:
-                task.status = GenerationStatus.CANCELLED
-                self.queue.pop(i)
-                return True
+        task = self._dequeue(task_id)
+        if task is not None:
+            task.status = GenerationStatus.CANCELLED
+            task.completed_at = self.clock()
+            self._release_inflight(task)
+            self._unindex(task)
+            self._persist(task)
+            events.emit("task_cancelled", task_id=task.id, stage=None,
+                        total_s=round(task.completed_at - task.created_at, 3))
+            return True
         
         # Отменяем текущую задачу
-        if self.processing and self.processing.id == task_id:
-            self.processing.status = GenerationStatus.CANCELLED
-            self.processing = None
+        task = self.processing.get(task_id)
+        if task is not None:
+            self._observe_finished(task, GenerationStatus.CANCELLED.value)
+            task.status = GenerationStatus.CANCELLED
+            task.completed_at = self.clock()
+            self._release_inflight(task)
+            self._unindex(task)
+            self._persist(task)
+            self._finish_processing(task, cancelled=True)
             return True
         
         return False
     
     def get_user_tasks(self, user_id: int) -> List[GenerationTask]:
         """Получает задачи пользователя"""
-        user_tasks = []
-        
-        # Задачи в очереди
-        for task in self.queue:
-            if task.user_id == user_id:
-                user_tasks.append(task)
-        
-        # Текущая задача
-        if self.processing and self.processing.user_id == user_id:
-            user_tasks.append(self.processing)
+        tasks = self._user_tasks.get(user_id, {}).values()
         
-        # Завершенные задачи
-        for task in self.completed_tasks:
-            if task.user_id == user_id:
-                user_tasks.append(task)
-        
-        return user_tasks
+        # Сначала задачи в очереди, затем текущая, затем завершенные
+        order = {
+            GenerationStatus.QUEUED: 0,
+            GenerationStatus.PROCESSING: 1,
+            GenerationStatus.COMPLETED: 2
+        }
+        return sorted(tasks, key=lambda task: order.get(task.status, 3))
     
     def cleanup_old_tasks(self, max_age_hours: int = 24):
         """Очищает старые завершенные задачи"""
-        current_time = time.time()
+        current_time = self.clock()
         max_age_seconds = max_age_hours * 3600
         
-        self.completed_tasks = [
-            task for task in self.completed_tasks
-            if task.completed_at and (current_time - task.completed_at) < max_age_seconds
-        ]
+        # Задачи добавляются по времени завершения, поэтому старые всегда в начале
+        while self.completed_tasks:
+            task = self.completed_tasks[0]
+            if task.completed_at and (current_time - task.completed_at) < max_age_seconds:
+                break
+            self._unindex(self.completed_tasks.popleft())
 
 # Глобальный экземпляр менеджера очереди
-queue_manager = QueueManager() 
\ No newline at end of file
+queue_manager = QueueManager(admission=create_admission())
@@ -0,0 +1,39 @@
+"""
+Ограничение частоты операций
+
+Корзина токенов: rate токенов в секунду, не больше capacity про запас.
+"""
+import time
+from typing import Callable
+
+class TokenBucket:
+    """Корзина токенов с ленивым пополнением"""
+    
+    def __init__(self, rate: float, capacity: float, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self._updated = clock()
+    
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+    
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        """Забирает tokens, если они есть"""
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+    
+    def time_until(self, tokens: float = 1.0) -> float:
+        """Через сколько секунд будет доступно tokens токенов"""
+        self._refill()
+        if self.tokens >= tokens:
+            return 0.0
+        if self.rate <= 0:
+            return float("inf")
+        return (tokens - self.tokens) / self.rate
@@ -0,0 +1,193 @@
+"""
+Кэш результатов генерации с адресацией по содержимому запроса
+
+Ключ — хэш модели, итогового промпта, негативного промпта, параметров и seed.
+Изображения хранятся на диске, вытеснение — LRU с ограничением общего размера.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+from collections import OrderedDict
+from typing import Any, BinaryIO, Dict, Optional
+
+from config import DEFAULT_PARAMS, RESULT_CACHE_DIR, RESULT_CACHE_MAX_MB
+
+# Параметры, от которых зависит изображение (кроме промптов и seed)
+CACHE_KEY_PARAMS = ("steps", "sampler_name", "cfg_scale", "width", "height")
+
+def make_cache_key(model: Optional[str], prompt: str, negative_prompt: str, parameters: Optional[Dict], seed: int) -> str:
+    """
+    Строит ключ кэша для запроса генерации
+    
+    Args:
+        model (Optional[str]): Модель (чекпоинт), на которой генерируется изображение
+        prompt (str): Итоговый (улучшенный) промпт
+        negative_prompt (str): Негативный промпт
+        parameters (Optional[Dict]): Параметры генерации
+        seed (int): Seed, -1 — случайный
+        
+    Returns:
+        str: SHA-256 ключа в hex
+    """
+    params = DEFAULT_PARAMS.copy()
+    params.update(parameters or {})
+    canonical = {
+        "model": model or "",
+        "prompt": prompt,
+        "negative_prompt": negative_prompt,
+        "params": {name: params[name] for name in CACHE_KEY_PARAMS},
+        "seed": int(seed),
+    }
+    # 7 и 7.0 должны давать один ключ
+    canonical["params"]["cfg_scale"] = float(canonical["params"]["cfg_scale"])
+    payload = json.dumps(canonical, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ResultCache:
+    """Дисковый кэш PNG результатов с LRU вытеснением по суммарному размеру.
+    
+    Индекс (ключ -> размер) хранится в памяти, файловые операции выполняются
+    в потоках, чтобы не блокировать event loop.
+    """
+    
+    def __init__(self, directory: str = RESULT_CACHE_DIR, max_bytes: int = int(RESULT_CACHE_MAX_MB * 1024 * 1024)):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._total_bytes = 0
+    
+    def _path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.directory, f"{key}{suffix}")
+    
+    def load(self):
+        """Восстанавливает индекс по файлам на диске (старые по mtime — первыми на вытеснение)"""
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.directory):
+            key, suffix = os.path.splitext(name)
+            if suffix not in (".png", ".alias"):
+                continue
+            stat = os.stat(os.path.join(self.directory, name))
+            size = stat.st_size
+            if suffix == ".png":
+                meta_path = self._path(key, ".json")
+                size += os.path.getsize(meta_path) if os.path.exists(meta_path) else 0
+            entries.append((stat.st_mtime, key, size))
+        
+        self._entries.clear()
+        self._total_bytes = 0
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._total_bytes += size
+        self._evict()
+    
+    def stats(self) -> Dict[str, Any]:
+        """Статистика кэша для /status"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "size_mb": self._total_bytes / (1024 * 1024),
+        }
+    
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Возвращает {'image': открытый файл PNG, 'seed': int, ...} или None при промахе; файл закрывает вызывающий"""
+        if key not in self._entries:
+            self.misses += 1
+            return None
+        try:
+            result = await asyncio.to_thread(self._read, key)
+        except OSError as e:
+            logging.warning(f"Запись кэша {key} недоступна: {e}")
+            result = None
+        
+        if result is None:
+            self._drop(key)
+            self.misses += 1
+            return None
+        
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return result
+    
+    def _read(self, key: str) -> Optional[Dict[str, Any]]:
+        alias_path = self._path(key, ".alias")
+        if os.path.exists(alias_path):
+            with open(alias_path, "r", encoding="utf-8") as f:
+                target = f.read().strip()
+            if target not in self._entries:
+                return None
+            os.utime(alias_path)
+            key = target
+        
+        png_path = self._path(key, ".png")
+        metadata = {}
+        meta_path = self._path(key, ".json")
+        if os.path.exists(meta_path):
+            with open(meta_path, "r", encoding="utf-8") as f:
+                metadata = json.load(f)
+        # mtime — порядок LRU после перезапуска
+        os.utime(png_path)
+        # Файл отдается открытым: изображение уходит в Telegram частями без чтения целиком
+        image = open(png_path, "rb")
+        return {**metadata, "image": image, "cached": True}
+    
+    async def put(self, key: str, image: BinaryIO, metadata: Dict[str, Any], alias: Optional[str] = None):
+        """Сохраняет изображение; alias — дополнительный ключ (например, запрос со случайным seed)"""
+        try:
+            size = await asyncio.to_thread(self._write, key, image, metadata, alias)
+        except OSError as e:
+            logging.error(f"Не удалось сохранить результат в кэш: {e}")
+            return
+        self._add(key, size)
+        if alias and alias != key:
+            self._add(alias, len(key))
+        self._evict()
+    
+    def _write(self, key: str, image: BinaryIO, metadata: Dict[str, Any], alias: Optional[str]) -> int:
+        os.makedirs(self.directory, exist_ok=True)
+        meta = json.dumps(metadata, ensure_ascii=False).encode("utf-8")
+        for suffix, data in ((".json", meta), (".png", image)):
+            # Запись через временный файл: читатель никогда не увидит половину PNG
+            tmp_path = self._path(key, f"{suffix}.tmp")
+            with open(tmp_path, "wb") as f:
+                if isinstance(data, bytes):
+                    f.write(data)
+                else:
+                    data.seek(0)
+                    shutil.copyfileobj(data, f)
+            os.replace(tmp_path, self._path(key, suffix))
+        if alias and alias != key:
+            with open(self._path(alias, ".alias"), "w", encoding="utf-8") as f:
+                f.write(key)
+        return os.path.getsize(self._path(key, ".png")) + len(meta)
+    
+    def _add(self, key: str, size: int):
+        self._total_bytes += size - self._entries.get(key, 0)
+        self._entries[key] = size
+        self._entries.move_to_end(key)
+    
+    def _drop(self, key: str):
+        size = self._entries.pop(key, None)
+        if size is None:
+            return
+        self._total_bytes -= size
+        for suffix in (".png", ".json", ".alias"):
+            try:
+                os.remove(self._path(key, suffix))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.warning(f"Не удалось удалить файл кэша {key}{suffix}: {e}")
+    
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and self._entries:
+            key = next(iter(self._entries))
+            self._drop(key)
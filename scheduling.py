@@ -0,0 +1,333 @@
+"""
+Политики планирования очереди генерации
+
+Политика решает, какая из ожидающих задач запускается следующей.
+QueueManager хранит задачи и индексы, а политика — только порядок выбора.
+"""
+import heapq
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Set, Tuple
+
+from config import (DEFAULT_MODEL, DEFAULT_PARAMS, SCHEDULING_POLICY, USER_WEIGHTS, DEFAULT_USER_WEIGHT,
+                    MODEL_AFFINITY, MODEL_SWITCH_STARVATION_SECONDS)
+
+if TYPE_CHECKING:
+    from queue_manager import GenerationTask
+
+# Стоимость задачи с параметрами по умолчанию (steps × width × height × batch_size)
+_BASE_COST = DEFAULT_PARAMS["steps"] * DEFAULT_PARAMS["width"] * DEFAULT_PARAMS["height"] * DEFAULT_PARAMS["batch_size"]
+
+def estimate_task_cost(parameters: Optional[Dict]) -> float:
+    """
+    Оценивает стоимость генерации относительно задачи с параметрами по умолчанию
+    
+    Args:
+        parameters (Optional[Dict]): Параметры задачи
+    
+    Returns:
+        float: Стоимость, где 1.0 — генерация с DEFAULT_PARAMS
+    """
+    params = DEFAULT_PARAMS.copy()
+    params.update(parameters or {})
+    cost = params["steps"] * params["width"] * params["height"] * params["batch_size"]
+    return cost / _BASE_COST
+
+class SchedulingPolicy:
+    """Базовый интерфейс политики планирования"""
+    
+    name = "base"
+    # Задачи извлекаются в порядке поступления: позиция в очереди по порядку поступления точная
+    arrival_order = False
+    
+    def push(self, task: "GenerationTask"):
+        """Добавляет задачу в политику"""
+        raise NotImplementedError
+    
+    def pop(self) -> Optional["GenerationTask"]:
+        """Извлекает следующую задачу для запуска"""
+        raise NotImplementedError
+    
+    def remove(self, task: "GenerationTask"):
+        """Удаляет задачу (отмена) без ее запуска"""
+        raise NotImplementedError
+    
+    def __len__(self) -> int:
+        raise NotImplementedError
+    
+    def spawn(self) -> "SchedulingPolicy":
+        """Новая пустая политика с тем же порядком (выбор задач в пакет среди совместимых)"""
+        return type(self)()
+
+class FIFOPolicy(SchedulingPolicy):
+    """Строгий порядок поступления"""
+    
+    name = "fifo"
+    arrival_order = True
+    
+    def __init__(self):
+        self._tasks: "OrderedDict[str, GenerationTask]" = OrderedDict()
+    
+    def push(self, task):
+        self._tasks[task.id] = task
+    
+    def pop(self):
+        if not self._tasks:
+            return None
+        return self._tasks.popitem(last=False)[1]
+    
+    def remove(self, task):
+        self._tasks.pop(task.id, None)
+    
+    def __len__(self):
+        return len(self._tasks)
+
+class RoundRobinPolicy(SchedulingPolicy):
+    """По одной задаче от каждого пользователя по кругу"""
+    
+    name = "round_robin"
+    
+    def __init__(self):
+        self._users: "OrderedDict[int, OrderedDict[str, GenerationTask]]" = OrderedDict()
+        self._size = 0
+    
+    def push(self, task):
+        user_tasks = self._users.get(task.user_id)
+        if user_tasks is None:
+            user_tasks = self._users[task.user_id] = OrderedDict()
+        user_tasks[task.id] = task
+        self._size += 1
+    
+    def pop(self):
+        if not self._users:
+            return None
+        user_id, user_tasks = next(iter(self._users.items()))
+        task = user_tasks.popitem(last=False)[1]
+        self._size -= 1
+        
+        # Пользователь уходит в конец круга
+        if user_tasks:
+            self._users.move_to_end(user_id)
+        else:
+            del self._users[user_id]
+        return task
+    
+    def remove(self, task):
+        user_tasks = self._users.get(task.user_id)
+        if user_tasks is None or user_tasks.pop(task.id, None) is None:
+            return
+        self._size -= 1
+        if not user_tasks:
+            del self._users[task.user_id]
+    
+    def __len__(self):
+        return self._size
+
+class _HeapPolicy(SchedulingPolicy):
+    """Общая часть политик на куче с ленивым удалением"""
+    
+    def __init__(self):
+        self._heap: List[Tuple[float, int, "GenerationTask"]] = []
+        self._live: Set[str] = set()
+    
+    def _push_entry(self, key: float, task):
+        heapq.heappush(self._heap, (key, task.seq, task))
+        self._live.add(task.id)
+    
+    def _pop_entry(self) -> Optional[Tuple[float, "GenerationTask"]]:
+        while self._heap:
+            key, _, task = heapq.heappop(self._heap)
+            if task.id in self._live:
+                self._live.discard(task.id)
+                return key, task
+        return None
+    
+    def remove(self, task):
+        self._live.discard(task.id)
+        # Куча не должна разрастаться из-за отмененных задач
+        if len(self._heap) > 2 * len(self._live) + 64:
+            self._heap = [entry for entry in self._heap if entry[2].id in self._live]
+            heapq.heapify(self._heap)
+    
+    def __len__(self):
+        return len(self._live)
+
+class WeightedFairPolicy(_HeapPolicy):
+    """Взвешенная справедливая очередь (start-time fair queueing).
+    
+    Каждому пользователю достается доля GPU, пропорциональная его весу,
+    с учетом стоимости задач.
+    """
+    
+    name = "weighted_fair"
+    
+    def __init__(self, weights: Optional[Dict[int, float]] = None, default_weight: float = DEFAULT_USER_WEIGHT):
+        super().__init__()
+        self.weights = weights if weights is not None else USER_WEIGHTS
+        self.default_weight = default_weight
+        self._virtual_time = 0.0
+        self._last_finish: Dict[int, float] = {}
+        self._user_counts: Dict[int, int] = {}
+        self._finish_tags: Dict[str, float] = {}
+    
+    def push(self, task):
+        weight = self.weights.get(task.user_id, self.default_weight)
+        start = max(self._virtual_time, self._last_finish.get(task.user_id, 0.0))
+        finish = start + estimate_task_cost(task.parameters) / weight
+        self._last_finish[task.user_id] = finish
+        self._user_counts[task.user_id] = self._user_counts.get(task.user_id, 0) + 1
+        self._finish_tags[task.id] = finish
+        self._push_entry(start, task)
+    
+    def _forget(self, task):
+        self._finish_tags.pop(task.id, None)
+        count = self._user_counts.get(task.user_id, 0) - 1
+        if count > 0:
+            self._user_counts[task.user_id] = count
+            return
+        self._user_counts.pop(task.user_id, None)
+        # Без очереди пользователь не копит ни долг, ни кредит
+        if self._last_finish.get(task.user_id, 0.0) <= self._virtual_time:
+            self._last_finish.pop(task.user_id, None)
+    
+    def pop(self):
+        entry = self._pop_entry()
+        if entry is None:
+            return None
+        start, task = entry
+        self._virtual_time = max(self._virtual_time, start)
+        self._forget(task)
+        return task
+    
+    def remove(self, task):
+        if task.id in self._live:
+            self._forget(task)
+        super().remove(task)
+    
+    def spawn(self):
+        return WeightedFairPolicy(self.weights, self.default_weight)
+
+class ShortestJobFirstPolicy(_HeapPolicy):
+    """Сначала самые дешевые задачи (steps × width × height × batch_size)"""
+    
+    name = "shortest_job_first"
+    
+    def push(self, task):
+        self._push_entry(estimate_task_cost(task.parameters), task)
+    
+    def pop(self):
+        entry = self._pop_entry()
+        return entry[1] if entry else None
+
+class ModelAffinityPolicy(SchedulingPolicy):
+    """Группировка задач по чекпоинту поверх базовой политики.
+    
+    Пока загружена модель, запускаются задачи с ней (задача без явной модели
+    генерируется на DEFAULT_MODEL и входит в ее группу), порядок внутри группы
+    задает базовая политика. Смена модели происходит,
+    когда задачи текущей модели закончились или задача другой модели ждет
+    дольше starvation_window секунд. Ожидание группы отсчитывается не раньше
+    момента, когда ее модель перестала быть текущей, чтобы при перегрузке
+    модели не менялись на каждой задаче.
+    """
+    
+    def __init__(self, base_factory: Callable[[], SchedulingPolicy],
+                 starvation_window: float = MODEL_SWITCH_STARVATION_SECONDS,
+                 clock: Callable[[], float] = time.time):
+        self._base_factory = base_factory
+        self.name = f"{getattr(base_factory, 'name', 'custom')}+model_affinity"
+        self.starvation_window = starvation_window
+        self.clock = clock
+        # Модель последней запущенной задачи (None — неизвестна)
+        self.current_model: Optional[str] = None
+        self._groups: Dict[str, SchedulingPolicy] = {}
+        # Задачи группы в порядке поступления: самая давняя — первая
+        self._arrivals: Dict[str, "OrderedDict[str, GenerationTask]"] = {}
+        # Когда модель перестала быть текущей
+        self._switched_away_at: Dict[str, float] = {}
+        self._size = 0
+    
+    @staticmethod
+    def _model(task) -> str:
+        return (task.parameters or {}).get("model") or DEFAULT_MODEL
+    
+    def _oldest(self, model: str) -> float:
+        return next(iter(self._arrivals[model].values())).created_at
+    
+    def _waiting_since(self, model: str) -> float:
+        return max(self._oldest(model), self._switched_away_at.get(model, float("-inf")))
+    
+    def push(self, task):
+        model = self._model(task)
+        group = self._groups.get(model)
+        if group is None:
+            group = self._groups[model] = self._base_factory()
+            self._arrivals[model] = OrderedDict()
+        group.push(task)
+        self._arrivals[model][task.id] = task
+        self._size += 1
+    
+    def _choose_group(self) -> str:
+        if self.current_model not in self._groups:
+            return min(self._groups, key=self._oldest)
+        others = [model for model in self._groups if model != self.current_model]
+        if others:
+            # Редкая модель не ждет бесконечно: по истечении окна переключаемся на нее
+            starved_model = min(others, key=self._waiting_since)
+            if self.clock() - self._waiting_since(starved_model) >= self.starvation_window:
+                return starved_model
+        return self.current_model
+    
+    def pop(self):
+        if not self._size:
+            return None
+        model = self._choose_group()
+        task = self._groups[model].pop()
+        self._forget(model, task)
+        if self.current_model is not None and model != self.current_model:
+            self._switched_away_at[self.current_model] = self.clock()
+        self.current_model = model
+        return task
+    
+    def remove(self, task):
+        model = self._model(task)
+        arrivals = self._arrivals.get(model)
+        if arrivals is None or task.id not in arrivals:
+            return
+        self._groups[model].remove(task)
+        self._forget(model, task)
+    
+    def _forget(self, model: str, task):
+        arrivals = self._arrivals[model]
+        del arrivals[task.id]
+        self._size -= 1
+        if not arrivals:
+            del self._arrivals[model]
+            del self._groups[model]
+            self._switched_away_at.pop(model, None)
+    
+    def __len__(self):
+        return self._size
+    
+    def spawn(self):
+        # Совместимые для пакета задачи используют одну модель
+        return self._base_factory()
+
+POLICIES = {
+    policy.name: policy
+    for policy in (FIFOPolicy, RoundRobinPolicy, WeightedFairPolicy, ShortestJobFirstPolicy)
+}
+
+def create_policy(name: str = SCHEDULING_POLICY, model_affinity: bool = MODEL_AFFINITY,
+                  clock: Callable[[], float] = time.time) -> SchedulingPolicy:
+    """Создает политику планирования по имени из config.SCHEDULING_POLICY.
+    
+    С model_affinity задачи дополнительно группируются по чекпоинту.
+    """
+    try:
+        policy_class = POLICIES[name]
+    except KeyError:
+        raise ValueError(f"Неизвестная политика планирования: {name}. Доступны: {', '.join(POLICIES)}")
+    if model_affinity:
+        return ModelAffinityPolicy(policy_class, clock=clock)
+    return policy_class()
@@ -1,26 +1,131 @@
-import requests
-import base64
+import asyncio
 import json
-from typing import Dict, Any, Optional
-from config import SD_WEBUI_URL, DEFAULT_PARAMS
+import logging
+import time
+from typing import Callable, Dict, Any, List, Optional, Union
+
+import aiohttp
+
+from config import (SD_WEBUI_URL, DEFAULT_PARAMS, DEFAULT_MODEL, SD_POOL_SIZE, SD_KEEPALIVE_TIMEOUT, SD_REQUEST_TIMEOUT, SD_PROGRESS_TIMEOUT,
+                    SD_STREAM_CHUNK_SIZE)
+from circuit_breaker import CircuitBreaker
+from image_stream import ImageResponseParser
 
 class StableDiffusionClient:
-    def __init__(self, base_url: str = SD_WEBUI_URL):
+    def __init__(self, base_url: str = SD_WEBUI_URL, pool_size: int = SD_POOL_SIZE):
         self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        self._session: Optional[aiohttp.ClientSession] = None
+        # Текущая модель WebUI (sd_model_checkpoint), None — еще не известна
+        self.current_model: Optional[str] = None
+        # При недоступном WebUI запросы отклоняются сразу, без ожидания таймаута
+        self.breaker = CircuitBreaker()
+        self._listeners: List[Callable[[str, float, bool], None]] = []
+    
+    def add_listener(self, callback: Callable[[str, float, bool], None]):
+        """Подписывает callback(endpoint, latency, ok) на завершение каждого запроса к WebUI"""
+        if callback not in self._listeners:
+            self._listeners.append(callback)
+    
+    def _observe(self, endpoint: str, started: float, ok: bool):
+        latency = time.monotonic() - started
+        for callback in self._listeners:
+            callback(endpoint, latency, ok)
+    
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Возвращает общую сессию с ограниченным пулом keep-alive соединений"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                keepalive_timeout=SD_KEEPALIVE_TIMEOUT
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+    
+    async def close(self):
+        """Закрывает сессию и все соединения пула"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+    
+    async def _request(self, method: str, endpoint: str, timeout: float, data: Optional[Dict[str, Any]] = None,
+                       stream_images: bool = False) -> Optional[Any]:
+        """Выполняет запрос к Stable Diffusion WebUI API через автоматический выключатель.
+        
+        stream_images — ответ с изображениями разбирается потоково, поле images
+        содержит файлы с уже декодированными байтами.
+        """
+        if not self.breaker.allow_request():
+            logging.debug(f"SD WebUI недоступен, запрос {endpoint} отклонен без обращения к сети")
+            return None
         
-    def _make_request(self, endpoint: str, data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-        """Выполняет запрос к Stable Diffusion WebUI API"""
+        started = time.monotonic()
         try:
             url = f"{self.base_url}{endpoint}"
-            response = requests.post(url, json=data, timeout=300)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            print(f"Ошибка при запросе к SD WebUI: {e}")
+            session = self._get_session()
+            async with session.request(method, url, json=data, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                response.raise_for_status()
+                if stream_images:
+                    result = await self._read_images(response)
+                else:
+                    result = await response.json()
+        except aiohttp.ClientResponseError as e:
+            logging.error(f"Ошибка при {method} запросе к SD WebUI {endpoint}: {e!r}")
+            # 4xx — ошибка запроса, а не признак недоступности WebUI
+            if e.status >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.release()
+            self._observe(endpoint, started, e.status < 500)
+            return None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"Ошибка при {method} запросе к SD WebUI {endpoint}: {e!r}")
+            self.breaker.record_failure()
+            self._observe(endpoint, started, False)
+            return None
+        except ValueError as e:
+            # WebUI ответил, но тело не разбирается — это не признак его недоступности
+            logging.error(f"Некорректный ответ SD WebUI {endpoint}: {e}")
+            self.breaker.release()
+            self._observe(endpoint, started, False)
             return None
+        except BaseException:
+            # Отмена (прогресс, прерывание, остановка) не говорит о состоянии WebUI,
+            # но пробный запрос полуоткрытого выключателя должен быть освобожден
+            self.breaker.release()
+            raise
+        
+        self.breaker.record_success()
+        self._observe(endpoint, started, True)
+        return result
+    
+    async def _read_images(self, response: aiohttp.ClientResponse) -> Dict[str, Any]:
+        """Читает ответ частями: base64 изображений декодируется по мере поступления"""
+        parser = ImageResponseParser()
+        try:
+            async for chunk in response.content.iter_chunked(SD_STREAM_CHUNK_SIZE):
+                parser.feed(chunk)
+            return parser.finish()
+        except BaseException:
+            parser.close()
+            raise
+    
+    async def _make_request(self, endpoint: str, data: Dict[str, Any], timeout: float = SD_REQUEST_TIMEOUT,
+                            stream_images: bool = False) -> Optional[Dict[str, Any]]:
+        """Выполняет POST запрос к Stable Diffusion WebUI API"""
+        return await self._request("POST", endpoint, timeout, data, stream_images=stream_images)
     
-    def txt2img(self, prompt: str, **kwargs) -> Optional[Dict[str, Any]]:
-        """Генерирует изображение из текста"""
+    async def _get(self, endpoint: str, timeout: float) -> Optional[Any]:
+        """Выполняет GET запрос к Stable Diffusion WebUI API"""
+        return await self._request("GET", endpoint, timeout)
+    
+    async def txt2img(self, prompt: Union[str, List[str]], model: Optional[str] = None, **kwargs) -> Optional[Dict[str, Any]]:
+        """Генерирует изображение из текста (список промптов — по одному на изображение пакета).
+        
+        В результате images — файлы с байтами PNG (см. image_stream), их закрывает вызывающий код.
+        model — чекпоинт этого запроса (override_settings, без него — DEFAULT_MODEL):
+        чекпоинт, оставшийся от предыдущей задачи, не влияет на следующую.
+        """
         # Объединяем параметры по умолчанию с переданными
         params = DEFAULT_PARAMS.copy()
         params.update(kwargs)
@@ -34,60 +139,79 @@ class StableDiffusionClient:
             "cfg_scale": params["cfg_scale"],
             "width": params["width"],
             "height": params["height"],
-            "batch_size": params["batch_size"]
+            "batch_size": params["batch_size"],
+            "seed": params["seed"]
         }
+        # Модель остается загруженной после запроса: следующая задача с ней не ждет загрузки
+        model = model or DEFAULT_MODEL
+        data["override_settings"] = {"sd_model_checkpoint": model}
+        data["override_settings_restore_afterwards"] = False
+        
+        result = await self._make_request("/sdapi/v1/txt2img", data, stream_images=True)
+        if result is not None:
+            self.current_model = model
+            self._record_generation_info(result, data)
+        return result
+    
+    def _record_generation_info(self, result: Dict[str, Any], data: Dict[str, Any]):
+        """Сохраняет в результате фактический seed и итоговые параметры генерации"""
+        info = result.get('info')
+        if isinstance(info, str):
+            try:
+                info = json.loads(info)
+            except ValueError:
+                info = None
+        info = info if isinstance(info, dict) else {}
         
-        return self._make_request("/sdapi/v1/txt2img", data)
+        seed = info.get('seed', data['seed'])
+        result['seed'] = seed
+        result['all_seeds'] = info.get('all_seeds') or [seed]
+        effective = {key: value for key, value in data.items() if not key.startswith('override_settings')}
+        result['effective_params'] = {
+            **effective,
+            'seed': seed,
+            'sampler_name': info.get('sampler_name', data['sampler_name']),
+            'model': info.get('sd_model_name') or self.current_model
+        }
+    
+    async def get_current_model(self) -> Optional[str]:
+        """Возвращает текущую модель WebUI (запрашивается один раз, затем из памяти)"""
+        if self.current_model is None:
+            options = await self.get_options()
+            if options:
+                self.current_model = options.get('sd_model_checkpoint')
+        return self.current_model
+    
+    async def get_progress(self) -> Optional[Dict[str, Any]]:
+        """Получает прогресс текущей генерации (progress, eta_relative, state)"""
+        return await self._get("/sdapi/v1/progress?skip_current_image=true", timeout=SD_PROGRESS_TIMEOUT)
+    
+    async def interrupt(self):
+        """Прерывает текущую генерацию WebUI: txt2img вернется после ближайшего шага"""
+        await self._make_request("/sdapi/v1/interrupt", {}, timeout=SD_PROGRESS_TIMEOUT)
     
-    def get_models(self) -> Optional[list]:
+    async def get_models(self) -> Optional[list]:
         """Получает список доступных моделей"""
-        try:
-            response = requests.get(f"{self.base_url}/sdapi/v1/sd-models", timeout=10)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            print(f"Ошибка при получении списка моделей: {e}")
-            return None
+        return await self._get("/sdapi/v1/sd-models", timeout=10)
     
-    def switch_model(self, model_name: str) -> bool:
-        """Переключает модель"""
-        try:
-            # Получаем список моделей для проверки
-            models = self.get_models()
-            if not models:
-                print(f"Не удалось получить список моделей")
-                return False
-            
-            # Ищем модель по имени
-            model_found = False
-            for model in models:
-                if model.get('model_name') == model_name or model.get('title') == model_name:
-                    model_found = True
-                    break
-            
-            if not model_found:
-                print(f"Модель '{model_name}' не найдена в списке доступных моделей")
-                return False
-            
-            # Отправляем запрос на смену модели
-            data = {"sd_model_checkpoint": model_name}
-            result = self._make_request("/sdapi/v1/options", data)
-            
-            if result is not None:
-                print(f"Модель успешно переключена на: {model_name}")
-                return True
-            else:
-                print(f"Ошибка при переключении модели на: {model_name}")
-                return False
-                
-        except Exception as e:
-            print(f"Исключение при переключении модели: {e}")
-            return False
+    async def get_samplers(self) -> Optional[list]:
+        """Получает список доступных сэмплеров"""
+        return await self._get("/sdapi/v1/samplers", timeout=10)
+    
+    async def get_loras(self) -> Optional[list]:
+        """Получает список доступных LoRA"""
+        return await self._get("/sdapi/v1/loras", timeout=10)
     
-    def is_available(self) -> bool:
+    async def get_options(self) -> Optional[Dict[str, Any]]:
+        """Получает настройки WebUI (в том числе текущий чекпоинт sd_model_checkpoint)"""
+        return await self._get("/sdapi/v1/options", timeout=10)
+    
+    async def is_available(self) -> bool:
         """Проверяет доступность SD WebUI"""
         try:
-            response = requests.get(f"{self.base_url}/sdapi/v1/sd-models", timeout=5)
-            return response.status_code == 200
-        except:
-            return False 
\ No newline at end of file
+            url = f"{self.base_url}/sdapi/v1/sd-models"
+            session = self._get_session()
+            async with session.get(url, timeout=aiohttp.ClientTimeout(total=5)) as response:
+                return response.status == 200
+        except Exception:
+            return False
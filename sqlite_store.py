@@ -0,0 +1,116 @@
+"""
+Общие утилиты для встроенных SQLite хранилищ
+
+Подключение в режиме WAL и фоновая запись пакетами (write-behind):
+горячий путь только кладет изменения в память, а отдельный поток
+периодически записывает их одной транзакцией.
+"""
+import logging
+import os
+import sqlite3
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional
+
+def connect_sqlite(path: str) -> sqlite3.Connection:
+    """Открывает базу в режиме WAL, общую для потока записи и читателей"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+# Маркер удаления записи в буфере write-behind
+DELETE = object()
+
+class WriteBehindWriter:
+    """Буфер изменений с фоновой пакетной записью.
+    
+    put()/delete() только обновляют словарь в памяти, поэтому повторные изменения
+    одного ключа между сбросами схлопываются в одну запись.
+    """
+    
+    def __init__(self, conn: sqlite3.Connection, flush_batch: Callable[[sqlite3.Connection, Dict[Hashable, Any]], None],
+                 interval: float, name: str = "sqlite-writer",
+                 on_idle: Optional[Callable[[sqlite3.Connection], None]] = None):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.interval = interval
+        self._flush_batch = flush_batch
+        self._on_idle = on_idle
+        self._pending: Dict[Hashable, Any] = {}
+        self._pending_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._flushed = threading.Condition()
+        self._generation = 0
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+    
+    def put(self, key: Hashable, value: Any):
+        with self._pending_lock:
+            self._pending[key] = value
+    
+    def delete(self, key: Hashable):
+        with self._pending_lock:
+            self._pending[key] = DELETE
+    
+    def _write_pending(self) -> bool:
+        with self._pending_lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return False
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self._flush_batch(self.conn, batch)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                # Возвращаем несохраненные изменения, не затирая более новые
+                with self._pending_lock:
+                    for key, value in batch.items():
+                        self._pending.setdefault(key, value)
+                raise
+        return True
+    
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                written = self._write_pending()
+                if not written and self._on_idle is not None and not self._stopped:
+                    with self.lock:
+                        self._on_idle(self.conn)
+            except Exception as e:
+                logging.error(f"Ошибка фоновой записи в SQLite ({self._thread.name}): {e}")
+            with self._flushed:
+                self._generation += 1
+                self._flushed.notify_all()
+            if self._stopped:
+                return
+    
+    def flush(self, timeout: float = 5.0):
+        """Сбрасывает накопленные изменения и ждет завершения записи"""
+        if not self._thread.is_alive():
+            return
+        with self._flushed:
+            # Текущая итерация могла забрать буфер до наших изменений — ждем следующую
+            target = self._generation + 2
+            self._wake.set()
+            self._flushed.wait_for(lambda: self._generation >= target, timeout=timeout)
+    
+    def close(self):
+        """Записывает остаток изменений, останавливает поток и закрывает базу"""
+        self._stopped = True
+        self._wake.set()
+        self._thread.join()
+        # Поток мог завершиться с ошибкой — пробуем записать остаток напрямую
+        try:
+            self._write_pending()
+        except Exception as e:
+            logging.error(f"Не удалось записать изменения при закрытии SQLite: {e}")
+        self.conn.close()
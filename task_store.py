@@ -0,0 +1,142 @@
+"""
+Постоянное хранилище задач генерации на SQLite
+
+Очередь переживает перезапуск бота: при старте восстанавливаются задачи
+в статусе QUEUED и зависшие PROCESSING (с пакетом брокера — вместе с ним). Запись идет пакетами в фоне,
+поэтому операции очереди остаются субмиллисекундными.
+"""
+import json
+import time
+from typing import Dict, List
+
+from config import QUEUE_DB_PATH, QUEUE_FLUSH_INTERVAL, QUEUE_DB_RETENTION_HOURS
+from queue_manager import GenerationTask, GenerationStatus, GenerationStage, TaskSubscriber
+from sqlite_store import DELETE, WriteBehindWriter, connect_sqlite
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    chat_id INTEGER,
+    status_message_id INTEGER,
+    prompt TEXT NOT NULL,
+    status TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    progress REAL NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    completed_at REAL,
+    error TEXT,
+    parameters TEXT,
+    subscribers TEXT,
+    job_id TEXT,
+    job_index INTEGER
+);
+CREATE INDEX IF NOT EXISTS tasks_status_seq ON tasks (status, seq);
+"""
+
+_COLUMNS = (
+    "id", "seq", "user_id", "chat_id", "status_message_id", "prompt", "status", "stage",
+    "progress", "created_at", "started_at", "completed_at", "error", "parameters", "subscribers",
+    "job_id", "job_index"
+)
+
+_UPSERT = f"INSERT OR REPLACE INTO tasks ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})"
+
+_ACTIVE_STATUSES = (GenerationStatus.QUEUED.value, GenerationStatus.PROCESSING.value)
+
+def _task_to_row(task: GenerationTask) -> tuple:
+    return (
+        task.id, task.seq, task.user_id, task.chat_id, task.status_message_id, task.prompt,
+        task.status.value, task.stage.value, task.progress, task.created_at, task.started_at,
+        task.completed_at, task.error, json.dumps(task.parameters or {}),
+        json.dumps([vars(subscriber) for subscriber in task.subscribers]),
+        task.job_id, task.job_index
+    )
+
+def _row_to_task(row: tuple) -> GenerationTask:
+    values = dict(zip(_COLUMNS, row))
+    return GenerationTask(
+        id=values["id"],
+        user_id=values["user_id"],
+        prompt=values["prompt"],
+        status=GenerationStatus(values["status"]),
+        stage=GenerationStage(values["stage"]),
+        created_at=values["created_at"],
+        started_at=values["started_at"],
+        completed_at=values["completed_at"],
+        progress=values["progress"],
+        error=values["error"],
+        parameters=json.loads(values["parameters"] or "{}"),
+        seq=values["seq"],
+        chat_id=values["chat_id"],
+        status_message_id=values["status_message_id"],
+        subscribers=[TaskSubscriber(**subscriber) for subscriber in json.loads(values["subscribers"] or "[]")],
+        job_id=values["job_id"],
+        job_index=values["job_index"] or 0
+    )
+
+def _flush_batch(conn, batch: Dict[str, object]):
+    upserts = [row for row in batch.values() if row is not DELETE]
+    deletes = [(task_id,) for task_id, row in batch.items() if row is DELETE]
+    if upserts:
+        conn.executemany(_UPSERT, upserts)
+    if deletes:
+        conn.executemany("DELETE FROM tasks WHERE id = ?", deletes)
+
+class SQLiteTaskStore:
+    """Хранилище задач в SQLite (WAL) с пакетной фоновой записью"""
+    
+    def __init__(self, path: str = QUEUE_DB_PATH, flush_interval: float = QUEUE_FLUSH_INTERVAL,
+                 retention_hours: float = QUEUE_DB_RETENTION_HOURS):
+        self.path = path
+        self.retention_seconds = retention_hours * 3600
+        self._last_prune = 0.0
+        conn = connect_sqlite(path)
+        conn.executescript(_SCHEMA)
+        # Базы, созданные до появления подписчиков и пакетов брокера
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(tasks)")}
+        for column, kind in (("subscribers", "TEXT"), ("job_id", "TEXT"), ("job_index", "INTEGER")):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE tasks ADD COLUMN {column} {kind}")
+        self._writer = WriteBehindWriter(
+            conn, _flush_batch, flush_interval, name="task-store-writer", on_idle=self._prune
+        )
+    
+    def save(self, task: GenerationTask):
+        """Запоминает состояние задачи; запись на диск произойдет при ближайшем сбросе"""
+        self._writer.put(task.id, _task_to_row(task))
+    
+    def delete(self, task_id: str):
+        """Удаляет задачу из хранилища"""
+        self._writer.delete(task_id)
+    
+    def load_pending(self) -> List[GenerationTask]:
+        """Загружает незавершенные задачи (QUEUED и PROCESSING) в порядке поступления"""
+        self._writer.flush()
+        with self._writer.lock:
+            rows = self._writer.conn.execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM tasks WHERE status IN (?, ?) ORDER BY seq",
+                _ACTIVE_STATUSES
+            ).fetchall()
+        return [_row_to_task(row) for row in rows]
+    
+    def _prune(self, conn):
+        """Удаляет старые завершенные задачи (вызывается в потоке записи при простое)"""
+        now = time.time()
+        if now - self._last_prune < 600:
+            return
+        self._last_prune = now
+        conn.execute(
+            "DELETE FROM tasks WHERE status NOT IN (?, ?) AND completed_at < ?",
+            (*_ACTIVE_STATUSES, now - self.retention_seconds)
+        )
+    
+    def flush(self):
+        """Принудительно записывает накопленные изменения"""
+        self._writer.flush()
+    
+    def close(self):
+        """Записывает остаток изменений и закрывает базу"""
+        self._writer.close()
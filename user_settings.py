@@ -0,0 +1,37 @@
+"""
+Пользовательские настройки генерации
+
+Выбор модели — личная настройка пользователя: она подставляется в параметры
+его задач и не меняет модель WebUI для остальных. Задача без выбранной модели
+получает DEFAULT_MODEL, а не чекпоинт, оставшийся от чужой задачи.
+"""
+from typing import Dict, Optional
+
+from config import DEFAULT_MODEL
+
+class UserSettings:
+    """Настройки пользователей в памяти процесса"""
+    
+    def __init__(self):
+        self._models: Dict[int, str] = {}
+    
+    def get_model(self, user_id: int) -> Optional[str]:
+        """Возвращает выбранную пользователем модель или None (модель по умолчанию)"""
+        return self._models.get(user_id)
+    
+    def set_model(self, user_id: int, model: Optional[str]):
+        """Запоминает модель для следующих генераций пользователя, None — сброс"""
+        if model:
+            self._models[user_id] = model
+        else:
+            self._models.pop(user_id, None)
+    
+    def apply(self, user_id: int, parameters: Optional[Dict]) -> Dict:
+        """Возвращает параметры задачи с моделью пользователя (или DEFAULT_MODEL), если модель не задана явно"""
+        parameters = dict(parameters or {})
+        if not parameters.get('model'):
+            parameters['model'] = self.get_model(user_id) or DEFAULT_MODEL
+        return parameters
+
+# Глобальный экземпляр настроек пользователей
+user_settings = UserSettings()
@@ -0,0 +1,165 @@
+"""
+Прием обновлений Telegram через webhook во встроенном aiohttp сервере
+
+Альтернатива long polling для продакшена: Telegram сам присылает обновления,
+несколько реплик бота могут стоять за балансировщиком. Запрос проверяется по
+секретному токену и подтверждается ответом 200 сразу, а обработка идет в фоне
+с ограничением числа одновременно обрабатываемых обновлений. Если принятых и
+еще не обработанных обновлений слишком много, Telegram получает 503 и повторит
+доставку позже.
+
+GET /healthz — процесс жив, GET /readyz — бот запущен и принимает обновления.
+"""
+import asyncio
+import logging
+import re
+import signal
+from typing import Any, Dict, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from config import (
+    WEBHOOK_HOST, WEBHOOK_MAX_CONCURRENT_UPDATES, WEBHOOK_MAX_PENDING_UPDATES,
+    WEBHOOK_PATH, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_URL
+)
+
+# Допустимый секрет webhook по документации Bot API
+_SECRET_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,256}$")
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Обработчик webhook: ответ 200 сразу, обработка в фоне не более max_concurrent обновлений одновременно"""
+    
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str,
+                 max_concurrent: int = WEBHOOK_MAX_CONCURRENT_UPDATES,
+                 max_pending: int = WEBHOOK_MAX_PENDING_UPDATES, **data: Any):
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token, **data)
+        self.max_pending = max_pending
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self.stats = {"accepted": 0, "rejected_overload": 0, "unauthorized": 0, "errors": 0}
+    
+    @property
+    def pending(self) -> int:
+        """Принятые, но еще не обработанные обновления (включая обрабатываемые)"""
+        return len(self._background_feed_update_tasks)
+    
+    async def handle(self, request: web.Request) -> web.Response:
+        response = await super().handle(request)
+        if response.status == 401:
+            self.stats["unauthorized"] += 1
+            logging.warning(f"Webhook: запрос с неверным секретом от {request.remote}")
+        return response
+    
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        if self.pending >= self.max_pending:
+            # Telegram повторит доставку; обновление не теряется
+            self.stats["rejected_overload"] += 1
+            return web.Response(status=503, text="Overloaded")
+        self.stats["accepted"] += 1
+        return await super()._handle_request_background(bot, request)
+    
+    async def close(self, timeout: float = 30.0):
+        """Дожидается обработки принятых обновлений; сессию бота закрывает WebhookServer после dp.shutdown"""
+        tasks = set(self._background_feed_update_tasks)
+        if tasks:
+            logging.info(f"Webhook: ожидание обработки {len(tasks)} обновлений")
+            await asyncio.wait(tasks, timeout=timeout)
+    
+    async def _background_feed_update(self, bot: Bot, update: Dict[str, Any]):
+        async with self._semaphore:
+            try:
+                await super()._background_feed_update(bot, update)
+            except Exception as e:
+                self.stats["errors"] += 1
+                logging.error(f"Ошибка при обработке обновления {update.get('update_id')}: {e}")
+
+class WebhookServer:
+    """Встроенный aiohttp сервер webhook с эндпоинтами здоровья.
+    
+    Запуск и остановка диспетчера (dp.startup / dp.shutdown) привязаны к жизненному
+    циклу приложения; дополнительные маршруты можно добавить в app до run().
+    """
+    
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, url: str = WEBHOOK_URL, path: str = WEBHOOK_PATH,
+                 secret_token: str = WEBHOOK_SECRET, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT,
+                 max_concurrent: int = WEBHOOK_MAX_CONCURRENT_UPDATES, max_pending: int = WEBHOOK_MAX_PENDING_UPDATES):
+        if not _SECRET_PATTERN.match(secret_token or ""):
+            raise ValueError("WEBHOOK_SECRET не задан или содержит недопустимые символы (A-Z, a-z, 0-9, _ и -)")
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.url = url.rstrip("/") + path if url else ""
+        self.path = path
+        self.secret_token = secret_token
+        self.host = host
+        self.port = port
+        self.ready = False
+        self.handler = BoundedRequestHandler(dispatcher, bot, secret_token, max_concurrent, max_pending)
+        self.app = web.Application()
+        self.handler.register(self.app, path=path)
+        self.app.router.add_get("/healthz", self._healthz)
+        self.app.router.add_get("/readyz", self._readyz)
+        setup_application(self.app, dispatcher, bot=bot)
+        # После dp.startup: сервисы бота запущены, можно принимать обновления
+        self.app.on_startup.append(self._on_startup)
+        self.app.on_shutdown.insert(0, self._on_shutdown)
+        self._runner: Optional[web.AppRunner] = None
+    
+    async def _on_startup(self, app: web.Application):
+        if self.url:
+            await self.bot.set_webhook(
+                self.url,
+                secret_token=self.secret_token,
+                allowed_updates=self.dispatcher.resolve_used_update_types(),
+                drop_pending_updates=False
+            )
+            logging.info(f"Webhook зарегистрирован: {self.url}")
+        self.ready = True
+    
+    async def _on_shutdown(self, app: web.Application):
+        # Балансировщик перестает слать запросы; webhook не удаляется — его обслуживают другие реплики
+        self.ready = False
+    
+    async def _healthz(self, request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok"})
+    
+    async def _readyz(self, request: web.Request) -> web.Response:
+        payload = {
+            "status": "ready" if self.ready else "not_ready",
+            "pending_updates": self.handler.pending,
+            **self.handler.stats,
+        }
+        return web.json_response(payload, status=200 if self.ready else 503)
+    
+    async def start(self):
+        """Запускает HTTP сервер (и вместе с ним dp.startup)"""
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        # Порт 0 — свободный порт, выбранный системой
+        self.port = site._server.sockets[0].getsockname()[1]
+        logging.info(f"Сервер webhook слушает {self.host}:{self.port}{self.path}")
+    
+    async def stop(self):
+        """Останавливает сервер, дожидается обработки принятых обновлений и выполняет dp.shutdown"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+            await self.bot.session.close()
+    
+    async def run(self):
+        """Работает до SIGINT/SIGTERM"""
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stopped.set)
+            except NotImplementedError:
+                # Windows: остановка по KeyboardInterrupt
+                pass
+        await self.start()
+        try:
+            await stopped.wait()
+        finally:
+            await self.stop()
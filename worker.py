@@ -0,0 +1,171 @@
+"""
+Процесс генерации для режима GENERATION_BACKEND=broker
+
+Берет пакеты из брокера, выполняет их на своем SD WebUI (SD_WEBUI_URL) и
+возвращает результаты боту: прогресс — событиями, изображения — файлами в
+BROKER_FILES_DIR. Процессов может быть несколько, например по одному на GPU
+(BROKER_MAX_ACTIVE_JOBS в боте — их число). Пока WebUI недоступен, worker
+не берет пакеты, и их забирают другие.
+
+Запуск: python worker.py
+"""
+import asyncio
+import logging
+import os
+import shutil
+import signal
+import socket
+from typing import Any, Dict, List, Optional
+
+from backend_health import BackendHealthMonitor
+from broker import Broker, Job, create_broker, remove_result_files
+from config import BROKER_FILES_DIR, BROKER_LEASE_SECONDS, BROKER_POLL_INTERVAL
+from generation import close_images, generate_batch
+from queue_manager import GenerationStage
+from sd_client import StableDiffusionClient
+
+class GenerationWorker:
+    """Цикл worker: аренда пакета, генерация с продлением аренды, возврат результата"""
+    
+    def __init__(self, broker: Broker, sd_client: StableDiffusionClient, files_dir: str = BROKER_FILES_DIR,
+                 lease_seconds: float = BROKER_LEASE_SECONDS, poll_interval: float = BROKER_POLL_INTERVAL,
+                 worker_id: Optional[str] = None):
+        self.broker = broker
+        self.sd_client = sd_client
+        self.backend = BackendHealthMonitor(sd_client)
+        self.files_dir = files_dir
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.stopping = asyncio.Event()
+        self._backend_changed = asyncio.Event()
+        self.backend.add_listener(self._backend_changed.set)
+    
+    async def run(self):
+        """Выполняет пакеты до вызова stop(); текущий пакет доводится до конца"""
+        os.makedirs(self.files_dir, exist_ok=True)
+        await self.backend.start()
+        logging.info(f"Worker {self.worker_id} запущен, SD WebUI: {self.sd_client.base_url}")
+        try:
+            while not self.stopping.is_set():
+                if not self.backend.is_accepting():
+                    # WebUI недоступен: пакеты остаются другим worker
+                    self._backend_changed.clear()
+                    await self._wait(self._backend_changed, self.lease_seconds)
+                    continue
+                job = await self.broker.lease(self.worker_id, self.lease_seconds)
+                if job is None:
+                    await self._wait(self.stopping, self.poll_interval)
+                    continue
+                await self.execute(job)
+        finally:
+            await self.backend.stop()
+            await self.sd_client.close()
+            self.broker.close()
+            logging.info(f"Worker {self.worker_id} остановлен")
+    
+    def stop(self):
+        self.stopping.set()
+    
+    async def _wait(self, event: asyncio.Event, timeout: float):
+        """Ждет события, остановки worker или таймаута"""
+        waiters = {asyncio.ensure_future(event.wait()), asyncio.ensure_future(self.stopping.wait())}
+        try:
+            await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+    
+    async def execute(self, job: Job):
+        """Выполняет пакет и возвращает результат в брокер"""
+        if job.attempts > 1:
+            logging.warning(f"Пакет {job.id} выдан повторно после истечения аренды (попытка {job.attempts})")
+        progress: Dict[str, Any] = {}
+        
+        def on_progress(stage: GenerationStage, percent: float, eta: Optional[float]):
+            progress.update(stage=stage.value, progress=percent, eta=eta)
+        
+        payload = job.payload
+        generation = asyncio.create_task(generate_batch(
+            self.sd_client, payload["prompt"], payload["params"], payload["count"], on_progress
+        ))
+        revoked = asyncio.Event()
+        keepalive = asyncio.create_task(self._keepalive(job, progress, generation, revoked))
+        try:
+            results, backend_failed = await generation
+            if results is None:
+                kind, message = "error", {"results": None, "backend_failed": backend_failed,
+                                          "error": "Ошибка при генерации изображения"}
+            else:
+                kind, message = "result", {"results": await asyncio.to_thread(self._save_images, job.id, results)}
+        except asyncio.CancelledError:
+            if not revoked.is_set():
+                raise
+            # Бот снял пакет (задачи отменены): генерация на WebUI уже прервана
+            logging.info(f"Пакет {job.id} снят, генерация прервана")
+            return
+        except Exception as e:
+            logging.error(f"Ошибка при выполнении пакета {job.id}: {e}")
+            kind, message = "error", {"results": None, "backend_failed": False, "error": str(e)}
+        finally:
+            keepalive.cancel()
+        
+        if not await self.broker.finish(job.id, self.worker_id, kind, message):
+            logging.warning(f"Пакет {job.id} снят или передан другому worker, результат отброшен")
+            remove_result_files(message)
+    
+    def _save_images(self, job_id: str, results: List[Dict]) -> List[Dict]:
+        """Переносит изображения во файлы, доступные боту; в событие попадают только пути"""
+        saved = []
+        try:
+            for i, result in enumerate(results):
+                path = os.path.abspath(os.path.join(self.files_dir, f"{job_id}_{i}.png"))
+                image = result.pop("image")
+                image.seek(0)
+                with open(path, "wb") as f:
+                    shutil.copyfileobj(image, f)
+                image.close()
+                saved.append({**result, "image_path": path})
+        except BaseException:
+            close_images(result["image"] for result in results if "image" in result)
+            remove_result_files({"results": saved})
+            raise
+        return saved
+    
+    async def _keepalive(self, job: Job, progress: Dict[str, Any], generation: asyncio.Task, revoked: asyncio.Event):
+        """Продлевает аренду и передает боту последний прогресс; потеряв аренду, прерывает генерацию"""
+        sent = None
+        renewed_at = 0.0
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            changed = bool(progress) and progress != sent
+            if not changed and loop.time() - renewed_at < self.lease_seconds / 3:
+                continue
+            try:
+                if not await self.broker.renew(job.id, self.worker_id, self.lease_seconds, dict(progress) if changed else None):
+                    logging.warning(f"Аренда пакета {job.id} потеряна")
+                    # Пакет снят или передан другому worker: дорисовывать его незачем
+                    revoked.set()
+                    generation.cancel()
+                    return
+            except Exception as e:
+                logging.error(f"Не удалось продлить аренду пакета {job.id}: {e}")
+                continue
+            sent = dict(progress)
+            renewed_at = loop.time()
+
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    worker = GenerationWorker(create_broker(), StableDiffusionClient())
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, worker.stop)
+        except NotImplementedError:
+            # Windows: остановка по KeyboardInterrupt
+            pass
+    await worker.run()
+
+if __name__ == "__main__":
+    asyncio.run(main())